@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from email.utils import parsedate_to_datetime
+
+from landsatxplore.errors import EarthExplorerError
+from tqdm import tqdm
+
+from .constants import (
+    ASYNC_MAX_CONCURRENCY,
+    DOWNLOAD_WORKERS,
+    THROTTLE_STATUS,
+    TIMEOUT,
+)
+from .feature_utils import content_range_size, url2name
+from .profiling import count
+
+logger = logging.getLogger("__name__")
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+REQUEST_ATTEMPTS = 8
+DEFAULT_RETRY_AFTER = 2.0
+
+
+def retry_after_seconds(value, default=DEFAULT_RETRY_AFTER):
+    """
+    The retry_after_seconds function parses a Retry-After header.
+
+    Args:
+        value (str): header value, seconds or an HTTP date.
+        default (float): seconds when the header is missing or invalid.
+    Returns:
+        float: seconds to wait.
+    """
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that adapts to the server (additive increase, multiplicative decrease).
+
+    A throttled response (429/503) halves the limit and pauses new requests for the
+    Retry-After time, after as many healthy responses as the current limit, the limit
+    grows by one up to maximum.
+    """
+
+    def __init__(self, initial=DOWNLOAD_WORKERS, maximum=ASYNC_MAX_CONCURRENCY):
+        self.limit = max(1, min(initial, maximum))
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.condition = asyncio.Condition()
+        self.stats = {
+            "throttled": 0,
+            "min_limit": self.limit,
+            "max_limit": self.limit,
+        }
+
+    async def __aenter__(self):
+        async with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < self.limit:
+                    break
+                try:
+                    await asyncio.wait_for(
+                        self.condition.wait(), timeout=wait if wait > 0 else None
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def throttled(self, retry_after):
+        async with self.condition:
+            self.stats["throttled"] += 1
+            self.successes = 0
+            self.limit = max(1, self.limit // 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.stats["min_limit"] = min(self.stats["min_limit"], self.limit)
+
+    async def healthy(self):
+        async with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.successes = 0
+                self.limit += 1
+                self.stats["max_limit"] = max(self.stats["max_limit"], self.limit)
+                self.condition.notify_all()
+
+
+class _Throttled(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+def _rejected(ee, response):
+    """Check if the server rejected the cookies of the web session, like WrapperEarthExplorer._rejected."""
+    if ee.sessions is None:
+        return False
+    location = response.headers.get("Location", "")
+    return response.status in (401, 403) or (
+        300 <= response.status < 400 and "login" in location
+    )
+
+
+async def _refresh_cookies(ee, session, rejected):
+    """Get new cookies from the session manager and copy them to the aiohttp session."""
+    ee.cookies = await asyncio.to_thread(
+        ee.sessions.web_cookies, ee.session, rejected
+    )
+    session.cookie_jar.clear()
+    _copy_cookies(ee, session.cookie_jar)
+
+
+async def _get_json(ee, session, limiter, url, timeout):
+    """Get the redirect JSON of EarthExplorer, waiting when the server throttles."""
+    refreshed = False
+    for _ in range(REQUEST_ATTEMPTS):
+        rejected = None
+        async with limiter:
+            cookies = ee.cookies if ee.sessions else None
+            async with session.get(
+                url, allow_redirects=False, timeout=timeout
+            ) as response:
+                if not refreshed and _rejected(ee, response):
+                    rejected = cookies
+                elif response.status in THROTTLE_STATUS:
+                    retry_after = retry_after_seconds(
+                        response.headers.get("Retry-After")
+                    )
+                else:
+                    response.raise_for_status()
+                    data = await response.json(content_type=None)
+                    await limiter.healthy()
+                    return data
+        if rejected is not None:
+            # the web session expired, the cookies are refreshed once
+            refreshed = True
+            await _refresh_cookies(ee, session, rejected)
+            continue
+        await limiter.throttled(retry_after)
+    raise EarthExplorerError(f"{url2name(url)} throttled {REQUEST_ATTEMPTS} times.")
+
+
+async def _stream_part(session, url, part_path, timeout, name):
+    """Append the missing bytes to part_path, return the size of the whole file if it is known."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        if response.status in THROTTLE_STATUS:
+            raise _Throttled(retry_after_seconds(response.headers.get("Retry-After")))
+        if response.status == 416:
+            file_size = content_range_size(response.headers.get("Content-Range"))
+            if file_size != offset:
+                os.remove(part_path)
+            return file_size
+        response.raise_for_status()
+        if response.status == 206:
+            file_size = content_range_size(response.headers.get("Content-Range"))
+            file_mode = "ab"
+        else:
+            file_size = response.content_length
+            file_mode = "wb"
+            offset = 0
+        with tqdm(
+            desc=f"download  {name} file",
+            total=file_size,
+            initial=offset,
+            unit_scale=True,
+            unit="B",
+            unit_divisor=1024,
+        ) as pbar:
+            with open(part_path, file_mode) as dst:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    dst.write(chunk)
+                    pbar.update(len(chunk))
+                    count("bytes_downloaded", len(chunk))
+    return file_size
+
+
+async def _fetch(session, limiter, url, file_path, timeout, aiohttp):
+    """Stream the file to file_path.part and rename it when it is complete."""
+    name = url2name(file_path)
+    part_path = f"{file_path}.part"
+    for _ in range(REQUEST_ATTEMPTS):
+        retry_after = None
+        async with limiter:
+            try:
+                file_size = await _stream_part(session, url, part_path, timeout, name)
+            except _Throttled as ex:
+                retry_after = ex.retry_after
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError) as ex:
+                logger.warning(f"download of {name} interrupted: {ex}")
+                continue
+            except asyncio.TimeoutError:
+                raise EarthExplorerError(f"Connection timeout after {timeout} seconds.")
+        if retry_after is not None:
+            await limiter.throttled(retry_after)
+            continue
+        if os.path.exists(part_path) and (
+            file_size is None or os.path.getsize(part_path) == file_size
+        ):
+            os.replace(part_path, file_path)
+            await limiter.healthy()
+            return file_path
+    raise EarthExplorerError(
+        f"Download of {name} failed after {REQUEST_ATTEMPTS} attempts."
+    )
+
+
+def _copy_cookies(ee, jar):
+    """Copy the login cookies of the requests session to an aiohttp jar keeping their domains."""
+    from yarl import URL
+
+    for cookie in ee.session.cookies:
+        domain = (cookie.domain or "").lstrip(".")
+        if domain:
+            jar.update_cookies(
+                {cookie.name: cookie.value}, response_url=URL(f"https://{domain}/")
+            )
+    return jar
+
+
+async def _download_bands(
+    ee, tasks, cache, timeout, initial_concurrency, max_concurrency, aiohttp
+):
+    limiter = AdaptiveLimiter(initial=initial_concurrency, maximum=max_concurrency)
+    connector = aiohttp.TCPConnector(
+        limit=max_concurrency, limit_per_host=ee.max_per_host
+    )
+    tmp_dir = None if cache else tempfile.TemporaryDirectory()
+    client_timeout = aiohttp.ClientTimeout(sock_read=timeout, sock_connect=timeout)
+
+    async def fetch_band_(session, url, key):
+        data = await _get_json(ee, session, limiter, url, client_timeout)
+        if data.get("errorMessage"):
+            raise EarthExplorerError(data.get("errorMessage"))
+        tmp_path = cache.tmp_path(key) if cache else f"{tmp_dir.name}/{key}.TIF"
+        await _fetch(
+            session, limiter, data.get("url"), tmp_path, client_timeout, aiohttp
+        )
+        return tmp_path
+
+    async def download_band_(session, display_id, band, features_contains):
+        url = ee.band_url(display_id, band)
+        key = url2name(url)
+        if not cache:
+            file_path = await fetch_band_(session, url, key)
+            # masking runs in a thread while other bands are downloaded
+            data_read = await asyncio.to_thread(
+                ee._read_from_path, file_path, features_contains
+            )
+            os.remove(file_path)
+            return {"name": key, "data_read": data_read}
+
+        # the lock of the key is shared with the threads and the other processes of the
+        # cache, it is acquired in a thread to not block the loop
+        lock = cache.lock(key)
+        await asyncio.to_thread(lock.__enter__)
+        try:
+            file_path = await asyncio.to_thread(cache.get, key)
+            count("band_cache_hits" if file_path else "band_cache_misses")
+            if file_path is None:
+                tmp_path = await fetch_band_(session, url, key)
+                file_path = await asyncio.to_thread(cache.put, key, tmp_path)
+            data_read = await asyncio.to_thread(
+                ee._read_from_path, file_path, features_contains
+            )
+        finally:
+            lock.__exit__(None, None, None)
+        return {"name": key, "data_read": data_read}
+
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, cookie_jar=_copy_cookies(ee, aiohttp.CookieJar())
+        ) as session:
+            results = await asyncio.gather(
+                *[download_band_(session, *task) for task in tasks]
+            )
+    finally:
+        if tmp_dir:
+            tmp_dir.cleanup()
+    logger.info(f"async download limiter: {limiter.stats}, final limit {limiter.limit}")
+    return results, limiter.stats
+
+
+def download_bands_async(
+    ee,
+    tasks,
+    cache=None,
+    timeout=TIMEOUT,
+    initial_concurrency=DOWNLOAD_WORKERS,
+    max_concurrency=ASYNC_MAX_CONCURRENCY,
+):
+    """
+    The download_bands_async function downloads and masks the bands with an asyncio engine.
+
+    The concurrency adapts to the server, it is cut when the server answers 429 or 503
+    and waits for the Retry-After header, then it grows again while the server is healthy.
+    The requests to the same host are limited by ee.max_per_host, and the cookies are
+    refreshed through the session manager when the server rejects them.
+
+    Args:
+        ee (WrapperEarthExplorer): logged EarthExplorer, its cookies are reused.
+        tasks (list): A list of (display_id, band, features_contains) tuples.
+        cache (BandCache): Optional band cache.
+        timeout (int): seconds to wait for the connection and each read.
+        initial_concurrency (int): concurrent requests at the start.
+        max_concurrency (int): upper limit of concurrent requests.
+
+    Returns:
+         tuple : A list of band dicts in the order of tasks and the stats of the limiter.
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            "The async download engine needs aiohttp, install it with: pip install landsat2geojson[async]"
+        )
+    return asyncio.run(
+        _download_bands(
+            ee, tasks, cache, timeout, initial_concurrency, max_concurrency, aiohttp
+        )
+    )
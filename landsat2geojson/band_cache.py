@@ -0,0 +1,276 @@
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from .constants import BAND_CACHE_MAX_BYTES
+
+logger = logging.getLogger("__name__")
+
+HASH_CHUNK_SIZE = 1 << 20
+SQLITE_TIMEOUT = 60
+
+
+def file_digest(file_path: str):
+    """
+    The file_digest function calculates the sha256 of a file.
+
+    Args:
+        file_path (str): path of file.
+    Returns:
+        str: hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as src:
+        for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def band_key(display_id: str, band: str):
+    """Name of a band of a scene in the download url, it is also its key in the band cache."""
+    return f"L2SR_{display_id}_SR_{band}_TIF"
+
+
+class BandCache:
+    """Content addressed cache of band files, bounded in size with LRU eviction.
+
+    The manifest is a SQLite database with the key, checksum, size, modification time and
+    last access of each entry, so several processes can share the same cache folder. The
+    files are stored by checksum and written with atomic renames. A hit is validated with
+    the size and the modification time, verify recalculates the checksums.
+    """
+
+    def __init__(self, root, max_bytes=BAND_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, "objects")
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL,
+                    mtime REAL
+                )""")
+            columns = [i[1] for i in conn.execute("PRAGMA table_info(entries)")]
+            if "mtime" not in columns:
+                # manifest of a previous version, its entries are hashed once by get
+                conn.execute("ALTER TABLE entries ADD COLUMN mtime REAL")
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            os.path.join(self.root, "manifest.sqlite"),
+            timeout=SQLITE_TIMEOUT,
+            isolation_level=None,
+        )
+        return contextlib.closing(conn)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.TIF")
+
+    def tmp_path(self, key):
+        """Path to download a file before adding it with put, it is kept between runs to resume downloads."""
+        return os.path.join(self.tmp_dir, f"{key}.TIF")
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        """
+        The lock method takes an exclusive lock of a key between threads and processes.
+
+        The key is locked while it is downloaded and read, the eviction skips locked keys.
+
+        Args:
+            key (str): name of the file.
+            blocking (bool): wait for the lock, otherwise it is not taken if it is busy.
+        Returns:
+            bool: the lock was taken.
+        """
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.tmp_dir, f"{key}.lock"), "w") as lock_file:
+            try:
+                mode = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                fcntl.flock(lock_file, mode)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _valid(self, path, digest, size, mtime):
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+        if mtime is None:
+            return file_digest(path) == digest
+        return os.path.getmtime(path) == mtime
+
+    def get(self, key):
+        """
+        The get method gets the path of a cached file, the entry is validated and its access time updated.
+
+        Args:
+            key (str): name of the file.
+        Returns:
+            str: path of the file, None if it is not cached or it is corrupted.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT digest, size, mtime FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            digest, size, mtime = row
+            path = self._object_path(digest)
+            if not self._valid(path, digest, size, mtime):
+                self._remove_corrupted(conn, key, digest)
+                return None
+            conn.execute(
+                "UPDATE entries SET last_access = ?, mtime = ? WHERE key = ?",
+                (time.time(), os.path.getmtime(path), key),
+            )
+        return path
+
+    def _remove_corrupted(self, conn, key, digest):
+        logger.warning(f"cache entry {key} is corrupted, it will be removed")
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._remove_unreferenced(conn, digest)
+        conn.execute("COMMIT")
+
+    def verify(self):
+        """
+        The verify method recalculates the checksum of each entry and removes the corrupted ones.
+
+        Returns:
+            list: keys of the removed entries.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, digest, size FROM entries").fetchall()
+        corrupted = []
+        for key, digest, size in rows:
+            with self.lock(key):
+                path = self._object_path(digest)
+                if os.path.isfile(path) and os.path.getsize(path) == size:
+                    if file_digest(path) == digest:
+                        continue
+                with self._connect() as conn:
+                    self._remove_corrupted(conn, key, digest)
+                corrupted.append(key)
+        return corrupted
+
+    def contains(self, key):
+        """Check if a key is cached, only with the size of the file, the modification time is validated by get."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT digest, size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return False
+        path = self._object_path(row[0])
+        return os.path.isfile(path) and os.path.getsize(path) == row[1]
+
+    def put(self, key, file_path):
+        """
+        The put method moves a file to the cache and evicts the least recently used entries over the budget.
+
+        Args:
+            key (str): name of the file.
+            file_path (str): path of the file, it is moved.
+        Returns:
+            str: path of the cached file.
+        """
+        digest = file_digest(file_path)
+        size = os.path.getsize(file_path)
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(file_path, path)
+        mtime = os.path.getmtime(path)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            previous = conn.execute(
+                "SELECT digest FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, digest, size, last_access, mtime) VALUES (?, ?, ?, ?, ?)",
+                (key, digest, size, time.time(), mtime),
+            )
+            # the same content of other keys was replaced too
+            conn.execute(
+                "UPDATE entries SET mtime = ? WHERE digest = ?", (mtime, digest)
+            )
+            if previous and previous[0] != digest:
+                self._remove_unreferenced(conn, previous[0])
+            self._evict(conn, keep=key)
+            conn.execute("COMMIT")
+        return path
+
+    def _remove_unreferenced(self, conn, digest):
+        used = conn.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)
+        ).fetchone()
+        if not used:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._object_path(digest))
+
+    def _evict(self, conn, keep=None):
+        if self.max_bytes is None:
+            return
+        total = self._total_bytes(conn)
+        rows = conn.execute(
+            "SELECT key, digest, size FROM entries WHERE key != ? ORDER BY last_access",
+            (keep or "",),
+        ).fetchall()
+        for key, digest, size in rows:
+            if total <= self.max_bytes:
+                break
+            # a key that is downloaded or read by other thread or process is kept
+            with self.lock(key, blocking=False) as locked:
+                if not locked:
+                    logger.info(f"cache entry {key} is in use, it is not evicted")
+                    continue
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                if not conn.execute(
+                    "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)
+                ).fetchone():
+                    total -= size
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self._object_path(digest))
+            logger.info(f"cache entry {key} evicted")
+
+    def _total_bytes(self, conn):
+        row = conn.execute(
+            "SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM entries)"
+        ).fetchone()
+        return row[0] or 0
+
+    def evict(self):
+        """Evict the least recently used entries until the cache fits in max_bytes."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._evict(conn)
+            conn.execute("COMMIT")
+
+    def stats(self):
+        """Number of entries and bytes of the cache."""
+        with self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            return {
+                "entries": entries,
+                "bytes": self._total_bytes(conn),
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,110 @@
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+import numpy as np
+
+from .constants import BAND_STORE_DIR
+from .profiling import count
+
+logger = logging.getLogger("__name__")
+
+
+class BandStore:
+    """Arrays of the bands of a run in memory mapped files, shared by its processes.
+
+    Each array is written once as a .npy file and the scenes carry a small handle with
+    its path instead of the array, so the process pools pickle the handle and the
+    workers map the same pages without copying them. The files are removed when the
+    store is closed.
+    """
+
+    def __init__(self, root=BAND_STORE_DIR):
+        if root:
+            os.makedirs(root, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix="landsat2geojson_", dir=root)
+
+    def put(self, name: str, array):
+        """
+        The put method writes an array in the store.
+
+        Args:
+            name (str): name of the array, like the scene and the band.
+            array (ndarray): array to write.
+        Returns:
+            dict: handle of the array, None if it does not fit in the store.
+        """
+        path = os.path.join(self.root, f"{name}_{uuid.uuid4().hex}.npy")
+        try:
+            np.save(path, array)
+        except OSError as ex:
+            # the shared memory of the containers can be small
+            logger.warning(
+                f"{name} is kept in memory, it does not fit in the store: {ex}"
+            )
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            return None
+        count("band_store_bytes", array.nbytes)
+        return {"path": path, "shape": list(array.shape), "dtype": str(array.dtype)}
+
+    def remove_scene(self, raw_data: dict):
+        """Remove the arrays of the bands and the indices of the raw data of a scene."""
+        values = [
+            i.get("data_read", {}).get("out_image")
+            for key, i in raw_data.items()
+            if key != "index"
+        ]
+        values += [i.get("index_result") for i in raw_data.get("index", {}).values()]
+        for value in values:
+            if isinstance(value, dict):
+                with contextlib.suppress(OSError):
+                    os.remove(value["path"])
+
+    def close(self):
+        """Remove the arrays of the store, their handles are not valid anymore."""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def store_array(store, data: dict, key: str, name: str):
+    """
+    The store_array function moves an array of a dict to the store, the dict keeps its handle.
+
+    Args:
+        store (BandStore): Optional band store, without it the array is kept in the dict.
+        data (dict): dict with the array, like the data_read of a band.
+        key (str): key of the array in the dict.
+        name (str): name of the array in the store.
+    Returns:
+        dict: the same dict.
+    """
+    array = data.get(key)
+    if store is None or not isinstance(array, np.ndarray):
+        return data
+    handle = store.put(name, array)
+    if handle:
+        data[key] = handle
+    return data
+
+
+def load_array(value):
+    """
+    The load_array function gets the array of a handle of the store, read only and memory mapped.
+
+    Args:
+        value (dict | ndarray): handle of store_array, or an array that was not stored.
+    Returns:
+        ndarray: the array.
+    """
+    if isinstance(value, dict):
+        return np.load(value["path"], mmap_mode="r")
+    return value
@@ -0,0 +1,565 @@
+import csv
+import json
+import logging
+import os
+import time
+
+import click
+import geopandas as gpd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from .band_cache import BandCache
+from .band_store import BandStore, store_array
+from .constants import (
+    BAND_CACHE_MAX_BYTES,
+    BAND_STORE_DIR,
+    DOWNLOAD_WORKERS,
+    MAX_CONNECTIONS_PER_HOST,
+    OUTPUT_FORMATS,
+    OVERPASS_ENDPOINT,
+    OVERPASS_TILE_DEG,
+    OVERPASS_WORKERS,
+    SEARCH_CACHE_PATH,
+    SEARCH_CACHE_TTL_DAYS,
+)
+from .download_band import EE_DOWNLOAD_URL, WrapperEarthExplorer
+from .feature_utils import clean_path, create_folder, fc2box, fc2geoms, url2name
+from .indices import get_indices, required_bands
+from .main import search_scenes, write_index_outputs
+from .process_landsat import calculate_indices_feature
+from .search_cache import SearchCache
+from .vector_io import guess_driver, read_features
+
+logger = logging.getLogger("__name__")
+
+MANIFEST_INDEX_SEPARATOR = ";"
+
+
+def read_manifest(manifest_file: str):
+    """
+    The read_manifest function reads the jobs of a batch.
+
+    The manifest is a JSON list of jobs, or a CSV file with a header, each job has an input,
+    an output and the index, or a list of indices separated by ";" in a CSV file. The
+    relative paths are relative to the folder of the manifest.
+
+    Args:
+        manifest_file (str): path of the JSON or CSV manifest.
+    Returns:
+        list: list of jobs with name, geojson_file, geojson_output and landsat_index.
+    """
+    with open(manifest_file, encoding="utf-8") as src:
+        if manifest_file.lower().endswith(".csv"):
+            rows = list(csv.DictReader(src))
+        else:
+            rows = json.load(src)
+            if isinstance(rows, dict):
+                rows = rows.get("jobs", [])
+    folder = os.path.dirname(os.path.abspath(manifest_file))
+
+    jobs = []
+    names = set()
+    outputs = set()
+    for number, row in enumerate(rows, 1):
+        missing = [i for i in ("input", "output") if not row.get(i)]
+        if missing:
+            raise ValueError(f"Job {number} of {manifest_file} has no {missing}")
+        geojson_output = os.path.join(folder, row["output"])
+        if geojson_output in outputs:
+            raise ValueError(
+                f"Job {number} of {manifest_file} has the output of other job"
+            )
+        outputs.add(geojson_output)
+        landsat_index = row.get("index") or ["WATER"]
+        if isinstance(landsat_index, str):
+            landsat_index = [
+                i.strip()
+                for i in landsat_index.split(MANIFEST_INDEX_SEPARATOR)
+                if i.strip()
+            ]
+        # the name is the folder of the files of the job in data_folder
+        name = row.get("name") or os.path.splitext(os.path.basename(row["output"]))[0]
+        if name in names:
+            name = f"{name}_{number}"
+        names.add(name)
+        jobs.append(
+            {
+                "name": name,
+                "geojson_file": os.path.join(folder, row["input"]),
+                "geojson_output": geojson_output,
+                "landsat_index": landsat_index,
+            }
+        )
+    return jobs
+
+
+def plan_batch(jobs: list):
+    """
+    The plan_batch function gets the union of the scenes and bands needed by the jobs.
+
+    Args:
+        jobs (list): list of jobs with scenes and indices.
+    Returns:
+        list: list of (display_id, band, uses) tuples, uses are the (job, scene)
+            positions and the features of the scene in the job.
+    """
+    uses = {}
+    for job_id, job in enumerate(jobs):
+        if job.get("error"):
+            continue
+        for scene_id, scene in enumerate(job["scenes"]):
+            features_contains = gpd.GeoSeries(
+                [i["geom"] for i in scene.get("features_contains", [])]
+            ).set_crs(4326)
+            for band in required_bands(job["indices"]):
+                uses.setdefault((scene.get("display_id"), band), []).append(
+                    (job_id, scene_id, features_contains)
+                )
+    return [(display_id, band, uses_) for (display_id, band), uses_ in uses.items()]
+
+
+def release_scenes(scenes: list, band_store=None):
+    """
+    The release_scenes function drops the bands and the indices of the scenes of a job.
+
+    Args:
+        scenes (list): scenes of the job, and the copies calculated in other processes.
+        band_store (BandStore): Optional band store, the arrays of the scenes are removed.
+    """
+    for scene in scenes:
+        raw_data = scene.pop("raw_data", None)
+        if band_store and raw_data:
+            band_store.remove_scene(raw_data)
+
+
+def download_batch(ee, cache, plan: list, n_jobs=DOWNLOAD_WORKERS, band_store=None):
+    """
+    The download_batch function downloads each band of the plan once and masks it with the features of each job.
+
+    Args:
+        ee (WrapperEarthExplorer): logged EarthExplorer.
+        cache (BandCache): band cache, the bands are read from it by each job.
+        plan (list): list of (display_id, band, uses) tuples of plan_batch.
+        n_jobs (int): number of download threads, each (scene, band) pair is a task.
+        band_store (BandStore): Optional band store, the band dicts keep the handles of the arrays.
+    Returns:
+        list: list of (job, scene, band, band dict, seconds of the masking) tuples,
+            the band dict is the exception when the band could not be downloaded.
+    """
+
+    def fetch_band_(display_id, band, uses):
+        url = ee.band_url(display_id, band)
+        name = url2name(url)
+        # the lock keeps the band in the cache while the jobs read it
+        with cache.lock(name):
+            try:
+                file_path = ee._cache_band(url, cache)
+            except Exception as ex:
+                # only the jobs of the band fail
+                logger.error(f"{display_id} {band}: {ex}")
+                return [
+                    (job_id, scene_id, band, ex, 0.0) for job_id, scene_id, _ in uses
+                ]
+            reads = []
+            for job_id, scene_id, features_contains in uses:
+                start = time.perf_counter()
+                data_read = ee._read_from_path(file_path, features_contains)
+                store_array(band_store, data_read, "out_image", f"{job_id}_{name}")
+                reads.append(
+                    (
+                        job_id,
+                        scene_id,
+                        band,
+                        {"name": name, "data_read": data_read},
+                        time.perf_counter() - start,
+                    )
+                )
+        return reads
+
+    # download is I/O bound, every (scene, band) pair runs in a thread
+    results = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(fetch_band_)(display_id, band, uses)
+        for display_id, band, uses in tqdm(plan, desc="Prepare download data")
+    )
+    return [read for reads in results for read in reads]
+
+
+def landsat2geojson_batch(
+    username,
+    password,
+    manifest_file,
+    data_folder,
+    cache_dir=None,
+    cache_max_gb=None,
+    download_workers=DOWNLOAD_WORKERS,
+    max_per_host=MAX_CONNECTIONS_PER_HOST,
+    search_cache=SEARCH_CACHE_PATH,
+    search_cache_ttl_days=SEARCH_CACHE_TTL_DAYS,
+    overpass_endpoint=OVERPASS_ENDPOINT,
+    overpass_tile_deg=OVERPASS_TILE_DEG,
+    overpass_workers=OVERPASS_WORKERS,
+    overpass_cache_dir=None,
+    block_size=None,
+    simplify_tolerance=None,
+    min_area=None,
+    coord_precision=None,
+    output_format=None,
+    download_url=EE_DOWNLOAD_URL,
+    band_store_dir=BAND_STORE_DIR,
+):
+    """
+    The landsat2geojson_batch function runs the jobs of a manifest with shared searches, downloads and sessions.
+
+    The scenes of all the jobs are searched with one login, each band of the union of the
+    scenes is downloaded once to the band cache and masked with the features of each job
+    that uses it. The files of each job are saved in data_folder/<job name>, the report
+    with the timings of each job is saved in data_folder/batch_report.json.
+
+    Args:
+        username (str): username for earthexplorer.
+        password (str):  password for earthexplorer.
+        manifest_file (str): path of the JSON or CSV manifest, see read_manifest.
+        data_folder (str): path of directory.
+        download_url (str): template of the EarthExplorer download url.
+        band_store_dir (str): folder of the band arrays memory mapped by the processes, empty to disable it.
+        The other arguments are the options of landsat2geojson.
+    Returns:
+        dict: the report of the batch.
+    """
+    start = time.perf_counter()
+    data_folder = clean_path(data_folder) or "."
+    create_folder(data_folder)
+    jobs = read_manifest(manifest_file)
+    timings = {}
+
+    # one login for the searches and the downloads
+    ee = WrapperEarthExplorer(
+        username,
+        password,
+        download_url,
+        pool_size=download_workers,
+        max_per_host=max_per_host,
+    )
+    cache = BandCache(
+        cache_dir or f"{data_folder}/band_cache",
+        int(cache_max_gb * 1024**3) if cache_max_gb else BAND_CACHE_MAX_BYTES,
+    )
+    search_cache = (
+        SearchCache(search_cache, search_cache_ttl_days) if search_cache else None
+    )
+
+    stage = time.perf_counter()
+    for job in jobs:
+        job_start = time.perf_counter()
+        job["seconds"] = {}
+        try:
+            job["indices"] = get_indices(job["landsat_index"])
+            features = list(read_features(job["geojson_file"]))
+            features_geoms = fc2geoms(features)
+            job["features_bbox"] = fc2box(features, features_geoms)
+            job["scenes"] = search_scenes(
+                username,
+                password,
+                features,
+                features_geoms,
+                job["features_bbox"],
+                search_cache=search_cache,
+                api=getattr(ee, "api", None),
+            )
+        except Exception as ex:
+            logger.error(f"job {job['name']}: {ex}")
+            job["error"] = str(ex)
+        job["seconds"]["search"] = time.perf_counter() - job_start
+    timings["search"] = time.perf_counter() - stage
+
+    # the bands read for each job are written once, the processes map them
+    band_store = BandStore(band_store_dir) if band_store_dir else None
+    try:
+        stage = time.perf_counter()
+        plan = plan_batch(jobs)
+        reads = download_batch(
+            ee, cache, plan, n_jobs=download_workers, band_store=band_store
+        )
+        for job_id, scene_id, band, band_read, seconds in reads:
+            if isinstance(band_read, Exception):
+                jobs[job_id]["error"] = str(band_read)
+                continue
+            raw_data = jobs[job_id]["scenes"][scene_id].setdefault("raw_data", {})
+            raw_data[band] = band_read
+            seconds_ = jobs[job_id]["seconds"]
+            seconds_["mask"] = seconds_.get("mask", 0.0) + seconds
+        # the bands read for a job that failed are not used
+        for job in jobs:
+            if job.get("error"):
+                release_scenes(job.get("scenes", []), band_store)
+        timings["download"] = time.perf_counter() - stage
+
+        stage = time.perf_counter()
+        overpass_cache_dir = overpass_cache_dir or f"{data_folder}/overpass_cache"
+        for job in jobs:
+            if job.get("error"):
+                continue
+            job_start = time.perf_counter()
+            job_folder = f"{data_folder}/{job['name']}"
+            create_folder(job_folder)
+            job_format = output_format or guess_driver(job["geojson_output"])
+            data_result = []
+            try:
+                data_result = calculate_indices_feature(
+                    job["scenes"],
+                    job["indices"],
+                    job_folder,
+                    block_size=block_size,
+                    simplify_tolerance=simplify_tolerance,
+                    min_area=min_area,
+                    precision=coord_precision,
+                    output_format=job_format,
+                    band_store=band_store,
+                )
+                job["seconds"]["index"] = time.perf_counter() - job_start
+                if not write_index_outputs(
+                    data_result,
+                    job["indices"],
+                    job["features_bbox"],
+                    job_folder,
+                    job["geojson_output"],
+                    job_format,
+                    overpass_endpoint=overpass_endpoint,
+                    overpass_tile_deg=overpass_tile_deg,
+                    overpass_workers=overpass_workers,
+                    overpass_cache_dir=overpass_cache_dir,
+                ):
+                    job["error"] = "No results that satisfy the index"
+            except Exception as ex:
+                logger.error(f"job {job['name']}: {ex}")
+                job["error"] = str(ex)
+            # the bands and the indices of the job are not needed anymore, the
+            # scenes calculated in other processes are copies
+            release_scenes(job["scenes"] + data_result, band_store)
+            job["seconds"]["output"] = (
+                time.perf_counter() - job_start - job["seconds"].get("index", 0.0)
+            )
+        timings["jobs"] = time.perf_counter() - stage
+    finally:
+        if band_store:
+            band_store.close()
+    timings["total"] = time.perf_counter() - start
+
+    report = {
+        "jobs": [
+            {
+                "name": job["name"],
+                "geojson_file": job["geojson_file"],
+                "geojson_output": job["geojson_output"],
+                "status": "failed" if job.get("error") else "done",
+                "error": job.get("error"),
+                "scenes": [i.get("display_id") for i in job.get("scenes", [])],
+                "seconds": {k: round(v, 3) for k, v in job["seconds"].items()},
+            }
+            for job in jobs
+        ],
+        "scenes": len({display_id for display_id, _, _ in plan}),
+        "bands": len(plan),
+        "bands_read": len(reads),
+        "seconds": {k: round(v, 3) for k, v in timings.items()},
+        "band_cache": cache.stats(),
+    }
+    with open(f"{data_folder}/batch_report.json", "w", encoding="utf-8") as dst:
+        json.dump(report, dst, indent=2)
+    return report
+
+
+@click.command(short_help="Run landsat2geojson for the jobs of a manifest")
+@click.option(
+    "-u",
+    "--username",
+    type=str,
+    help="EarthExplorer username.",
+    envvar="LANDSATXPLORE_USERNAME",
+)
+@click.option(
+    "-p",
+    "--password",
+    type=str,
+    help="EarthExplorer password.",
+    envvar="LANDSATXPLORE_PASSWORD",
+)
+@click.option(
+    "--manifest",
+    help="JSON or CSV file with the input, output and index of each job",
+    required=True,
+    type=str,
+)
+@click.option(
+    "--data_folder",
+    help="Path from download data, the files of each job are in a folder with its name",
+    type=str,
+    required=False,
+    default="",
+)
+@click.option(
+    "--cache_dir",
+    help="Path of the band cache, by default band_cache inside data_folder",
+    type=str,
+    required=False,
+    default=None,
+)
+@click.option(
+    "--cache_max_gb",
+    help="Size budget of the band cache in GB, the least recently used bands are evicted",
+    type=float,
+    required=False,
+    default=None,
+)
+@click.option(
+    "--download_workers",
+    help="Number of bands downloaded at the same time",
+    type=int,
+    default=DOWNLOAD_WORKERS,
+    show_default=True,
+)
+@click.option(
+    "--max_per_host",
+    help="Limit of concurrent requests to the same host",
+    type=int,
+    default=MAX_CONNECTIONS_PER_HOST,
+    show_default=True,
+)
+@click.option(
+    "--search_cache",
+    help="Path of the cache of scene searches, empty to disable it",
+    type=str,
+    default=SEARCH_CACHE_PATH,
+    show_default=True,
+)
+@click.option(
+    "--search_cache_ttl_days",
+    help="Days after which a cached search is done again",
+    type=int,
+    default=SEARCH_CACHE_TTL_DAYS,
+    show_default=True,
+)
+@click.option(
+    "--overpass_endpoint",
+    help="Url of the overpass interpreter",
+    type=str,
+    default=OVERPASS_ENDPOINT,
+    show_default=True,
+)
+@click.option(
+    "--overpass_tile_deg",
+    help="Size in degrees of the tiles of the overpass queries",
+    type=float,
+    default=OVERPASS_TILE_DEG,
+    show_default=True,
+)
+@click.option(
+    "--overpass_workers",
+    help="Number of overpass tiles queried at the same time",
+    type=int,
+    default=OVERPASS_WORKERS,
+    show_default=True,
+)
+@click.option(
+    "--overpass_cache_dir",
+    help="Folder of the cache of overpass tiles, by default overpass_cache in data_folder",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--band_store_dir",
+    help="Folder of the band arrays memory mapped by the processes, shared memory by default, empty to keep them in memory",
+    type=str,
+    default=BAND_STORE_DIR,
+    show_default=True,
+)
+@click.option(
+    "--block_size",
+    help="Size in pixels of the blocks to calculate the index of each scene in parallel, by default the whole scene",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--simplify_tolerance",
+    help="Tolerance in meters to simplify the polygons of the index, the shared edges are kept",
+    type=float,
+    default=None,
+)
+@click.option(
+    "--min_area",
+    help="Min area in square meters of the polygons of the index",
+    type=float,
+    default=None,
+)
+@click.option(
+    "--coord_precision",
+    help="Number of decimals of the coordinates of the output",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--output_format",
+    help="Format of the outputs, by default from the extension of each output",
+    type=click.Choice(OUTPUT_FORMATS),
+    default=None,
+)
+def main(
+    username,
+    password,
+    manifest,
+    data_folder,
+    cache_dir,
+    cache_max_gb,
+    download_workers,
+    max_per_host,
+    search_cache,
+    search_cache_ttl_days,
+    overpass_endpoint,
+    overpass_tile_deg,
+    overpass_workers,
+    overpass_cache_dir,
+    band_store_dir,
+    block_size,
+    simplify_tolerance,
+    min_area,
+    coord_precision,
+    output_format,
+):
+    report = landsat2geojson_batch(
+        username,
+        password,
+        manifest,
+        data_folder,
+        cache_dir,
+        cache_max_gb,
+        download_workers,
+        max_per_host,
+        search_cache,
+        search_cache_ttl_days,
+        overpass_endpoint,
+        overpass_tile_deg,
+        overpass_workers,
+        overpass_cache_dir,
+        block_size,
+        simplify_tolerance,
+        min_area,
+        coord_precision,
+        output_format,
+        band_store_dir=band_store_dir,
+    )
+    for job in report["jobs"]:
+        seconds = ", ".join(f"{k} {v:.1f}s" for k, v in job["seconds"].items())
+        click.echo(f"{job['name']}: {job['status']} ({seconds})")
+    click.echo(
+        f"{len(report['jobs'])} jobs, {report['scenes']} scenes, "
+        f"{report['bands']} bands downloaded once for {report['bands_read']} reads, "
+        f"{report['seconds']['total']:.1f}s"
+    )
+    failed = [i["name"] for i in report["jobs"] if i["status"] == "failed"]
+    if failed:
+        raise click.ClickException(f"{len(failed)} jobs failed: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,623 @@
+import contextlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import click
+import numpy as np
+import rasterio as rio
+import shapely
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+from .constants import QUERY_DATA
+from .download_band import download_scenes
+from .feature_utils import (
+    fc2geoms,
+    features_in_escene,
+    mark_intersects,
+    reproject_geoms,
+)
+from .indices import get_indices, required_bands
+from .local_server import LocalServer
+from .overpass_search import get_overpass_data
+from .process_landsat import calculate_indices_feature
+from .vector_io import write_features
+
+logger = logging.getLogger("__name__")
+
+# size of the scenes in pixels, number of scenes, AOI features and OSM elements,
+# and boxes of each side of the mark_intersects stage
+BENCHMARK_SCALES = {
+    "small": {
+        "size": 1000,
+        "scenes": 2,
+        "features": 50,
+        "osm_elements": 200,
+        "intersects_features": 2000,
+    },
+    "medium": {
+        "size": 4000,
+        "scenes": 4,
+        "features": 500,
+        "osm_elements": 2000,
+        "intersects_features": 10000,
+    },
+    "large": {
+        "size": 8000,
+        "scenes": 8,
+        "features": 5000,
+        "osm_elements": 20000,
+        "intersects_features": 50000,
+    },
+}
+BENCHMARK_CRS = 32618
+BENCHMARK_ORIGIN = (500000.0, 4500000.0)
+PIXEL_SIZE = 30.0
+# the scenes overlap like the paths of landsat
+SCENE_OVERLAP = 0.15
+REGRESSION_THRESHOLD = 0.1
+# smaller changes are noise of the timer
+REGRESSION_MIN_SECONDS = 0.05
+# modules that the CLI imports only when a stage runs
+LAZY_MODULES = [
+    "geopandas",
+    "rasterio",
+    "shapely",
+    "numpy",
+    "landsatxplore",
+    "overpass",
+    "joblib",
+]
+
+
+def _water_field(size: int, rng):
+    """Smooth random field, the values over 0.6 are the water."""
+    cells = max(2, size // 128)
+    coarse = rng.random((cells + 1, cells + 1))
+    # bilinear upscale of the coarse grid
+    axis = np.linspace(0, cells, size, endpoint=False)
+    i0 = axis.astype(int)
+    t = (axis - i0).astype(np.float32)
+    rows = coarse[i0] * (1 - t)[:, None] + coarse[i0 + 1] * t[:, None]
+    return rows[:, i0] * (1 - t) + rows[:, i0 + 1] * t
+
+
+def scene_bounds(number: int, size: int):
+    """Bounds in BENCHMARK_CRS of the synthetic scene number, the scenes are in a row."""
+    width = size * PIXEL_SIZE
+    left = BENCHMARK_ORIGIN[0] + number * width * (1 - SCENE_OVERLAP)
+    top = BENCHMARK_ORIGIN[1]
+    return left, top - width, left + width, top
+
+
+def make_scene(folder: str, display_id: str, bands: list, size: int, bounds, seed=0):
+    """
+    The make_scene function writes synthetic bands of a Landsat-like scene.
+
+    The bands are tiled uint16 GeoTIFFs named like the files of EarthExplorer, with
+    smooth water areas where the normalized indices of the bands are high, and noise.
+
+    Args:
+        folder (str): folder of the files.
+        display_id (str): display id of the scene.
+        bands (list): list of band names, like B3.
+        size (int): width and height in pixels.
+        bounds (tuple): bounds of the scene in BENCHMARK_CRS.
+        seed (int): seed of the random values.
+    Returns:
+        list: paths of the bands.
+    """
+    rng = np.random.default_rng(seed)
+    water = _water_field(size, rng) > 0.6
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint16",
+        "count": 1,
+        "width": size,
+        "height": size,
+        "crs": f"EPSG:{BENCHMARK_CRS}",
+        "transform": from_origin(bounds[0], bounds[3], PIXEL_SIZE, PIXEL_SIZE),
+        "nodata": 0,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+    }
+    paths = []
+    for number, band in enumerate(bands):
+        # the first bands are bright over the water and the last ones dark
+        level = 12000 + (3000 if number % 2 == 0 else -3000) * water
+        data = level + rng.normal(0, 800, (size, size))
+        path = os.path.join(folder, f"{display_id}_SR_{band}.TIF")
+        with rio.open(path, "w", **profile) as dst:
+            dst.write(np.clip(data, 1, 65535).astype("uint16"), 1)
+        paths.append(path)
+    return paths
+
+
+def make_features(bounds, n_features: int, seed=0):
+    """
+    The make_features function creates random AOI polygons inside bounds.
+
+    Args:
+        bounds (tuple): bounds in BENCHMARK_CRS.
+        n_features (int): number of features.
+        seed (int): seed of the random values.
+    Returns:
+        list: list of GeoJSON features in EPSG:4326.
+    """
+    rng = np.random.default_rng(seed)
+    left, bottom, right, top = bounds
+    sizes = rng.uniform(0.01, 0.05, n_features) * (right - left)
+    xs = rng.uniform(left, right - sizes)
+    ys = rng.uniform(bottom, top - sizes)
+    geoms = reproject_geoms(
+        [box(x, y, x + s, y + s) for x, y, s in zip(xs, ys, sizes)],
+        BENCHMARK_CRS,
+        4326,
+    )
+    return [
+        {"type": "Feature", "properties": {"id": i}, "geometry": mapping(geom)}
+        for i, geom in enumerate(geoms)
+    ]
+
+
+def make_osm_elements(bounds, n_elements: int, seed=0):
+    """
+    The make_osm_elements function creates random closed ways with the water tags, like the overpass JSON.
+
+    Args:
+        bounds (tuple): bounds in BENCHMARK_CRS.
+        n_elements (int): number of ways.
+        seed (int): seed of the random values.
+    Returns:
+        list: list of OSM JSON elements with geometry.
+    """
+    rng = np.random.default_rng(seed)
+    left, bottom, right, top = bounds
+    sizes = rng.uniform(0.002, 0.02, n_elements) * (right - left)
+    xs = rng.uniform(left, right - sizes)
+    ys = rng.uniform(bottom, top - sizes)
+    geoms = reproject_geoms(
+        [box(x, y, x + s, y + s) for x, y, s in zip(xs, ys, sizes)],
+        BENCHMARK_CRS,
+        4326,
+    )
+    elements = []
+    for number, geom in enumerate(geoms):
+        coords = list(geom.exterior.coords)
+        elements.append(
+            {
+                "type": "way",
+                "id": number + 1,
+                "nodes": list(range(len(coords))),
+                "geometry": [{"lat": lat, "lon": lon} for lon, lat in coords],
+                "tags": {"natural": "water"},
+            }
+        )
+    return elements
+
+
+def make_boxes(n_boxes: int, seed=0, max_size=0.01):
+    """
+    The make_boxes function creates random boxes in the unit square, like index polygons or OSM ways.
+
+    Args:
+        n_boxes (int): number of boxes.
+        seed (int): seed of the random values.
+        max_size (float): max width and height of the boxes.
+    Returns:
+        np.ndarray: array of shapely boxes.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = rng.uniform(max_size / 10, max_size, (n_boxes, 2))
+    xs = rng.uniform(0, 1 - sizes[:, 0])
+    ys = rng.uniform(0, 1 - sizes[:, 1])
+    return shapely.box(xs, ys, xs + sizes[:, 0], ys + sizes[:, 1])
+
+
+def make_dataset(folder: str, scale: str = "small", bands=None, seed=0):
+    """
+    The make_dataset function writes the synthetic scenes and creates the AOI and OSM data of a scale.
+
+    Args:
+        folder (str): folder of the band files.
+        scale (str): key of BENCHMARK_SCALES.
+        bands (list): list of band names, the bands of WATER by default.
+        seed (int): seed of the random values.
+    Returns:
+        dict: scenes like the search results, features and osm_elements.
+    """
+    config = BENCHMARK_SCALES[scale]
+    bands = bands or QUERY_DATA["WATER"]["bands"]
+    size = config["size"]
+    os.makedirs(folder, exist_ok=True)
+    scenes = []
+    for number in range(config["scenes"]):
+        display_id = f"LC09_L2SP_{number + 1:03d}001_20220101_20220102_02_T1"
+        bounds = scene_bounds(number, size)
+        make_scene(folder, display_id, bands, size, bounds, seed=seed + number)
+        scenes.append(
+            {
+                "display_id": display_id,
+                "entity_id": f"LC9{number + 1:03d}0012022001LGN00",
+                "cloud_cover": 1.0,
+                "wrs_path": number + 1,
+                "wrs_row": 1,
+                "acquisition_date": "2022-01-01",
+                "spatial_coverage": reproject_geoms(
+                    [box(*bounds)], BENCHMARK_CRS, 4326
+                )[0],
+            }
+        )
+    # the AOI and the OSM data cover all the scenes
+    first, last = scene_bounds(0, size), scene_bounds(config["scenes"] - 1, size)
+    all_bounds = (first[0], first[1], last[2], first[3])
+    return {
+        "scenes": scenes,
+        "features": make_features(all_bounds, config["features"], seed),
+        "osm_elements": make_osm_elements(all_bounds, config["osm_elements"], seed),
+        "bbox": reproject_geoms([box(*all_bounds)], BENCHMARK_CRS, 4326)[0].bounds,
+    }
+
+
+def cli_imports():
+    """
+    The cli_imports function imports the CLI in a new interpreter, like each call of landsat2geojson.
+
+    Returns:
+        list: the modules of LAZY_MODULES imported by the CLI, they slow down its start.
+    """
+    code = (
+        "import sys\n"
+        "import landsat2geojson.main\n"
+        f"print(','.join(i for i in {LAZY_MODULES!r} if i in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    return [i for i in output.strip().split(",") if i]
+
+
+@contextlib.contextmanager
+def measure(results: dict, stage: str, trace_memory=False):
+    """
+    The measure context manager saves the time or the peak memory of a stage in results.
+
+    The peak memory is measured with tracemalloc, it includes the numpy arrays but it
+    slows down the python code of the stage, so the time of a traced run is not saved.
+    """
+    stage_result = results.setdefault(stage, {"runs": [], "peak_mb": []})
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if trace_memory:
+            stage_result["peak_mb"].append(tracemalloc.get_traced_memory()[1] / 2**20)
+            tracemalloc.stop()
+        else:
+            stage_result["runs"].append(seconds)
+
+
+def run_benchmark(
+    scale: str = "small",
+    repeat: int = 3,
+    index: str = "WATER",
+    block_size=None,
+    trace_memory=True,
+    work_dir=None,
+    intersects_features=None,
+):
+    """
+    The run_benchmark function times the stages of the pipeline with synthetic data and local servers.
+
+    The bands are served by LocalServer with the redirect JSON of EarthExplorer and the
+    OSM data by its overpass interpreter, so the benchmark runs offline. Each repetition
+    starts with empty caches, the peak memory is measured in one more run. The import of
+    the CLI is timed in a new interpreter, with the heavy modules it imports at start.
+
+    Args:
+        scale (str): key of BENCHMARK_SCALES.
+        repeat (int): number of runs of each stage.
+        index (str): key of the index.
+        block_size (int): Optional size of blocks to calculate the index.
+        trace_memory (bool): measure the peak memory of each stage.
+        work_dir (str): folder of the synthetic data, a temporary folder by default.
+        intersects_features (int): number of random boxes of each side of the
+            mark_intersects stage, the one of the scale by default.
+    Returns:
+        dict: the results, with the median seconds and the max peak memory of each stage.
+    """
+    intersects_features = (
+        intersects_features or BENCHMARK_SCALES[scale]["intersects_features"]
+    )
+    intersects_geoms = [make_boxes(intersects_features, seed) for seed in (1, 2)]
+    intersects_data = [
+        [{"type": "Feature", "properties": {}} for _ in geoms]
+        for geoms in intersects_geoms
+    ]
+    indices = get_indices(index)
+    bands = required_bands(indices)
+    with contextlib.ExitStack() as stack:
+        if work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        files_dir = os.path.join(work_dir, "files")
+        start = time.perf_counter()
+        dataset = make_dataset(files_dir, scale, bands)
+        generate_seconds = time.perf_counter() - start
+        server = stack.enter_context(
+            LocalServer(files_dir, overpass_elements=dataset["osm_elements"])
+        )
+
+        stages = {}
+        for run in range(repeat + bool(trace_memory)):
+            traced = run == repeat
+            if not traced:
+                with measure(stages, "cli_import"):
+                    heavy_imports = cli_imports()
+            run_dir = os.path.join(work_dir, f"run_{run}")
+            os.makedirs(run_dir)
+            features = [dict(i) for i in dataset["features"]]
+            with measure(stages, "mark_intersects", traced):
+                mark_intersects(*intersects_data, *intersects_geoms)
+            with measure(stages, "features_in_escene", traced):
+                geoms = fc2geoms(features)
+                scenes = features_in_escene(
+                    [dict(i) for i in dataset["scenes"]], features, geoms
+                )
+            with measure(stages, "download", traced):
+                scenes = download_scenes(
+                    None,
+                    None,
+                    scenes,
+                    bands,
+                    run_dir,
+                    download_url=server.download_url,
+                )
+            with measure(stages, "calculate_index", traced):
+                scenes = calculate_indices_feature(
+                    scenes, indices, run_dir, block_size=block_size
+                )
+            metadata = indices[index]
+            minx, miny, maxx, maxy = dataset["bbox"]
+            with measure(stages, "overpass", traced):
+                osm_data = get_overpass_data(
+                    (miny, minx, maxy, maxx),
+                    metadata.get("query"),
+                    run_dir,
+                    endpoint=server.overpass_url,
+                )
+            with measure(stages, "merge_output", traced):
+                index_data = [
+                    feature
+                    for scene in scenes
+                    for feature in scene.get("raw_data")
+                    .get("index")
+                    .get(index)
+                    .get("index_result_vector_4326", [])
+                ]
+                osm_features = osm_data.get("features", [])
+                intersects_index, _ = mark_intersects(
+                    index_data,
+                    osm_features,
+                    fc2geoms(index_data),
+                    fc2geoms(osm_features),
+                )
+                write_features(
+                    os.path.join(run_dir, "output.geojson"),
+                    (
+                        feature
+                        for feature, intersects in zip(index_data, intersects_index)
+                        if not intersects
+                    ),
+                )
+
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "scale": scale,
+        "repeat": repeat,
+        "config": {
+            **BENCHMARK_SCALES[scale],
+            "intersects_features": intersects_features,
+            "index": index,
+            "block_size": block_size,
+        },
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "rasterio": rio.__version__,
+        },
+        "generate_seconds": round(generate_seconds, 3),
+        "cli_heavy_imports": heavy_imports,
+        "max_rss_mb": (
+            round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+            if resource
+            else None
+        ),
+        "stages": {
+            stage: {
+                "seconds": round(statistics.median(result["runs"]), 4),
+                "runs": [round(i, 4) for i in result["runs"]],
+                "peak_mb": (
+                    round(max(result["peak_mb"]), 1) if result["peak_mb"] else None
+                ),
+            }
+            for stage, result in stages.items()
+        },
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold=REGRESSION_THRESHOLD):
+    """
+    The compare_results function compares the stages of two benchmark results.
+
+    Args:
+        baseline (dict): results of run_benchmark of the reference version.
+        current (dict): results of run_benchmark of the new version.
+        threshold (float): relative increase of time or memory that is a regression, the
+            time also has to grow more than REGRESSION_MIN_SECONDS. A module of LAZY_MODULES
+            imported at the start of the CLI is also a regression.
+    Returns:
+        list: list of dicts with the stage, the ratios and if it is a regression.
+    """
+    if baseline.get("config") != current.get("config"):
+        logger.warning(
+            f"the benchmarks have different configs: {baseline.get('config')} {current.get('config')}"
+        )
+    comparison = []
+    for stage, result in current.get("stages", {}).items():
+        reference = baseline.get("stages", {}).get(stage)
+        if not reference:
+            continue
+        time_ratio = result["seconds"] / reference["seconds"]
+        memory_ratio = (
+            result["peak_mb"] / reference["peak_mb"]
+            if result.get("peak_mb") and reference.get("peak_mb")
+            else None
+        )
+        comparison.append(
+            {
+                "stage": stage,
+                "seconds": result["seconds"],
+                "baseline_seconds": reference["seconds"],
+                "time_ratio": round(time_ratio, 3),
+                "memory_ratio": round(memory_ratio, 3) if memory_ratio else None,
+                "regression": (
+                    time_ratio > 1 + threshold
+                    and result["seconds"] - reference["seconds"]
+                    > REGRESSION_MIN_SECONDS
+                )
+                or (memory_ratio or 0) > 1 + threshold,
+            }
+        )
+    new_imports = sorted(
+        set(current.get("cli_heavy_imports") or [])
+        - set(baseline.get("cli_heavy_imports") or [])
+    )
+    if new_imports:
+        logger.warning(f"the CLI imports {', '.join(new_imports)} at start")
+        comparison.append(
+            {
+                "stage": "cli_heavy_imports",
+                "seconds": None,
+                "baseline_seconds": None,
+                "time_ratio": None,
+                "memory_ratio": None,
+                "modules": new_imports,
+                "regression": True,
+            }
+        )
+    return comparison
+
+
+@click.command(short_help="Benchmark of the stages with synthetic data, offline")
+@click.option(
+    "--scale",
+    help="Size of the synthetic scenes, AOI and OSM data",
+    type=click.Choice(list(BENCHMARK_SCALES.keys())),
+    default="small",
+    show_default=True,
+)
+@click.option(
+    "--repeat",
+    help="Number of runs of each stage, the median is saved",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+)
+@click.option(
+    "--landsat_index",
+    help="Landsar normalized index",
+    type=click.Choice(list(QUERY_DATA.keys())),
+    default="WATER",
+    show_default=True,
+)
+@click.option(
+    "--block_size",
+    help="Size in pixels of the blocks to calculate the index",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--intersects_features",
+    help="Number of random boxes of each side of the mark_intersects stage, by default the one of the scale",
+    type=click.IntRange(min=1),
+    default=None,
+)
+@click.option(
+    "--no_memory",
+    help="Do not measure the peak memory, it needs one more run",
+    is_flag=True,
+    default=False,
+)
+@click.option("--output", help="Pathfile of the JSON results", type=str, required=False)
+@click.option(
+    "--baseline",
+    help="Pathfile of the JSON results of other run to compare",
+    type=str,
+    required=False,
+)
+@click.option(
+    "--threshold",
+    help="Relative increase of time or memory over the baseline that fails",
+    type=float,
+    default=REGRESSION_THRESHOLD,
+    show_default=True,
+)
+def main(
+    scale,
+    repeat,
+    landsat_index,
+    block_size,
+    intersects_features,
+    no_memory,
+    output,
+    baseline,
+    threshold,
+):
+    results = run_benchmark(
+        scale,
+        repeat,
+        landsat_index,
+        block_size=block_size,
+        trace_memory=not no_memory,
+        intersects_features=intersects_features,
+    )
+    if output:
+        with open(output, "w", encoding="utf-8") as dst:
+            json.dump(results, dst, indent=2)
+    for stage, result in results["stages"].items():
+        click.echo(f"{stage:20} {result['seconds']:10.3f}s {result['peak_mb']} MB")
+    if baseline:
+        with open(baseline, encoding="utf-8") as src:
+            comparison = compare_results(json.load(src), results, threshold)
+        for i in comparison:
+            click.echo(
+                f"{i['stage']:20} time x{i['time_ratio']} memory x{i['memory_ratio']}"
+                f"{'  REGRESSION' if i['regression'] else ''}"
+            )
+        regressions = [i["stage"] for i in comparison if i["regression"]]
+        if regressions:
+            raise click.ClickException(f"regressions in {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
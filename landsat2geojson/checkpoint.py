@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from .profiling import span
+
+logger = logging.getLogger("__name__")
+
+MANIFEST_NAME = "checkpoints.json"
+
+
+def fingerprint(*inputs):
+    """
+    The fingerprint function gets the key of the inputs of a stage.
+
+    Args:
+        inputs: JSON serializable values, like paths, options and fingerprints of other stages.
+    Returns:
+        str: sha256 hex digest.
+    """
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def write_json(path, data):
+    """Write data as JSON with an atomic rename, with the encoder of the geometries and dates."""
+    # search_cache imports shapely, it is not needed by the CLI until a stage runs
+    from .search_cache import json_encode
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as dst:
+        # dumps encodes in C, dump writes many small chunks
+        dst.write(json.dumps(data, default=json_encode, separators=(",", ":")))
+    os.replace(tmp_path, path)
+
+
+class RunCheckpoint:
+    """Checkpoints of the stages of a run, saved in a run folder.
+
+    Each stage is saved with the fingerprint of its inputs in a JSON file, and the manifest
+    keeps the completed stages. With resume, a stage whose fingerprint did not change is
+    loaded instead of running it again, without resume the previous checkpoints are
+    discarded.
+    """
+
+    def __init__(self, run_dir, resume=False):
+        self.run_dir = run_dir
+        self.stages_dir = os.path.join(run_dir, "stages")
+        self.manifest_path = os.path.join(run_dir, MANIFEST_NAME)
+        os.makedirs(self.stages_dir, exist_ok=True)
+        self.manifest = {}
+        if resume:
+            try:
+                with open(self.manifest_path, encoding="utf-8") as src:
+                    self.manifest = json.load(src)
+            except (OSError, ValueError):
+                logger.warning(f"no checkpoints to resume in {run_dir}")
+        self.stats = {"resumed": 0, "saved": 0}
+        self._save_manifest()
+
+    def _stage_path(self, stage):
+        return os.path.join(self.stages_dir, f"{stage}.json")
+
+    def _save_manifest(self):
+        write_json(self.manifest_path, self.manifest)
+
+    def done(self, stage: str, fingerprint_: str):
+        """
+        The done method checks if a stage was completed with the same inputs.
+
+        Args:
+            stage (str): name of the stage.
+            fingerprint_ (str): fingerprint of the inputs.
+        Returns:
+            bool: True if the stage can be skipped.
+        """
+        entry = self.manifest.get(stage)
+        return bool(entry) and entry.get("fingerprint") == fingerprint_
+
+    def load(self, stage: str, fingerprint_: str):
+        """
+        The load method gets the output of a completed stage.
+
+        Args:
+            stage (str): name of the stage.
+            fingerprint_ (str): fingerprint of the inputs.
+        Returns:
+            object: output of the stage, None if it was not completed with the same inputs.
+        """
+        if not self.done(stage, fingerprint_):
+            return None
+        from .search_cache import json_decode
+
+        try:
+            with open(self._stage_path(stage), encoding="utf-8") as src:
+                data = json.load(src, object_hook=json_decode)
+        except (OSError, ValueError):
+            # missing or cut file, the stage runs again
+            logger.warning(f"checkpoint of {stage} is not readable")
+            return None
+        self.stats["resumed"] += 1
+        logger.info(f"stage {stage} resumed from {self.run_dir}")
+        return data
+
+    def save(self, stage: str, fingerprint_: str, data=None):
+        """
+        The save method saves the output of a stage and marks it as completed.
+
+        Args:
+            stage (str): name of the stage.
+            fingerprint_ (str): fingerprint of the inputs.
+            data (object): output of the stage, JSON serializable or geometries and dates.
+        """
+        with span("checkpoint", stage=stage):
+            write_json(self._stage_path(stage), data)
+        self.manifest[stage] = {
+            "fingerprint": fingerprint_,
+            "completed_at": time.time(),
+        }
+        self._save_manifest()
+        self.stats["saved"] += 1
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 DAYS_AGO = 120
 LIMIT_QUERY = 200
 FEATURE_CLEAN_FIELDS = [
@@ -14,17 +17,95 @@ FEATURE_CLEAN_FIELDS = [
     "spatial_coverage",
 ]
 WATER_BANDS = ["B3", "B6"]
+# surface reflectance bands of the Landsat Collection 2 Level-2 scenes
+LANDSAT_BANDS = ["B1", "B2", "B3", "B4", "B5", "B6", "B7"]
 TIMEOUT = 60
+BAND_CACHE_MAX_BYTES = 20 * 1024**3
+DOWNLOAD_WORKERS = 8
+MAX_CONNECTIONS_PER_HOST = 4
+ASYNC_MAX_CONCURRENCY = 32
+THROTTLE_STATUS = (429, 503)
+DOWNLOAD_ENGINES = ["threads", "async"]
+SEARCH_CACHE_TTL_DAYS = 30
+SEARCH_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "landsat2geojson", "search.sqlite"
+)
+CREDENTIAL_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "landsat2geojson", "session.json"
+)
+# the API tokens of EarthExplorer are valid for two hours
+SESSION_TTL_HOURS = 2
+# days that are searched again, scenes are still being published for them
+SEARCH_CACHE_SETTLE_DAYS = 16
+OVERPASS_ENDPOINT = "https://overpass-api.de/api/interpreter"
+OVERPASS_TIMEOUT = 180
+# size in degrees of the tiles of the overpass queries
+OVERPASS_TILE_DEG = 0.5
+# the public instances allow few concurrent queries by ip
+OVERPASS_WORKERS = 2
+OVERPASS_CACHE_TTL_DAYS = 7
+OUTPUT_FORMATS = ["GeoJSON", "GeoJSONSeq", "FlatGeobuf", "GeoParquet"]
+SCENE_PLANNERS = ["path_row", "cover"]
+# estimated size of a surface reflectance band of a scene, for the cost of the planner
+SCENE_BAND_BYTES = 75 * 1024**2
+# with 2.0 a scene with 50% of clouds costs as two clear scenes
+CLOUD_COST_WEIGHT = 2.0
+# a scene that adds less AOI than a pixel is not selected
+PLANNER_MIN_AREA_M2 = 900
 QUERY_DATA = {
     "WATER": {
         "bands": ["B3", "B6"],
         "query": 'node["natural"="water"]{bbox};way["natural"="water"]{bbox};',
         "message": "",
-        "extra": 'raw_data.get("B3").get("data_read").get("meta")',
-        "formula": """np.where(
-            ((bands.get('B3') + bands.get('B6')) == 0.0),
-             0,
-            ((bands.get('B3') - bands.get('B6')) / (bands.get('B3') + bands.get('B6'))))""",
+        # band with the profile of the output
+        "reference_band": "B3",
+        "formula": "(B3 - B6) / (B3 + B6)",
+        # negative values are set to 0
+        "min_value": 0,
         "index_name": "MNDWI",
-    }
+    },
+    "VEGETATION": {
+        "bands": ["B4", "B5"],
+        "query": 'way["landuse"="forest"]{bbox};way["natural"="wood"]{bbox};',
+        "message": "",
+        "reference_band": "B5",
+        "formula": "(B5 - B4) / (B5 + B4)",
+        "min_value": 0,
+        "index_name": "NDVI",
+    },
+    "BUILT": {
+        "bands": ["B5", "B6"],
+        "query": 'way["landuse"="residential"]{bbox};way["landuse"="industrial"]{bbox};',
+        "message": "",
+        "reference_band": "B6",
+        "formula": "(B6 - B5) / (B6 + B5)",
+        "min_value": 0,
+        "index_name": "NDBI",
+    },
+    "SNOW": {
+        "bands": ["B3", "B6"],
+        "query": 'way["natural"="glacier"]{bbox};relation["natural"="glacier"]{bbox};',
+        "message": "",
+        "reference_band": "B3",
+        "formula": "(B3 - B6) / (B3 + B6)",
+        "min_value": 0,
+        "index_name": "NDSI",
+    },
 }
+
+# stages of landsat2geojson that can be profiled with cProfile
+PROFILE_STAGES = [
+    "read_input",
+    "search",
+    "download",
+    "calculate_index",
+    "overpass",
+    "output",
+]
+# a task without heartbeats for this time is leased to other worker
+QUEUE_LEASE_SECONDS = 600
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_POLL_SECONDS = 5
+QUEUE_WORKERS = 1
+# the band arrays are memory mapped from shared memory in linux, from the temp folder otherwise
+BAND_STORE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
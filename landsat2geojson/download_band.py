@@ -1,20 +1,41 @@
-import io
 import logging
 import os
+import tempfile
+import threading
+from urllib.parse import urlparse
 
 import geopandas as gpd
 import rasterio as rio
 import requests
 from joblib import Parallel, delayed
-from landsatxplore.api import API
 from landsatxplore.earthexplorer import EarthExplorer
 from landsatxplore.errors import EarthExplorerError
 from rasterio import mask
+from rasterio.errors import RasterioIOError
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from tqdm import tqdm
 
-from .feature_utils import clean_path, create_folder, get_crs_dataset, url2name
+from .async_download import download_bands_async
+from .band_cache import BandCache, band_key
+from .band_store import store_array
+from .constants import (
+    ASYNC_MAX_CONCURRENCY,
+    BAND_CACHE_MAX_BYTES,
+    CREDENTIAL_CACHE_PATH,
+    DOWNLOAD_WORKERS,
+    MAX_CONNECTIONS_PER_HOST,
+    TIMEOUT,
+)
+from .feature_utils import (
+    clean_path,
+    content_range_size,
+    create_folder,
+    get_crs_dataset,
+    url2name,
+)
+from .profiling import count, span
+from .session import get_session
 
 logger = logging.getLogger("__name__")
 
@@ -23,8 +44,31 @@ EE_DOWNLOAD_URL = (
 )
 
 
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_ATTEMPTS = 3
+
+# GDAL options to read only the needed tiles of a remote COG with range requests
+VSICURL_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MAX_RETRY": "3",
+    "GDAL_HTTP_RETRY_DELAY": "2",
+    # signed urls are only valid for GET
+    "CPL_VSIL_CURL_USE_HEAD": "NO",
+    "VSI_CACHE": "TRUE",
+}
+
+
 class WrapperEarthExplorer(EarthExplorer):
-    def __init__(self, username, password):
+    def __init__(
+        self,
+        username=None,
+        password=None,
+        download_url=EE_DOWNLOAD_URL,
+        pool_size=DOWNLOAD_WORKERS,
+        max_per_host=MAX_CONNECTIONS_PER_HOST,
+        credential_cache=CREDENTIAL_CACHE_PATH,
+    ):
         # retry setup
         session_ = requests.Session()
 
@@ -32,18 +76,50 @@ class WrapperEarthExplorer(EarthExplorer):
             total=5,
             backoff_factor=2,
             status_forcelist=[429, 500, 502, 503, 504],
-            method_whitelist=["HEAD", "GET", "OPTIONS"],
+            allowed_methods=["HEAD", "GET", "OPTIONS"],
+        )
+        # one connection for each thread that shares the session
+        adapter = HTTPAdapter(
+            max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size
         )
-        adapter = HTTPAdapter(max_retries=retries)
         session_.mount("https://", adapter)
         session_.mount("http://", adapter)
 
         self.session = session_
-        self.login(username, password)
-        self.api = API(username, password)
+        self.download_url = download_url
+        self.max_per_host = max_per_host
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+        # without credentials the session is anonymous, e.g. for a local server
+        self.sessions = None
+        if username:
+            # the login is shared with the searches and the other processes of the run
+            self.sessions = get_session(username, password, credential_cache)
+            self.cookies = self.sessions.web_cookies(self.session)
 
-    def _read_from_path(self, file_path, features_contains):
-        dataset = rio.open(file_path)
+    @property
+    def api(self):
+        """API of the session manager, it logs in the API only when it is used."""
+        return self.sessions.api() if self.sessions else None
+
+    def _rejected(self, response):
+        """Check if the server rejected the cookies of the web session."""
+        if self.sessions is None:
+            return False
+        location = response.headers.get("Location", "")
+        return response.status_code in (401, 403) or (
+            response.is_redirect and "login" in location
+        )
+
+    def _host_slot(self, url):
+        """Semaphore that limits the concurrent requests to the host of the url."""
+        host = urlparse(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _read_dataset(self, dataset, features_contains):
         if "4326" not in str(dataset.crs) and str(dataset.crs):
             features_contains = features_contains.to_crs(get_crs_dataset(dataset.crs))
 
@@ -67,85 +143,184 @@ class WrapperEarthExplorer(EarthExplorer):
             "out_image": out_image.squeeze(),
         }
 
-    def _save_file_path(self, byio, output_dir, filename_):
-        if output_dir:
-            with open(f"{output_dir}/{filename_}.TIF", "wb") as src:
-                src.write(byio.getvalue())
+    def _read_from_path(self, file_path, features_contains):
+        with rio.open(file_path) as dataset:
+            return self._read_dataset(dataset, features_contains)
 
-    def _download(
-        self, url, features_contains, output_dir, timeout, chunk_size=1024, skip=False
-    ):
-        """Download remote file given its URL."""
+    def _read_from_url(self, download_url, features_contains):
+        """Read only the window of features_contains from a remote COG."""
+        with self._host_slot(download_url), rio.Env(**VSICURL_OPTIONS):
+            with rio.open(f"/vsicurl/{download_url}") as dataset:
+                return self._read_dataset(dataset, features_contains)
+
+    def _resolve_url(self, url, timeout):
+        """Get the url of the file from the EarthExplorer download url."""
         # Check availability of the requested product
         # EarthExplorer should respond with JSON
+        for attempt in range(2):
+            with self._host_slot(url), self.session.get(
+                url, allow_redirects=False, stream=True, timeout=timeout
+            ) as r:
+                if attempt == 0 and self._rejected(r):
+                    # the web session expired, the cookies are refreshed once
+                    self.cookies = self.sessions.web_cookies(
+                        self.session, rejected=self.cookies
+                    )
+                    continue
+                r.raise_for_status()
+                error_msg = r.json().get("errorMessage")
+                if error_msg:
+                    raise EarthExplorerError(error_msg)
+                return r.json().get("url")
 
-        if os.path.exists(f"{output_dir}/{url2name(url)}.TIF"):
-            return self._read_from_path(
-                f"{output_dir}/{url2name(url)}.TIF", features_contains
-            )
+    def _accept_ranges(self, download_url, timeout):
+        """Check if the server answers a range request with partial content."""
+        try:
+            with self._host_slot(download_url), self.session.get(
+                download_url,
+                headers={"Range": "bytes=0-0"},
+                stream=True,
+                allow_redirects=True,
+                timeout=timeout,
+            ) as r:
+                return r.status_code == 206
+        except requests.exceptions.RequestException as ex:
+            logger.warning(ex.__str__())
+            return False
 
-        with self.session.get(
-            url, allow_redirects=False, stream=True, timeout=timeout
-        ) as r:
-            r.raise_for_status()
-            error_msg = r.json().get("errorMessage")
-            if error_msg:
-                raise EarthExplorerError(error_msg)
-            download_url = r.json().get("url")
+    def _download(
+        self,
+        url,
+        features_contains,
+        output_dir,
+        timeout,
+        chunk_size=DOWNLOAD_CHUNK_SIZE,
+        skip=False,
+        partial=False,
+        cache=None,
+    ):
+        """Download remote file given its URL."""
+        key = url2name(url)
+        if cache is None:
+            download_url = self._resolve_url(url, timeout)
+            if partial:
+                data_read = self._read_partial(download_url, key, features_contains)
+                if data_read:
+                    return data_read
+            # without cache the band is only kept until it is read
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                file_path = f"{tmp_dir}/{key}.TIF"
+                self._fetch(download_url, file_path, timeout, chunk_size)
+                return self._read_from_path(file_path, features_contains)
 
-            try:
+        # the lock avoids downloading the same band twice
+        with cache.lock(key):
+            file_path = cache.get(key)
+            count("band_cache_hits" if file_path else "band_cache_misses")
+            if file_path is None:
+                download_url = self._resolve_url(url, timeout)
+                if partial:
+                    data_read = self._read_partial(download_url, key, features_contains)
+                    if data_read:
+                        return data_read
+                tmp_path = self._fetch(
+                    download_url, cache.tmp_path(key), timeout, chunk_size
+                )
+                file_path = cache.put(key, tmp_path)
+            return self._read_from_path(file_path, features_contains)
 
-                with self.session.get(
-                    download_url, stream=True, allow_redirects=True, timeout=timeout
-                ) as r:
-                    file_size = int(r.headers.get("Content-Length"))
-                    with tqdm(
-                        desc=f"download  {url2name(url)} file",
-                        total=file_size,
-                        unit_scale=True,
-                        unit="B",
-                        unit_divisor=1024,
-                    ) as pbar:
-
-                        byio = io.BytesIO()
-                        for chunk in r.iter_content(chunk_size=chunk_size):
-                            if chunk:
-                                byio.write(chunk)
-                                pbar.update(chunk_size)
-                        self._save_file_path(byio, output_dir, f"{url2name(url)}")
-                        # check save file or memory
-                        with rio.io.MemoryFile(byio.getvalue()) as memfile:
-                            dataset = memfile.open()
-                            if "4326" not in str(dataset.crs) and str(dataset.crs):
-                                features_contains = features_contains.to_crs(
-                                    get_crs_dataset(dataset.crs)
-                                )
-
-                            out_image, out_transform = mask.mask(
-                                dataset, list(features_contains), crop=True
-                            )
-                            out_meta = dataset.meta
-                            out_meta.update(
-                                {
-                                    "nodata": 0,
-                                    "height": out_image.shape[1],
-                                    "width": out_image.shape[2],
-                                    "transform": out_transform,
-                                    "count": 1,
-                                    "dtype": "float64",
-                                }
-                            )
-
-                            return {
-                                "profile": dataset.profile,
-                                "meta": out_meta,
-                                "out_image": out_image.squeeze(),
-                            }
+    def _read_partial(self, download_url, name, features_contains):
+        """Read the window of the features with range requests, None if the server does not support them."""
+        if not self._accept_ranges(download_url, timeout=TIMEOUT):
+            logger.warning(
+                f"{name} does not support range requests, downloading the whole file"
+            )
+            return None
+        try:
+            data_read = self._read_from_url(download_url, features_contains)
+            count("partial_reads")
+            return data_read
+        except RasterioIOError as ex:
+            logger.warning(
+                f"partial read of {name} failed, downloading the whole file: {ex}"
+            )
+        return None
 
+    def _fetch(self, download_url, file_path, timeout, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Stream the file to file_path.part, resume it with range requests and rename it when it is complete."""
+        part_path = f"{file_path}.part"
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                file_size = self._fetch_part(
+                    download_url, part_path, timeout, chunk_size
+                )
             except requests.exceptions.Timeout:
                 raise EarthExplorerError(
                     "Connection timeout after {} seconds.".format(timeout)
                 )
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+            ) as ex:
+                logger.warning(
+                    f"download of {url2name(file_path)} interrupted ({attempt}/{DOWNLOAD_ATTEMPTS}): {ex}"
+                )
+                continue
+            if os.path.exists(part_path) and (
+                file_size is None or os.path.getsize(part_path) == file_size
+            ):
+                os.replace(part_path, file_path)
+                return file_path
+            logger.warning(
+                f"download of {url2name(file_path)} incomplete ({attempt}/{DOWNLOAD_ATTEMPTS})"
+            )
+        raise EarthExplorerError(
+            f"Download of {url2name(file_path)} failed after {DOWNLOAD_ATTEMPTS} attempts."
+        )
+
+    def _fetch_part(self, download_url, part_path, timeout, chunk_size):
+        """Append the missing bytes to part_path, return the size of the whole file if it is known."""
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self._host_slot(download_url), self.session.get(
+            download_url,
+            stream=True,
+            allow_redirects=True,
+            headers=headers,
+            timeout=timeout,
+        ) as r:
+            if r.status_code == 416:
+                # the part file has all the bytes, or it is not from this file
+                file_size = content_range_size(r.headers.get("Content-Range"))
+                if file_size != offset:
+                    os.remove(part_path)
+                return file_size
+            r.raise_for_status()
+            if r.status_code == 206:
+                file_size = content_range_size(r.headers.get("Content-Range"))
+                file_mode = "ab"
+            else:
+                # the server sends the whole file
+                content_length = r.headers.get("Content-Length")
+                file_size = int(content_length) if content_length else None
+                file_mode = "wb"
+                offset = 0
+
+            with tqdm(
+                desc=f"download  {os.path.basename(part_path)[:-9]} file",
+                total=file_size,
+                initial=offset,
+                unit_scale=True,
+                unit="B",
+                unit_divisor=1024,
+            ) as pbar:
+                with open(part_path, file_mode) as dst:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            dst.write(chunk)
+                            pbar.update(len(chunk))
+                            count("bytes_downloaded", len(chunk))
+        return file_size
 
     def download(
         self,
@@ -156,30 +331,101 @@ class WrapperEarthExplorer(EarthExplorer):
         dataset=None,
         timeout=600,
         skip=False,
+        partial=False,
+        cache=None,
     ):
         create_folder(output_dir)
 
-        urls = [
-            EE_DOWNLOAD_URL.format(
-                data_product_id="5f85f0419985f2aa",
-                display_id=f"L2SR_{display_id}_SR_{i}_TIF",
-            )
-            for i in bands
-        ]
         data_out = {}
-        for url, band in zip(urls, bands):
-            data_read = self._download(
-                url, features_contains, output_dir, timeout=timeout, skip=skip
+        for band in bands:
+            data_out[band] = self.download_band(
+                display_id,
+                band,
+                features_contains,
+                output_dir,
+                timeout=timeout,
+                skip=skip,
+                partial=partial,
+                cache=cache,
             )
-            data_out[band] = {
-                "name": url.split("/")[-1],
-                "data_read": data_read,
-            }
         return data_out
 
+    def band_url(self, display_id, band):
+        """EarthExplorer download url of a band of a scene."""
+        return self.download_url.format(
+            data_product_id="5f85f0419985f2aa",
+            display_id=band_key(display_id, band),
+        )
+
+    def cache_band(self, display_id, band, cache, timeout=600):
+        """
+        The cache_band method downloads the whole band to the cache if it is not there.
+
+        Args:
+            display_id (str): display id of the scene.
+            band (str): band name, like B3.
+            cache (BandCache): band cache.
+            timeout (int): seconds to wait for the connection and each read.
+        Returns:
+            str: path of the cached file.
+        """
+        url = self.band_url(display_id, band)
+        with cache.lock(url2name(url)):
+            return self._cache_band(url, cache, timeout)
+
+    def _cache_band(self, url, cache, timeout=600):
+        """Download the band of the url to the cache, the caller holds the lock of its key."""
+        key = url2name(url)
+        file_path = cache.get(key)
+        count("band_cache_hits" if file_path else "band_cache_misses")
+        if file_path is None:
+            download_url = self._resolve_url(url, timeout)
+            tmp_path = self._fetch(download_url, cache.tmp_path(key), timeout)
+            file_path = cache.put(key, tmp_path)
+        return file_path
+
+    def download_band(
+        self,
+        display_id,
+        band,
+        features_contains,
+        output_dir="",
+        timeout=600,
+        skip=False,
+        partial=False,
+        cache=None,
+    ):
+        url = self.band_url(display_id, band)
+        data_read = self._download(
+            url,
+            features_contains,
+            output_dir,
+            timeout=timeout,
+            skip=skip,
+            partial=partial,
+            cache=cache,
+        )
+        return {
+            "name": url.split("/")[-1],
+            "data_read": data_read,
+        }
+
 
 def download_scenes(
-    username: str, password: str, scenes: list, bands: list, output_dir: str
+    username: str,
+    password: str,
+    scenes: list,
+    bands: list,
+    output_dir: str,
+    partial: bool = False,
+    download_url: str = EE_DOWNLOAD_URL,
+    cache_dir: str = None,
+    cache_max_bytes: int = BAND_CACHE_MAX_BYTES,
+    n_jobs: int = DOWNLOAD_WORKERS,
+    max_per_host: int = MAX_CONNECTIONS_PER_HOST,
+    engine: str = "threads",
+    credential_cache: str = CREDENTIAL_CACHE_PATH,
+    band_store=None,
 ):
     """
     The download_scenes function downloads the bands for each scene.
@@ -190,28 +436,98 @@ def download_scenes(
         scenes (list): A list of scenes with features.
         bands (list): A list of bands.
         output_dir (str): path of directory.
+        partial (bool): read only the window of the features with range requests when the server supports them.
+        download_url (str): template of the EarthExplorer download url.
+        cache_dir (str): path of the band cache, {output_dir}/band_cache by default.
+        cache_max_bytes (int): size budget of the band cache.
+        n_jobs (int): number of download threads, each (scene, band) pair is a task.
+        max_per_host (int): limit of concurrent requests to the same host.
+        engine (str): "threads" or "async", the async engine adapts its concurrency to the
+            throttling of the server, from n_jobs up to ASYNC_MAX_CONCURRENCY requests, and
+            it falls back to threads with partial.
+        credential_cache (str): path of the credential cache of the session, None to disable it.
+        band_store (BandStore): Optional band store, the scenes keep the handles of the band
+            arrays instead of the arrays.
 
     Returns:
          list : A list of scenes with download bands.
     """
 
     output_dir = clean_path(output_dir)
-    ee = WrapperEarthExplorer(username, password)
-
-    def download_scene_(ee_, scene_, bands_, output_dir_):
-        display_id = scene_.get("display_id")
-        features_contains = gpd.GeoSeries(
-            [i["geom"] for i in scene_.get("features_contains", [])]
-        ).set_crs(4326)
-        if not ee_.logged_in():
-            ee_ = WrapperEarthExplorer(username, password)
-        scene_["raw_data"] = ee_.download(
-            display_id, features_contains, bands_, output_dir_
+    create_folder(output_dir)
+    # one login and one connection pool shared by all the threads
+    ee = WrapperEarthExplorer(
+        username,
+        password,
+        download_url,
+        pool_size=n_jobs,
+        max_per_host=max_per_host,
+        credential_cache=credential_cache,
+    )
+    cache = None
+    if cache_dir or output_dir:
+        cache = BandCache(cache_dir or f"{output_dir}/band_cache", cache_max_bytes)
+
+    features_scenes = [
+        gpd.GeoSeries([i["geom"] for i in scene.get("features_contains", [])]).set_crs(
+            4326
         )
-        return scene_
+        for scene in scenes
+    ]
 
-    scenes_download = Parallel(n_jobs=-1)(
-        delayed(download_scene_)(ee, scene, bands, output_dir)
-        for scene in tqdm(scenes, desc="Prepare download data")
-    )
-    return scenes_download
+    def download_band_(scene_, band_, features_contains_):
+        with span("download_band", display_id=scene_.get("display_id"), band=band_):
+            band_download = ee.download_band(
+                scene_.get("display_id"),
+                band_,
+                features_contains_,
+                output_dir,
+                partial=partial,
+                cache=cache,
+            )
+        # the array is written once, the thread releases it
+        store_array(
+            band_store,
+            band_download["data_read"],
+            "out_image",
+            f"{scene_.get('display_id')}_{band_}",
+        )
+        return band_download
+
+    tasks = [
+        (scene, band, features_contains)
+        for scene, features_contains in zip(scenes, features_scenes)
+        for band in bands
+    ]
+    if engine == "async" and partial:
+        # the async engine downloads whole bands, the range requests need the threads
+        logger.warning("partial reads are not supported by the async engine, using threads")
+        engine = "threads"
+    if engine == "async":
+        bands_download, _ = download_bands_async(
+            ee,
+            [
+                (scene.get("display_id"), band, features_contains)
+                for scene, band, features_contains in tasks
+            ],
+            cache=cache,
+            initial_concurrency=n_jobs,
+            max_concurrency=max(n_jobs, ASYNC_MAX_CONCURRENCY),
+        )
+    else:
+        # download is I/O bound, every (scene, band) pair runs in a thread
+        bands_download = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(download_band_)(scene, band, features_contains)
+            for scene, band, features_contains in tqdm(
+                tasks, desc="Prepare download data"
+            )
+        )
+    for (scene, band, _), band_download in zip(tasks, bands_download):
+        store_array(
+            band_store,
+            band_download["data_read"],
+            "out_image",
+            f"{scene.get('display_id')}_{band}",
+        )
+        scene.setdefault("raw_data", {})[band] = band_download
+    return scenes
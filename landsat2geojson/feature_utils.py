@@ -1,58 +1,179 @@
+import functools
+import itertools
 import logging
 import os
-from copy import deepcopy
 
-from joblib import Parallel, delayed
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely import STRtree
 from shapely.geometry import box, mapping, shape
-from shapely.ops import unary_union
 from tqdm import tqdm
 
 from .constants import FEATURE_CLEAN_FIELDS
 
 logger = logging.getLogger("__name__")
 
+POLYGON_TYPE_IDS = [
+    shapely.GeometryType.POLYGON,
+    shapely.GeometryType.MULTIPOLYGON,
+]
+# nesting levels of the coordinates of each GeoJSON type
+GEOJSON_DEPTH = {
+    "Point": 0,
+    "LineString": 1,
+    "MultiPoint": 1,
+    "Polygon": 2,
+    "MultiLineString": 2,
+    "MultiPolygon": 3,
+}
+GEOJSON_TYPES = {shapely.GeometryType[i.upper()]: i for i in GEOJSON_DEPTH}
+
+
+def _ragged_geoms(geometries: list, geometry_type: str):
+    """
+    The _ragged_geoms function creates the shapely objects of geometries with the same type in one call.
+
+    The nested coordinates are flattened into one coordinate array and the offsets of each
+    nesting level, the layout expected by shapely.from_ragged_array.
 
-def fc2geom(features_: list):
+    Args:
+        geometries (list): list of GeoJSON geometry dicts of the same type.
+        geometry_type (str): GeoJSON type of the geometries.
+    Returns:
+        np.ndarray: An array of shapely geometries.
     """
-    The fc2geom function add a shapely object for each feature.
+    level = [geometry["coordinates"] for geometry in geometries]
+    offsets = []
+    for _ in range(GEOJSON_DEPTH[geometry_type]):
+        lengths = np.fromiter(map(len, level), dtype=np.int64, count=len(level))
+        offsets.append(np.concatenate([[0], np.cumsum(lengths)]))
+        level = list(itertools.chain.from_iterable(level))
+    coords = np.array(level, dtype="float64")
+    return shapely.from_ragged_array(
+        shapely.GeometryType[geometry_type.upper()], coords, offsets[::-1] or None
+    )
+
+
+def fc2geoms(features_: list):
+    """
+    The fc2geoms function converts the geometries of the features to an array of shapely objects.
+
+    The geometries of each type are created in one vectorized call, other types like
+    GeometryCollection are created one by one and features without geometry get None.
 
     Args:
         features_ (list): A list of dictionaries representing the features in the feature collection.
 
     Returns:
-        list: A list of dictionaries with geometry converted from shapely.
+        np.ndarray: An array of shapely geometries in the order of the features.
     """
+    geoms = np.full(len(features_), None, dtype=object)
+    types = {}
+    for n, feature in enumerate(features_):
+        geometry = feature.get("geometry")
+        if geometry:
+            types.setdefault(geometry.get("type"), []).append(n)
+
+    for geometry_type, index in types.items():
+        geometries = [features_[n]["geometry"] for n in index]
+        try:
+            geoms[index] = _ragged_geoms(geometries, geometry_type)
+        except (KeyError, ValueError, TypeError):
+            # unsupported type, mixed dimensions or empty coordinates
+            geoms[index] = [shape(geometry) for geometry in geometries]
+    return geoms
+
+
+def geoms2geometries(geoms):
+    """
+    The geoms2geometries function converts an array of shapely objects to GeoJSON geometry dicts.
 
-    def feature2geom(feature_: dict):
-        feature_["geom"] = shape(feature_["geometry"])
-        return feature_
+    When all the geometries have the same type, the coordinates are converted from
+    the ragged array of shapely in one call and split by the offsets of each nesting
+    level, otherwise the geometries are converted one by one.
 
-    new_features = Parallel(n_jobs=-1)(
-        delayed(feature2geom)(feature)
-        for feature in tqdm(features_, desc="create shape")
-    )
-    return new_features
+    Args:
+        geoms (np.ndarray): An array of shapely geometries.
+    Returns:
+        list: list of GeoJSON geometry dicts.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    type_ids = shapely.get_type_id(geoms)
+    if (
+        not len(geoms)
+        or (type_ids != type_ids[0]).any()
+        or type_ids[0] == shapely.GeometryType.GEOMETRYCOLLECTION
+        or shapely.is_empty(geoms).any()
+    ):
+        return [mapping(i) if i is not None else None for i in geoms]
+    geometry_type, coords, offsets = shapely.to_ragged_array(geoms)
+    level = coords.tolist()
+    for offset in offsets:
+        bounds = offset.tolist()
+        level = [level[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    geojson_type = GEOJSON_TYPES[geometry_type]
+    return [{"type": geojson_type, "coordinates": i} for i in level]
+
+
+@functools.lru_cache(maxsize=None)
+def _transformer(crs_from, crs_to):
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
+def reproject_geoms(geoms, crs_from, crs_to=4326, precision=None):
+    """
+    The reproject_geoms function reprojects an array of shapely objects with the coordinate arrays.
 
+    Args:
+        geoms (np.ndarray): An array of shapely geometries.
+        crs_from (int): epsg code of the geometries.
+        crs_to (int): epsg code of the result.
+        precision (int): Optional number of decimals of the coordinates.
+    Returns:
+        np.ndarray: An array of shapely geometries.
+    """
+    if crs_from != crs_to:
+        transformer = _transformer(crs_from, crs_to)
+        geoms = shapely.transform(
+            geoms, lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1]))
+        )
+    if precision is not None:
+        geoms = shapely.transform(geoms, lambda xy: np.round(xy, precision))
+    return geoms
 
-def fc2box(features_: list):
+
+def fc2geom(features_: list, geoms=None):
+    """
+    The fc2geom function add a shapely object for each feature.
+
+    Args:
+        features_ (list): A list of dictionaries representing the features in the feature collection.
+        geoms (np.ndarray): Optional array of geometries already created with fc2geoms.
+
+    Returns:
+        list: A list of dictionaries with geometry converted from shapely.
+    """
+    if geoms is None:
+        geoms = fc2geoms(features_)
+    for feature, geom in zip(features_, geoms):
+        feature["geom"] = geom
+    return features_
+
+
+def fc2box(features_: list, geoms=None):
     """
     The fc2box function takes a list of features and returns a bbox.
 
     Args:
         features_ (list): Used to Pass a list of features to the function.
+        geoms (np.ndarray): Optional array of geometries, used instead of the geom field.
     Returns:
          bbox : A bbox of shapely.
     """
-
-    def feature2box(feature_: dict):
-        return box(*feature_["geom"].bounds)
-
-    features_box = Parallel(n_jobs=-1)(
-        delayed(feature2box)(feature)
-        for feature in tqdm(features_, desc="create box from shape")
-    )
-    union = unary_union([*features_box])
-    return box(*union.bounds)
+    if geoms is None:
+        geoms = [feature["geom"] for feature in features_]
+    return box(*shapely.total_bounds(geoms))
 
 
 def clean_scene(feature: dict):
@@ -146,48 +267,125 @@ def check_geom(geom: shape):
     return geom.is_valid and "Polygon" in geom.geom_type
 
 
-def features_in_escene(scenes: list, features_geom: list):
+def _polygonal(geoms):
+    """
+    The _polygonal function is the vectorized version of check_geom.
+
+    Args:
+        geoms (np.ndarray): array of geoms.
+    Returns:
+        np.ndarray: array of bool, True where the geom is a valid (multi)polygon.
+    """
+    geom_types = shapely.get_type_id(geoms)
+    return shapely.is_valid(geoms) & np.isin(geom_types, POLYGON_TYPE_IDS)
+
+
+def _split_features(scene_geom, geoms: np.ndarray):
+    """
+    The _split_features function calculates the intersection and the difference of the geoms with the scene.
+
+    The operations run vectorized; if GEOS fails on the batch, each geom is processed on its
+    own and the failing ones are logged and skipped, as the per feature loop did.
+
+    Args:
+        scene_geom (shape): The scene geom.
+        geoms (np.ndarray): array of geoms that intersect the scene.
+    Returns:
+        tuple: arrays of intersections, differences and a bool array of processed geoms.
+    """
+    try:
+        return (
+            shapely.intersection(scene_geom, geoms),
+            shapely.difference(geoms, scene_geom),
+            np.ones(len(geoms), dtype=bool),
+        )
+    except shapely.errors.GEOSException:
+        intersections = np.empty(len(geoms), dtype=object)
+        differences = np.empty(len(geoms), dtype=object)
+        processed = np.zeros(len(geoms), dtype=bool)
+        for n, geom in enumerate(geoms):
+            try:
+                intersections[n] = scene_geom.intersection(geom)
+                differences[n] = geom.difference(scene_geom)
+                processed[n] = True
+            except Exception as ex:
+                logger.error(ex.__str__())
+        return intersections, differences, processed
+
+
+def features_in_escene(scenes: list, features_geom: list, geoms=None):
     """
     The features_in_escene function groups the features in the scene that intersect or include them.
 
+    The scenes are processed in order, the first scene that contains a feature keeps it, and the
+    part of a feature outside an intersecting scene is carried forward to the next scenes.
+    The candidates of each scene are taken from an STRtree built once over the features.
+
     Args:
         scenes (list): list of scenes.
         features_geom (list): list of features with geom field.
+        geoms (np.ndarray): Optional array of geometries, used instead of the geom field.
+            The array is updated with the remainders of the features.
 
     Returns:
         list: list of scenes with features.
     """
+    has_geom_field = geoms is None
+    if has_geom_field:
+        geoms = np.array([i["geom"] for i in features_geom], dtype=object)
+    tree = STRtree(geoms)
+    pending = np.array(
+        [not i.get("is_include", False) for i in features_geom], dtype=bool
+    )
 
     for scene in tqdm(scenes, desc="Filter feature in scene"):
         scene_geom = scene["spatial_coverage"]
-        features_contains = []
-        for feature in features_geom:
-            feature_geom = feature["geom"]
-            is_include = feature.get("is_include", False)
-            if is_include:
+        # the tree holds the original geoms, the remainders are always inside them
+        candidates = tree.query(scene_geom)
+        candidates = np.sort(candidates[pending[candidates]])
+        candidates = candidates[shapely.intersects(scene_geom, geoms[candidates])]
+        is_contains = shapely.contains(scene_geom, geoms[candidates])
+
+        features_contains = {}
+        #     contains
+        for idx in candidates[is_contains]:
+            feature = features_geom[idx]
+            feature["is_include"] = True
+            feature["status"] = "contains"
+            features_contains[idx] = {**feature, "geom": geoms[idx]}
+        pending[candidates[is_contains]] = False
+
+        # intersects
+        intersects = candidates[~is_contains]
+        intersections, differences, processed = _split_features(
+            scene_geom, geoms[intersects]
+        )
+        is_intersection = np.zeros(len(intersects), dtype=bool)
+        is_difference = np.zeros(len(intersects), dtype=bool)
+        is_intersection[processed] = _polygonal(intersections[processed])
+        is_difference[processed] = _polygonal(differences[processed])
+        for n, idx in enumerate(intersects):
+            if not processed[n]:
                 continue
-            #     contains
-            if scene_geom.contains(feature_geom):
+            feature = features_geom[idx]
+            feature["status"] = "intersects"
+            if is_intersection[n]:
+                features_contains[idx] = {
+                    **feature,
+                    "geometry": mapping(intersections[n]),
+                    "geom": intersections[n],
+                }
+            if is_difference[n]:
+                feature["geometry"] = mapping(differences[n])
+                if has_geom_field:
+                    feature["geom"] = differences[n]
+                geoms[idx] = differences[n]
+            else:
                 feature["is_include"] = True
-                feature["status"] = "contains"
-                features_contains.append(deepcopy(feature))
-            # intersects
-            elif scene_geom.intersects(feature_geom):
-                try:
-                    intersection = scene_geom.intersection(feature_geom)
-                    difference = feature_geom.difference(scene_geom)
-                    feature["status"] = "intersects"
-                    if check_geom(intersection):
-                        new_feature = deepcopy(feature)
-                        new_feature["geometry"] = mapping(intersection)
-                        features_contains.append(new_feature)
-                    if check_geom(difference):
-                        feature["geometry"] = mapping(difference)
-                    else:
-                        feature["is_include"] = True
-                except Exception as ex:
-                    logger.error(ex.__str__())
-        scene["features_contains"] = features_contains
+                pending[idx] = False
+        scene["features_contains"] = [
+            features_contains[i] for i in sorted(features_contains)
+        ]
     # remove scenes with no features
     new_scenes = [i for i in scenes if i.get("features_contains")]
     return new_scenes
@@ -219,6 +417,21 @@ def url2name(url_: str = ""):
     return url_.split("/")[-1]
 
 
+def content_range_size(content_range: str):
+    """
+    The content_range_size function get the size of the whole file from a Content-Range header.
+
+    Args:
+        content_range (str): header value, like "bytes 0-99/1000" or "bytes */1000".
+    Returns:
+        int: size of the file, None if it is unknown.
+    """
+    try:
+        return int(content_range.split("/")[-1])
+    except (AttributeError, ValueError):
+        return None
+
+
 def get_crs_dataset(crs):
     """
     The get_crs_dataset function get the crs of a crs object.
@@ -269,3 +482,34 @@ def remove_geom(features: list):
         if "geom" in i.keys():
             del i["geom"]
     return features
+
+
+def mark_intersects(features_a: list, features_b: list, geoms_a=None, geoms_b=None):
+    """
+    The mark_intersects function flags the features of both lists that intersect any feature of the other list.
+
+    An STRtree is built over the geometries of features_b and queried in bulk with all the
+    geometries of features_a, so only the candidate pairs of the index are tested.
+
+    Args:
+        features_a (list): list of features with geom field.
+        features_b (list): list of features with geom field.
+        geoms_a (np.ndarray): Optional array of geometries, used instead of the geom field of features_a.
+        geoms_b (np.ndarray): Optional array of geometries, used instead of the geom field of features_b.
+    Returns:
+        tuple: two numpy arrays of bool, one for each list.
+    """
+    if geoms_a is None:
+        geoms_a = [i["geom"] for i in features_a]
+    if geoms_b is None:
+        geoms_b = [i["geom"] for i in features_b]
+    intersects_a = np.zeros(len(features_a), dtype=bool)
+    intersects_b = np.zeros(len(features_b), dtype=bool)
+    if not features_a or not features_b:
+        return intersects_a, intersects_b
+
+    tree = STRtree(geoms_b)
+    index_a, index_b = tree.query(geoms_a, predicate="intersects")
+    intersects_a[index_a] = True
+    intersects_b[index_b] = True
+    return intersects_a, intersects_b
@@ -0,0 +1,223 @@
+import ast
+import functools
+import logging
+
+import numpy as np
+
+from .constants import LANDSAT_BANDS
+
+logger = logging.getLogger("__name__")
+
+# rows evaluated at a time, the buffers of a block are reused for the whole image
+BLOCK_ROWS = 256
+INDEX_DTYPE = np.float32
+
+BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: None,  # safe division, see _divide
+    ast.Pow: np.power,
+}
+UNARY_OPERATORS = {ast.USub: np.negative, ast.UAdd: None}
+FUNCTIONS = {"abs": np.absolute, "sqrt": np.sqrt}
+
+
+def _divide(a, b, out, mask):
+    """Division that is 0 where the denominator is 0, like the index formulas expect."""
+    np.not_equal(b, 0, out=mask)
+    np.divide(a, b, out=out, where=mask, dtype=INDEX_DTYPE)
+    np.logical_not(mask, out=mask)
+    np.copyto(out, 0, where=mask)
+
+
+class IndexFormula:
+    """Formula of an index compiled to a list of numpy operations on preallocated buffers.
+
+    The formula is parsed once, only numbers, the names of allowed_bands, + - * / ** and
+    the functions of FUNCTIONS are allowed. It is evaluated by blocks of rows, the result of each block is
+    written in the output array and the intermediate values use a few buffers of a block,
+    so the peak memory is about the output array.
+    """
+
+    def __init__(self, formula: str, allowed_bands=LANDSAT_BANDS):
+        self.formula = formula
+        self.allowed_bands = list(allowed_bands)
+        self.bands = []
+        self.program = []
+        self.registers = 0
+        try:
+            tree = ast.parse(formula.strip(), mode="eval")
+        except SyntaxError as ex:
+            raise ValueError(f"Invalid formula {formula!r}: {ex.msg}")
+        free = []
+        self.result = self._compile(tree.body, free)
+        if self.result[0] == "register" and self.result[1] != 0:
+            # the result is computed in the register of the output
+            self._swap_registers(self.result[1], 0)
+            self.result = ("register", 0)
+
+    def _new_register(self, free):
+        if free:
+            return free.pop()
+        self.registers += 1
+        return self.registers - 1
+
+    def _release(self, operand, free):
+        if operand[0] == "register":
+            free.append(operand[1])
+
+    def _compile(self, node, free):
+        """Add the operations of node to the program, return the operand of its result."""
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return ("constant", float(node.value))
+        if isinstance(node, ast.Name) and node.id in self.allowed_bands:
+            if node.id not in self.bands:
+                self.bands.append(node.id)
+            return ("band", node.id)
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            left = self._compile(node.left, free)
+            right = self._compile(node.right, free)
+            if left[0] == "constant" and right[0] == "constant":
+                return ("constant", _constant(node.op, left[1], right[1]))
+            return self._add_operation(type(node.op), [left, right], free)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            operand = self._compile(node.operand, free)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if operand[0] == "constant":
+                return ("constant", -operand[1])
+            return self._add_operation(ast.USub, [operand], free)
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in FUNCTIONS
+            and len(node.args) == 1
+            and not node.keywords
+        ):
+            operand = self._compile(node.args[0], free)
+            return self._add_operation(node.func.id, [operand], free)
+        raise ValueError(
+            f"{ast.unparse(node)!r} is not allowed in formula {self.formula!r}"
+        )
+
+    def _add_operation(self, operator, operands, free):
+        for operand in operands:
+            self._release(operand, free)
+        # numpy ufuncs can write the result in the buffer of an operand
+        register = self._new_register(free)
+        self.program.append((operator, register, operands))
+        return ("register", register)
+
+    def _swap_registers(self, a, b):
+        swap = {a: b, b: a}
+
+        def rename(operand):
+            if operand[0] != "register":
+                return operand
+            return ("register", swap.get(operand[1], operand[1]))
+
+        self.program = [
+            (operator, swap.get(register, register), [rename(i) for i in operands])
+            for operator, register, operands in self.program
+        ]
+
+    def evaluate(
+        self,
+        bands: dict,
+        out=None,
+        min_value=None,
+        max_value=None,
+        block_rows=BLOCK_ROWS,
+    ):
+        """
+        The evaluate method calculates the formula with the arrays of the bands.
+
+        Args:
+            bands (dict): A dict of 2D arrays by band name, all with the same shape.
+            out (ndarray): Optional float32 array for the result.
+            min_value (float): The values under min_value, or NaN, are set to min_value.
+            max_value (float): The values over max_value are set to max_value.
+            block_rows (int): rows evaluated at a time.
+        Returns:
+            ndarray: float32 array with the index.
+        """
+        missing = [i for i in self.bands if i not in bands]
+        if missing:
+            raise ValueError(
+                f"Bands {missing} are missing for formula {self.formula!r}"
+            )
+        shapes = {np.shape(i) for i in bands.values()}
+        if out is not None:
+            shapes.add(np.shape(out))
+        if len(shapes) != 1:
+            raise ValueError(
+                f"The bands of formula {self.formula!r} have shapes {shapes}"
+            )
+        shape = shapes.pop()
+        if out is None:
+            out = np.empty(shape, dtype=INDEX_DTYPE)
+        height = shape[0]
+        block_rows = max(1, min(block_rows, height))
+        width = shape[1:]
+        pool = [
+            np.empty((block_rows, *width), dtype=INDEX_DTYPE)
+            for _ in range(self.registers - 1)
+        ]
+        mask = np.empty((block_rows, *width), dtype=bool)
+
+        for start in range(0, height, block_rows):
+            stop = min(start + block_rows, height)
+            rows = stop - start
+            registers = [out[start:stop]] + [i[:rows] for i in pool]
+            self._run(bands, registers, mask[:rows], start, stop)
+            block = out[start:stop]
+            if self.result[0] == "constant":
+                block.fill(self.result[1])
+            elif self.result[0] == "band":
+                np.copyto(block, bands[self.result[1]][start:stop], casting="unsafe")
+            if min_value is not None:
+                np.fmax(block, min_value, out=block)
+            if max_value is not None:
+                np.fmin(block, max_value, out=block)
+        return out
+
+    def _run(self, bands, registers, mask, start, stop):
+        def value(operand):
+            kind, key = operand
+            if kind == "register":
+                return registers[key]
+            if kind == "band":
+                return bands[key][start:stop]
+            return key
+
+        for operator, register, operands in self.program:
+            out = registers[register]
+            args = [value(i) for i in operands]
+            if operator is ast.Div:
+                _divide(*args, out=out, mask=mask)
+            elif operator is ast.USub:
+                np.negative(*args, out=out, dtype=INDEX_DTYPE)
+            elif operator in FUNCTIONS:
+                FUNCTIONS[operator](*args, out=out, dtype=INDEX_DTYPE)
+            else:
+                BINARY_OPERATORS[operator](*args, out=out, dtype=INDEX_DTYPE)
+
+
+def _constant(operator, a, b):
+    if isinstance(operator, ast.Div):
+        return a / b if b else 0.0
+    return float(BINARY_OPERATORS[type(operator)](a, b))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_formula(formula: str):
+    """
+    The compile_formula function parses and checks a formula of an index, the result is cached.
+
+    Args:
+        formula (str): formula with band names, like (B3 - B6) / (B3 + B6).
+    Returns:
+        IndexFormula: compiled formula.
+    """
+    return IndexFormula(formula)
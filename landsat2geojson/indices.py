@@ -0,0 +1,86 @@
+import logging
+
+from .constants import QUERY_DATA
+from .index_formula import compile_formula
+
+logger = logging.getLogger("__name__")
+
+
+def register_index(
+    key: str,
+    formula: str,
+    index_name: str,
+    query: str = "",
+    bands=None,
+    reference_band=None,
+    min_value=0,
+    max_value=None,
+    message="",
+):
+    """
+    The register_index function adds an index to QUERY_DATA, so it can be used by the pipeline.
+
+    Args:
+        key (str): key of the index, like WATER.
+        formula (str): formula with band names, like (B3 - B6) / (B3 + B6).
+        index_name (str): name of the index, used in the names of the output files.
+        query (str): overpass query of the features of the index, with a {bbox} field.
+        bands (list): bands to download, the bands of the formula by default.
+        reference_band (str): band with the profile of the output, the first band of the formula by default.
+        min_value (float): The values under min_value are set to min_value.
+        max_value (float): The values over max_value are set to max_value.
+        message (str): message of the index.
+    Returns:
+        dict: metadata of the index.
+    """
+    compiled = compile_formula(formula)
+    metadata = {
+        "bands": list(bands or compiled.bands),
+        "query": query,
+        "message": message,
+        "reference_band": reference_band or compiled.bands[0],
+        "formula": formula,
+        "min_value": min_value,
+        "max_value": max_value,
+        "index_name": index_name,
+    }
+    missing = [i for i in compiled.bands if i not in metadata["bands"]]
+    if missing:
+        raise ValueError(f"The bands {missing} of the formula are not in bands")
+    if key in QUERY_DATA:
+        logger.warning(f"index {key} is replaced")
+    QUERY_DATA[key] = metadata
+    return metadata
+
+
+def get_indices(keys):
+    """
+    The get_indices function gets the metadata of several indices.
+
+    Args:
+        keys (list): keys of the indices, or a key.
+    Returns:
+        dict: A dict of metadata by key, in the order of keys.
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+    unknown = [i for i in keys if i not in QUERY_DATA]
+    if unknown:
+        raise ValueError(
+            f"Unknown index {unknown}, the indices are {list(QUERY_DATA.keys())}"
+        )
+    return {key: QUERY_DATA[key] for key in dict.fromkeys(keys)}
+
+
+def required_bands(indices: dict):
+    """
+    The required_bands function gets the union of the bands of several indices.
+
+    Args:
+        indices (dict): A dict of metadata of the indices.
+    Returns:
+        list: bands without duplicates, in order of appearance.
+    """
+    return list(
+        dict.fromkeys(band for i in indices.values() for band in i.get("bands", []))
+    )
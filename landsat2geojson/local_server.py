@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+logger = logging.getLogger("__name__")
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+DOWNLOAD_PATH = re.compile(
+    r"/download/[^/]+/L2SR_(?P<display_id>.+)_SR_(?P<band>\w+)_TIF$"
+)
+BBOX_PATTERN = re.compile(r"\(\s*([-\d.]+),\s*([-\d.]+),\s*([-\d.]+),\s*([-\d.]+)\s*\)")
+FILE_CHUNK_SIZE = 1 << 16
+
+
+def _element_bounds(element):
+    """Bounds (south, west, north, east) of an OSM JSON element with geometry."""
+    if "bounds" in element:
+        bounds = element["bounds"]
+        return bounds["minlat"], bounds["minlon"], bounds["maxlat"], bounds["maxlon"]
+    if "lat" in element:
+        return element["lat"], element["lon"], element["lat"], element["lon"]
+    lats = [i["lat"] for i in element.get("geometry", [])]
+    lons = [i["lon"] for i in element.get("geometry", [])]
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_throttled(self):
+        self.server.stats["throttled"] += 1
+        self.send_response(429)
+        self.send_header("Retry-After", str(self.server.retry_after))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _start_request(self):
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        return self.path.split("?")[0]
+
+    def _throttled(self, send):
+        """Answer with send, or 429 when there are max_concurrent requests in flight."""
+        with self.server.lock:
+            throttled = (
+                self.server.max_concurrent is not None
+                and self.server.in_flight >= self.server.max_concurrent
+            )
+            if not throttled:
+                self.server.in_flight += 1
+        if throttled:
+            return self._send_throttled()
+        try:
+            return send()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def do_GET(self):
+        path = self._start_request()
+        download = DOWNLOAD_PATH.match(path)
+        if download:
+            return self._send_redirect_json(**download.groupdict())
+        if path.startswith("/files/"):
+            return self._throttled(lambda: self._send_file(os.path.basename(path)))
+        self._send_json({"errorMessage": f"Not found {path}"}, status=404)
+
+    def do_POST(self):
+        path = self._start_request()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if path == "/api/interpreter" and self.server.overpass_elements is not None:
+            query = parse_qs(body.decode()).get("data", [""])[0]
+            return self._throttled(lambda: self._send_overpass(query))
+        self._send_json({"errorMessage": f"Not found {path}"}, status=404)
+
+    def _send_overpass(self, query):
+        """Overpass answers the elements inside the bboxes of the query."""
+        with self.server.lock:
+            self.server.stats["overpass_queries"] += 1
+        bboxes = [tuple(map(float, i)) for i in BBOX_PATTERN.findall(query)]
+        elements = [
+            element
+            for element in self.server.overpass_elements
+            if any(
+                south <= bounds[2]
+                and bounds[0] <= north
+                and west <= bounds[3]
+                and bounds[1] <= east
+                for bounds in [_element_bounds(element)]
+                for south, west, north, east in bboxes
+            )
+        ]
+        self._send_json({"version": 0.6, "elements": elements})
+
+    def _send_redirect_json(self, display_id, band):
+        """EarthExplorer answers the download url with the url of the file."""
+        file_name = f"{display_id}_SR_{band}.TIF"
+        if not os.path.exists(os.path.join(self.server.folder, file_name)):
+            return self._send_json(
+                {"url": None, "errorMessage": f"{file_name} not available"}
+            )
+        self._send_json(
+            {"url": f"{self.server.url}/files/{file_name}", "errorMessage": None}
+        )
+
+    def _send_file(self, file_name):
+        file_path = os.path.join(self.server.folder, file_name)
+        if not os.path.isfile(file_path):
+            return self._send_json({"errorMessage": "Not found"}, status=404)
+        size = os.path.getsize(file_path)
+        start, end = 0, size - 1
+        status = 200
+
+        range_header = self.headers.get("Range")
+        if self.server.ranges and range_header:
+            match = RANGE_PATTERN.match(range_header.strip())
+            if not match or not any(match.groups()):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Type", "image/tiff")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Content-Disposition", f'attachment; filename="{file_name}"')
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        with open(file_path, "rb") as src:
+            src.seek(start)
+            while length > 0:
+                chunk = src.read(min(FILE_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client only wanted the headers or the first bytes
+                    self.close_connection = True
+                    return
+                length -= len(chunk)
+                with self.server.lock:
+                    self.server.stats["bytes_sent"] += len(chunk)
+
+
+class LocalServer:
+    """Local stand-in of the EarthExplorer download flow that serves the band files of a folder.
+
+    The download url answers the redirect JSON of EarthExplorer and the files are served
+    with HTTP range requests, unless ranges is False. To reproduce back-pressure, each
+    request can be delayed by latency seconds and the file requests over max_concurrent
+    are answered with 429 and a Retry-After header.
+
+    With overpass_elements, a list of OSM JSON elements with geometry, it also answers
+    the overpass interpreter at /api/interpreter with the elements in the query bboxes.
+    """
+
+    def __init__(
+        self,
+        folder,
+        ranges=True,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        max_concurrent=None,
+        retry_after=1,
+        overpass_elements=None,
+    ):
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.folder = folder
+        self.httpd.ranges = ranges
+        self.httpd.latency = latency
+        self.httpd.max_concurrent = max_concurrent
+        self.httpd.retry_after = retry_after
+        self.httpd.overpass_elements = overpass_elements
+        self.httpd.in_flight = 0
+        self.httpd.lock = threading.Lock()
+        self.httpd.stats = {
+            "requests": 0,
+            "bytes_sent": 0,
+            "throttled": 0,
+            "overpass_queries": 0,
+        }
+        self.httpd.url = self.url
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def download_url(self):
+        """Template for WrapperEarthExplorer, like EE_DOWNLOAD_URL."""
+        return f"{self.url}/download/{{data_product_id}}/{{display_id}}"
+
+    @property
+    def overpass_url(self):
+        """Endpoint for get_overpass_data, like OVERPASS_ENDPOINT."""
+        return f"{self.url}/api/interpreter"
+
+    @property
+    def stats(self):
+        return self.httpd.stats
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
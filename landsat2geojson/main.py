@@ -1,100 +1,611 @@
 import itertools
-import json
+import os
 
 import click
-from geojson.feature import FeatureCollection as fc
 
-from .constants import QUERY_DATA
-from .download_band import download_scenes
-from .feature_utils import (
-    clean_scene,
-    fc2box,
-    fc2geom,
-    features_in_escene,
-    group_by_path_row,
-    minor_cloud,
-    remove_geom,
+from .band_cache import BandCache, file_digest
+from .checkpoint import RunCheckpoint, fingerprint
+from .constants import (
+    BAND_CACHE_MAX_BYTES,
+    BAND_STORE_DIR,
+    CREDENTIAL_CACHE_PATH,
+    DAYS_AGO,
+    DOWNLOAD_ENGINES,
+    DOWNLOAD_WORKERS,
+    MAX_CONNECTIONS_PER_HOST,
+    OUTPUT_FORMATS,
+    OVERPASS_ENDPOINT,
+    OVERPASS_TILE_DEG,
+    OVERPASS_WORKERS,
+    PROFILE_STAGES,
+    QUERY_DATA,
+    QUEUE_WORKERS,
+    SEARCH_CACHE_PATH,
+    SEARCH_CACHE_TTL_DAYS,
+    SCENE_PLANNERS,
+    WATER_BANDS,
 )
-from .overpass_search import get_overpass_data
-from .process_landsat import calculate_index_feature
-from .search_metadata import wraper_landsadxplore
+from .profiling import count, profiling, span
+
+# the modules of the stages import geopandas, rasterio, shapely, landsatxplore and
+# overpass, they are imported when their stage runs so the CLI starts fast
 
 
 def landsat2geojson(
-    username, password, geojson_file, data_folder, landsat_index, geojson_output
+    username,
+    password,
+    geojson_file,
+    data_folder,
+    landsat_index,
+    geojson_output,
+    partial_read=False,
+    cache_dir=None,
+    cache_max_gb=None,
+    download_workers=DOWNLOAD_WORKERS,
+    max_per_host=MAX_CONNECTIONS_PER_HOST,
+    download_engine="threads",
+    search_cache=SEARCH_CACHE_PATH,
+    search_cache_ttl_days=SEARCH_CACHE_TTL_DAYS,
+    overpass_endpoint=OVERPASS_ENDPOINT,
+    overpass_tile_deg=OVERPASS_TILE_DEG,
+    overpass_workers=OVERPASS_WORKERS,
+    overpass_cache_dir=None,
+    block_size=None,
+    simplify_tolerance=None,
+    min_area=None,
+    coord_precision=None,
+    output_format=None,
+    planner="path_row",
+    dry_run=False,
+    run_dir=None,
+    resume=False,
+    profile=None,
+    cprofile_stages=(),
+    credential_cache=CREDENTIAL_CACHE_PATH,
+    queue_dir=None,
+    queue_workers=QUEUE_WORKERS,
+    band_store_dir=BAND_STORE_DIR,
 ):
     """process script"""
-    metadata = QUERY_DATA.get(landsat_index)
+    with profiling(profile, cprofile_stages):
+        from .feature_utils import clean_path, fc2box, fc2geoms
+        from .indices import get_indices, required_bands
+        from .vector_io import guess_driver, output_path, read_features
 
-    features = json.load(open(geojson_file)).get("features")
-    features_geom = fc2geom(features)
-    features_bbox = fc2box(features_geom)
-    # get landsat data
-    data_query = wraper_landsadxplore(username, password, features_bbox.bounds)
-    if not data_query:
-        raise Exception("No results on query")
-    # Filter landsat 9
-    data_result = [d for d in data_query if "LC09" in d.get("display_id")]
-    data_result = group_by_path_row([clean_scene(scene) for scene in data_result])
-    # remove innecesary & merge features
-    data_result = features_in_escene(
-        [minor_cloud(scene) for scene in data_result.values()], features_geom
-    )
-    # Download scenes filter
-    data_result = download_scenes(
-        username, password, data_result, metadata.get("bands", []), data_folder
-    )
-    # calculate index
-    data_result = calculate_index_feature(data_result, metadata, data_folder)
+        output_format = output_format or guess_driver(geojson_output)
+        indices = get_indices(landsat_index)
+
+        with span("read_input"):
+            features = list(read_features(geojson_file))
+            features_geoms = fc2geoms(features)
+            features_bbox = fc2box(features, features_geoms)
+            count("features", len(features))
 
-    index_data_orig = list(
-        itertools.chain.from_iterable(
-            [i.get("raw_data").get("index_result_vector", []) for i in data_result]
+        cache_max_bytes = (
+            int(cache_max_gb * 1024**3) if cache_max_gb else BAND_CACHE_MAX_BYTES
         )
-    )
-    if not index_data_orig:
-        click.echo("=============", err=True)
-        raise Exception(
-            f"We did not find results in the geojson file that satisfy the index {metadata.get('index_name')} :("
+        cache_root = cache_dir or (
+            f"{clean_path(data_folder)}/band_cache" if data_folder else None
         )
-    # search osm
-    minx, miny, maxx, maxy = features_bbox.bounds
-    osm_data = get_overpass_data(
-        (miny, minx, maxy, maxx), metadata.get("query"), data_folder
-    )
-    # check intersects
-    index_data = list(
-        itertools.chain.from_iterable(
-            [
-                i.get("raw_data").get("index_result_vector_4326", [])
-                for i in data_result
-                if i.get("raw_data").get("index_result_vector_4326", None)
-            ]
+        if dry_run:
+            # only the search and the plan, nothing is downloaded or saved in run_dir
+            from .search_cache import SearchCache
+
+            with span("search"):
+                return plan_run(
+                    username,
+                    password,
+                    features,
+                    features_geoms,
+                    features_bbox,
+                    required_bands(indices),
+                    search_cache=(
+                        SearchCache(search_cache, search_cache_ttl_days)
+                        if search_cache
+                        else None
+                    ),
+                    planner=planner,
+                    credential_cache=credential_cache or None,
+                    band_cache=(
+                        BandCache(cache_root, cache_max_bytes)
+                        if cache_root and os.path.isdir(cache_root)
+                        else None
+                    ),
+                    report_file=(
+                        f"{clean_path(data_folder)}/dry_run.json"
+                        if data_folder
+                        else None
+                    ),
+                )
+        # each stage is saved in run_dir, a resumed run skips the completed ones
+        if resume and not (run_dir or data_folder):
+            raise click.UsageError("--resume needs --run_dir or --data_folder")
+        run_dir = run_dir or (f"{data_folder}/run" if data_folder else None)
+        checkpoint = RunCheckpoint(run_dir, resume) if run_dir else None
+
+        # get landsat data
+        # the cover planner selects by the bands to download
+        search_key = fingerprint(
+            "search",
+            file_digest(geojson_file),
+            DAYS_AGO,
+            planner,
+            required_bands(indices) if planner == "cover" else None,
+        )
+        with span("search"):
+            data_result = checkpoint.load("search", search_key) if checkpoint else None
+            if data_result is None:
+                from .search_cache import SearchCache
+
+                band_cache = None
+                if planner == "cover" and cache_root:
+                    band_cache = BandCache(cache_root, cache_max_bytes)
+                data_result = search_scenes(
+                    username,
+                    password,
+                    features,
+                    features_geoms,
+                    features_bbox,
+                    search_cache=(
+                        SearchCache(search_cache, search_cache_ttl_days)
+                        if search_cache
+                        else None
+                    ),
+                    planner=planner,
+                    credential_cache=credential_cache or None,
+                    bands=required_bands(indices),
+                    band_cache=band_cache,
+                    plan_file=(
+                        f"{clean_path(data_folder)}/scene_plan.json"
+                        if data_folder
+                        else None
+                    ),
+                )
+                if checkpoint:
+                    checkpoint.save("search", search_key, data_result)
+            count("scenes", len(data_result))
+
+        scene_keys = {
+            scene.get("display_id"): fingerprint(
+                "scene",
+                search_key,
+                scene.get("display_id"),
+                indices,
+                block_size,
+                simplify_tolerance,
+                min_area,
+                coord_precision,
+                output_format,
+            )
+            for scene in data_result
+        }
+        output_key = fingerprint(
+            "output",
+            list(scene_keys.values()),
+            geojson_output,
+            output_format,
+            overpass_endpoint,
+            overpass_tile_deg,
         )
+        # with the outputs of a completed run the scenes are not loaded
+        output = checkpoint.load("output", output_key) if checkpoint else None
+        if output and all(os.path.exists(i) for i in output.get("outputs")):
+            found = output.get("found")
+        else:
+            pending = []
+            for scene in data_result:
+                display_id = scene.get("display_id")
+                index = (
+                    checkpoint.load(f"scene_{display_id}", scene_keys[display_id])
+                    if checkpoint
+                    else None
+                )
+                if index is None:
+                    pending.append(scene)
+                else:
+                    scene["raw_data"] = {"index": index}
+
+            def save_scene(scene):
+                if checkpoint:
+                    display_id = scene.get("display_id")
+                    checkpoint.save(
+                        f"scene_{display_id}",
+                        scene_keys[display_id],
+                        {
+                            key: {
+                                k: v for k, v in result.items() if k != "index_result"
+                            }
+                            for key, result in scene.get("raw_data")
+                            .get("index")
+                            .items()
+                        },
+                    )
+
+            if pending and queue_dir:
+                from .download_band import EE_DOWNLOAD_URL
+                from .work_queue import run_queue, scene_task
+
+                # each scene is a task of the queue, run by the workers of any host
+                options = {
+                    "partial_read": partial_read,
+                    "download_url": EE_DOWNLOAD_URL,
+                    "cache_dir": cache_root,
+                    "cache_max_bytes": cache_max_bytes,
+                    "download_workers": download_workers,
+                    "max_per_host": max_per_host,
+                    "download_engine": download_engine,
+                    "block_size": block_size,
+                    "simplify_tolerance": simplify_tolerance,
+                    "min_area": min_area,
+                    "coord_precision": coord_precision,
+                    "output_format": output_format,
+                }
+                with span("queue", scenes=len(pending)):
+                    results = run_queue(
+                        queue_dir,
+                        {
+                            scene_keys[scene.get("display_id")]: scene_task(
+                                scene, list(indices), data_folder, options
+                            )
+                            for scene in pending
+                        },
+                        username,
+                        password,
+                        workers=queue_workers,
+                        credential_cache=credential_cache or None,
+                        band_store_dir=band_store_dir,
+                    )
+                for scene in pending:
+                    scene["raw_data"] = {
+                        "index": results[scene_keys[scene.get("display_id")]]
+                    }
+                    save_scene(scene)
+            elif pending:
+                from .band_store import BandStore
+                from .download_band import download_scenes
+                from .process_landsat import calculate_indices_feature
+
+                # the bands are written once in the store, the processes map them
+                band_store = BandStore(band_store_dir) if band_store_dir else None
+                try:
+                    # Download scenes filter
+                    with span("download", scenes=len(pending)):
+                        pending = download_scenes(
+                            username,
+                            password,
+                            pending,
+                            required_bands(indices),
+                            data_folder,
+                            partial=partial_read,
+                            cache_dir=cache_dir,
+                            cache_max_bytes=cache_max_bytes,
+                            n_jobs=download_workers,
+                            max_per_host=max_per_host,
+                            engine=download_engine,
+                            credential_cache=credential_cache or None,
+                            band_store=band_store,
+                        )
+                    # calculate indices, from the same bands, each scene is saved when it is done
+                    with span("calculate_index", scenes=len(pending)):
+                        pending = calculate_indices_feature(
+                            pending,
+                            indices,
+                            data_folder,
+                            block_size=block_size,
+                            simplify_tolerance=simplify_tolerance,
+                            min_area=min_area,
+                            precision=coord_precision,
+                            output_format=output_format,
+                            on_scene=save_scene,
+                            band_store=band_store,
+                        )
+                finally:
+                    if band_store:
+                        band_store.close()
+                calculated = {scene.get("display_id"): scene for scene in pending}
+                data_result = [
+                    calculated.get(scene.get("display_id"), scene)
+                    for scene in data_result
+                ]
+
+            found = write_index_outputs(
+                data_result,
+                indices,
+                features_bbox,
+                data_folder,
+                geojson_output,
+                output_format,
+                overpass_endpoint=overpass_endpoint,
+                overpass_tile_deg=overpass_tile_deg,
+                overpass_workers=overpass_workers,
+                overpass_cache_dir=overpass_cache_dir,
+            )
+            if checkpoint:
+                outputs = [
+                    output_path(
+                        index_output(geojson_output, i.get("index_name"), len(indices)),
+                        output_format,
+                    )
+                    for i in indices.values()
+                ]
+                checkpoint.save(
+                    "output",
+                    output_key,
+                    {
+                        "found": found,
+                        "outputs": [i for i in outputs if os.path.exists(i)],
+                    },
+                )
+        if not found:
+            click.echo("=============", err=True)
+            raise Exception(
+                f"We did not find results in the geojson file that satisfy the index {', '.join(i.get('index_name') for i in indices.values())} :("
+            )
+
+
+def search_scenes(
+    username,
+    password,
+    features,
+    features_geoms,
+    features_bbox,
+    search_cache=None,
+    api=None,
+    planner="path_row",
+    credential_cache=CREDENTIAL_CACHE_PATH,
+    bands=None,
+    band_cache=None,
+    plan_file=None,
+):
+    """
+    The search_scenes function finds the landsat 9 scenes over the features.
+
+    With the path_row planner it is the scene with less clouds of each path/row, with the
+    cover planner it is a near-minimal set of scenes that covers the features, by bytes to
+    download and cloud cover.
+
+    Args:
+        username (str): username for earthexplorer.
+        password (str):  password for earthexplorer.
+        features (list): list of features.
+        features_geoms (list): shapely geometries of the features.
+        features_bbox (Polygon): bbox of the features.
+        search_cache (SearchCache): Optional cache of the searches.
+        api (API): Optional logged API shared by several searches.
+        planner (str): "path_row" or "cover".
+        credential_cache (str): path of the credential cache of the login, without api.
+        bands (list): bands to download, for the cost of the cover planner.
+        band_cache (BandCache): Optional band cache, its bands cost nothing to the cover planner.
+        plan_file (str): Optional path of the JSON with the plan of the cover planner.
+    Returns:
+        list: list of scenes with the features they contain.
+    """
+    from .search_metadata import wraper_landsadxplore
+
+    data_query = wraper_landsadxplore(
+        username,
+        password,
+        features_bbox.bounds,
+        cache=search_cache,
+        api=api,
+        credential_cache=credential_cache,
+    )
+    if not data_query:
+        raise Exception("No results on query")
+    from .feature_utils import (
+        clean_scene,
+        features_in_escene,
+        group_by_path_row,
+        minor_cloud,
     )
-    index_data_geom = fc2geom(index_data)
-    osm_data_sh = fc2geom(osm_data.get("features", []))
-    for ind_feat in index_data_geom:
-        ind_geom = ind_feat.get("geom")
-        ind_feat["properties"]["source_generated"] = "landsat"
-        for osm_feat in osm_data_sh:
-            osm_geom = osm_feat.get("geom")
-            osm_feat["properties"]["source_generated"] = "osm"
-            if ind_geom.intersects(osm_geom):
-                # for remove
-                ind_feat["properties"]["intersects"] = True
-                osm_feat["properties"]["intersects"] = True
-
-    # clean geom field
-    data_merge = remove_geom(
-        [
-            i
-            for i in [*index_data_geom, *osm_data_sh]
-            if not i.get("properties").get("intersects")
+
+    # Filter landsat 9
+    data_result = [clean_scene(d) for d in data_query if "LC09" in d.get("display_id")]
+    if planner == "cover":
+        from .scene_planner import plan_scenes, write_plan
+
+        data_result, plan = plan_scenes(
+            data_result,
+            features_geoms,
+            bands=bands or WATER_BANDS,
+            cache=band_cache,
+        )
+        if plan_file:
+            write_plan(plan_file, plan)
+    else:
+        data_result = [
+            minor_cloud(scene) for scene in group_by_path_row(data_result).values()
         ]
+    # remove innecesary & merge features
+    return features_in_escene(data_result, features, features_geoms)
+
+
+def plan_run(
+    username,
+    password,
+    features,
+    features_geoms,
+    features_bbox,
+    bands,
+    search_cache=None,
+    planner="path_row",
+    credential_cache=CREDENTIAL_CACHE_PATH,
+    band_cache=None,
+    report_file=None,
+):
+    """
+    The plan_run function searches and plans the scenes of a run, without downloading them.
+
+    Args:
+        username (str): username for earthexplorer.
+        password (str):  password for earthexplorer.
+        features (list): list of features.
+        features_geoms (list): shapely geometries of the features.
+        features_bbox (Polygon): bbox of the features.
+        bands (list): bands to download for each scene.
+        search_cache (SearchCache): Optional cache of the searches.
+        planner (str): "path_row" or "cover".
+        credential_cache (str): path of the credential cache of the login.
+        band_cache (BandCache): Optional band cache, its bands are not downloaded.
+        report_file (str): Optional path of the JSON report.
+    Returns:
+        dict: report with the scenes, bands, estimated bytes and features of each scene.
+    """
+    from .scene_planner import explain_report, scene_report, write_plan
+
+    # the features are copied in the scenes, the index keeps their position in the input
+    for n, feature in enumerate(features):
+        feature["feature_index"] = n
+    data_result = search_scenes(
+        username,
+        password,
+        features,
+        features_geoms,
+        features_bbox,
+        search_cache=search_cache,
+        planner=planner,
+        credential_cache=credential_cache,
+        bands=bands,
+        band_cache=band_cache,
     )
+    report = scene_report(data_result, features, bands, band_cache)
+    report["planner"] = planner
+    for line in explain_report(report):
+        click.echo(line)
+    if report_file:
+        write_plan(report_file, report)
+    return report
+
+
+def write_index_outputs(
+    data_result,
+    indices,
+    features_bbox,
+    data_folder,
+    geojson_output,
+    output_format,
+    overpass_endpoint=OVERPASS_ENDPOINT,
+    overpass_tile_deg=OVERPASS_TILE_DEG,
+    overpass_workers=OVERPASS_WORKERS,
+    overpass_cache_dir=None,
+):
+    """
+    The write_index_outputs function merges the vectors of each index with the OSM data and writes them.
+
+    Args:
+        data_result (list): list of scenes with the calculated indices.
+        indices (dict): metadata of the indices by key.
+        features_bbox (Polygon): bbox of the features.
+        data_folder (str): path of directory.
+        geojson_output (str): path of output file.
+        output_format (str): driver of the output.
+        overpass_endpoint (str): url of the overpass interpreter.
+        overpass_tile_deg (float): max size of the overpass tiles in degrees.
+        overpass_workers (int): Number of overpass tiles queried at the same time.
+        overpass_cache_dir (str): folder of the cache of overpass tiles.
+    Returns:
+        bool: True if any index has results.
+    Raises:
+        click.ClickException: when the OSM data can not be queried.
+    """
+    from .feature_utils import fc2geoms, mark_intersects
+    from .overpass_search import OverpassError, get_overpass_data
+    from .vector_io import output_path, write_features
 
-    json.dump(fc(data_merge), open(geojson_output, "w"), indent=2)
+    found = False
+    for key, metadata in indices.items():
+        index_name = metadata.get("index_name")
+        index_data_orig = list(
+            itertools.chain.from_iterable(
+                [
+                    i.get("raw_data").get("index").get(key).get("index_result_vector")
+                    for i in data_result
+                ]
+            )
+        )
+        if not index_data_orig:
+            click.echo(
+                f"We did not find results in the geojson file that satisfy the index {index_name} :(",
+                err=True,
+            )
+            continue
+        found = True
+        # search osm
+        minx, miny, maxx, maxy = features_bbox.bounds
+        with span("overpass", index=index_name):
+            try:
+                osm_data = get_overpass_data(
+                    (miny, minx, maxy, maxx),
+                    metadata.get("query"),
+                    data_folder,
+                    endpoint=overpass_endpoint,
+                    tile_deg=overpass_tile_deg,
+                    n_jobs=overpass_workers,
+                    cache_dir=overpass_cache_dir,
+                    name="overpass" if len(indices) == 1 else f"overpass_{index_name}",
+                )
+            except OverpassError as ex:
+                # the index is not merged with incomplete OSM data
+                raise click.ClickException(f"{index_name}: {ex}")
+        with span("output", index=index_name):
+            # check intersects
+            index_data = list(
+                itertools.chain.from_iterable(
+                    [
+                        i.get("raw_data")
+                        .get("index")
+                        .get(key)
+                        .get("index_result_vector_4326", [])
+                        for i in data_result
+                    ]
+                )
+            )
+            osm_features = osm_data.get("features", [])
+            intersects_index, intersects_osm = mark_intersects(
+                index_data, osm_features, fc2geoms(index_data), fc2geoms(osm_features)
+            )
+            for ind_feat, intersects in zip(index_data, intersects_index):
+                ind_feat["properties"]["source_generated"] = "landsat"
+                if intersects:
+                    # for remove
+                    ind_feat["properties"]["intersects"] = True
+            for osm_feat, intersects in zip(osm_features, intersects_osm):
+                osm_feat["properties"]["source_generated"] = "osm"
+                if intersects:
+                    osm_feat["properties"]["intersects"] = True
+
+            data_merge = (
+                i
+                for i in itertools.chain(index_data, osm_features)
+                if not i.get("properties").get("intersects")
+            )
+            written = write_features(
+                output_path(
+                    index_output(geojson_output, index_name, len(indices)),
+                    output_format,
+                ),
+                data_merge,
+                driver=output_format,
+            )
+            count("features_written", written)
+    return found
+
+
+def index_output(geojson_output: str, index_name: str, n_indices: int):
+    """
+    The index_output function gets the output file of an index.
+
+    Args:
+        geojson_output (str): path of output file.
+        index_name (str): name of the index.
+        n_indices (int): number of indices of the run.
+    Returns:
+        str: geojson_output with one index, with the index name before the extension with several.
+    """
+    if n_indices == 1:
+        return geojson_output
+    root, ext = os.path.splitext(geojson_output)
+    return f"{root}_{index_name}{ext}"
 
 
 @click.command(short_help="Script to find data from landsat and open street maps")
@@ -127,16 +638,259 @@ def landsat2geojson(
 )
 @click.option(
     "--landsat_index",
-    help="Landsar normalized index",
+    help="Landsar normalized index, it can be repeated to calculate several indices from the same bands",
     type=click.Choice(list(QUERY_DATA.keys())),
-    default="WATER",
+    default=["WATER"],
+    multiple=True,
 )
 @click.option(
     "--geojson_output", help="Pathfile from geojson output", type=str, required=True
 )
-def main(username, password, geojson_file, data_folder, landsat_index, geojson_output):
+@click.option(
+    "--partial_read",
+    help="Read only the AOI window of the bands with HTTP range requests",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--cache_dir",
+    help="Path of the band cache, by default band_cache inside data_folder",
+    type=str,
+    required=False,
+    default=None,
+)
+@click.option(
+    "--cache_max_gb",
+    help="Size budget of the band cache in GB, the least recently used bands are evicted",
+    type=float,
+    required=False,
+    default=None,
+)
+@click.option(
+    "--download_workers",
+    help="Number of bands downloaded at the same time",
+    type=int,
+    default=DOWNLOAD_WORKERS,
+    show_default=True,
+)
+@click.option(
+    "--max_per_host",
+    help="Limit of concurrent requests to the same host",
+    type=int,
+    default=MAX_CONNECTIONS_PER_HOST,
+    show_default=True,
+)
+@click.option(
+    "--download_engine",
+    help="Download engine, async adapts the concurrency to the throttling of the server",
+    type=click.Choice(DOWNLOAD_ENGINES),
+    default="threads",
+    show_default=True,
+)
+@click.option(
+    "--search_cache",
+    help="Path of the cache of scene searches, empty to disable it",
+    type=str,
+    default=SEARCH_CACHE_PATH,
+    show_default=True,
+)
+@click.option(
+    "--search_cache_ttl_days",
+    help="Days after which a cached search is done again",
+    type=int,
+    default=SEARCH_CACHE_TTL_DAYS,
+    show_default=True,
+)
+@click.option(
+    "--overpass_endpoint",
+    help="Url of the overpass interpreter",
+    type=str,
+    default=OVERPASS_ENDPOINT,
+    show_default=True,
+)
+@click.option(
+    "--overpass_tile_deg",
+    help="Size in degrees of the tiles of the overpass queries",
+    type=float,
+    default=OVERPASS_TILE_DEG,
+    show_default=True,
+)
+@click.option(
+    "--overpass_workers",
+    help="Number of overpass tiles queried at the same time",
+    type=int,
+    default=OVERPASS_WORKERS,
+    show_default=True,
+)
+@click.option(
+    "--overpass_cache_dir",
+    help="Folder of the cache of overpass tiles, by default overpass_cache in data_folder",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--block_size",
+    help="Size in pixels of the blocks to calculate the index of each scene in parallel, by default the whole scene",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--simplify_tolerance",
+    help="Tolerance in meters to simplify the polygons of the index, the shared edges are kept",
+    type=float,
+    default=None,
+)
+@click.option(
+    "--min_area",
+    help="Min area in square meters of the polygons of the index",
+    type=float,
+    default=None,
+)
+@click.option(
+    "--coord_precision",
+    help="Number of decimals of the coordinates of the output",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--output_format",
+    help="Format of the output and the vectors of each scene, by default from the extension of geojson_output",
+    type=click.Choice(OUTPUT_FORMATS),
+    default=None,
+)
+@click.option(
+    "--planner",
+    help="Scene selection, path_row keeps the scene with less clouds of each path/row, cover selects the fewest scenes that cover the features by bytes to download and cloud cover",
+    type=click.Choice(SCENE_PLANNERS),
+    default="path_row",
+    show_default=True,
+)
+@click.option(
+    "--dry_run",
+    help="Only search and plan the scenes, report the scenes, bands, estimated MB to download and features of each scene",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--run_dir",
+    help="Folder of the checkpoints of the stages of the run, by default run inside data_folder",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--resume",
+    help="Skip the stages and scenes completed by a previous run with the same inputs",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--profile",
+    help="Pathfile of a JSON report with the time, memory and counters of each stage, in trace-event format",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--cprofile",
+    help="Stage also profiled with cProfile, saved next to the --profile report, it can be repeated",
+    type=click.Choice(PROFILE_STAGES),
+    multiple=True,
+)
+@click.option(
+    "--credential_cache",
+    help="Path of the cache of the EarthExplorer login, shared by the runs until it expires, empty to disable it",
+    type=str,
+    default=CREDENTIAL_CACHE_PATH,
+    show_default=True,
+)
+@click.option(
+    "--queue_dir",
+    help="Folder of a durable queue with a task for each scene, the workers of other hosts can run them with landsat2geojson-worker",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--queue_workers",
+    help="Number of local worker processes of the queue, 0 to wait for the workers of other hosts",
+    type=int,
+    default=QUEUE_WORKERS,
+    show_default=True,
+)
+@click.option(
+    "--band_store_dir",
+    help="Folder of the band arrays memory mapped by the processes, shared memory by default, empty to keep them in the memory of each process",
+    type=str,
+    default=BAND_STORE_DIR,
+    show_default=True,
+)
+def main(
+    username,
+    password,
+    geojson_file,
+    data_folder,
+    landsat_index,
+    geojson_output,
+    partial_read,
+    cache_dir,
+    cache_max_gb,
+    download_workers,
+    max_per_host,
+    download_engine,
+    search_cache,
+    search_cache_ttl_days,
+    overpass_endpoint,
+    overpass_tile_deg,
+    overpass_workers,
+    overpass_cache_dir,
+    block_size,
+    simplify_tolerance,
+    min_area,
+    coord_precision,
+    output_format,
+    planner,
+    dry_run,
+    run_dir,
+    resume,
+    profile,
+    cprofile,
+    credential_cache,
+    queue_dir,
+    queue_workers,
+    band_store_dir,
+):
     landsat2geojson(
-        username, password, geojson_file, data_folder, landsat_index, geojson_output
+        username,
+        password,
+        geojson_file,
+        data_folder,
+        landsat_index,
+        geojson_output,
+        partial_read,
+        cache_dir,
+        cache_max_gb,
+        download_workers,
+        max_per_host,
+        download_engine,
+        search_cache,
+        search_cache_ttl_days,
+        overpass_endpoint,
+        overpass_tile_deg,
+        overpass_workers,
+        overpass_cache_dir,
+        block_size,
+        simplify_tolerance,
+        min_area,
+        coord_precision,
+        output_format,
+        planner,
+        dry_run,
+        run_dir,
+        resume,
+        profile,
+        cprofile,
+        credential_cache,
+        queue_dir,
+        queue_workers,
+        band_store_dir,
     )
 
 
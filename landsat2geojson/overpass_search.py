@@ -1,34 +1,211 @@
+import hashlib
 import json
 import logging
+import math
+import os
+import time
 
 import overpass
 from geojson.feature import FeatureCollection as fc
+from joblib import Parallel, delayed
 
+from .constants import (
+    OVERPASS_CACHE_TTL_DAYS,
+    OVERPASS_ENDPOINT,
+    OVERPASS_TIMEOUT,
+    OVERPASS_TILE_DEG,
+    OVERPASS_WORKERS,
+)
 from .feature_utils import line2polygon
+from .profiling import count
+from .vector_io import write_features
 
 logger = logging.getLogger("__name__")
 
+QUERY_ATTEMPTS = 4
+RETRY_WAIT = 5
 
-def get_overpass_data(bbox, query, data_folder):
+
+class OverpassError(Exception):
+    """The query of a tile failed after its retries, the OSM data is incomplete."""
+
+
+def bbox_tiles(bbox: tuple, tile_deg=OVERPASS_TILE_DEG):
+    """
+    The bbox_tiles function splits a bbox in a grid of tiles.
+
+    Args:
+        bbox (tuple): A tuple of coords (south, west, north, east), like overpass.
+        tile_deg (float): max size of the tiles in degrees.
+    Returns:
+        list: list of (south, west, north, east) tuples.
+    """
+    south, west, north, east = bbox
+    rows = max(1, math.ceil(round((north - south) / tile_deg, 9)))
+    cols = max(1, math.ceil(round((east - west) / tile_deg, 9)))
+    lat_step = (north - south) / rows
+    lon_step = (east - west) / cols
+    return [
+        (
+            round(south + lat_step * row, 7),
+            round(west + lon_step * col, 7),
+            round(north if row == rows - 1 else south + lat_step * (row + 1), 7),
+            round(east if col == cols - 1 else west + lon_step * (col + 1), 7),
+        )
+        for row in range(rows)
+        for col in range(cols)
+    ]
+
+
+OSM_TYPES = ("node", "way", "relation")
+
+
+def osm_key(feature: dict):
+    """
+    The osm_key function gets the OSM id of a feature, with its element type.
+
+    The type of the feature, or a type property that is not an OSM element type like
+    "Feature", does not tell a node from a way with the same id, the geometry type is
+    used instead.
+
+    Args:
+        feature (dict): A feature of overpass.
+    Returns:
+        str: type/id, like way/123, or Point/123 without the element type.
+    """
+    properties = feature.get("properties") or {}
+    osm_id = properties["id"] if "id" in properties else feature.get("id")
+    if isinstance(osm_id, str) and osm_id.split("/")[0] in OSM_TYPES:
+        # osmtogeojson ids, like way/123
+        return osm_id
+    osm_type = properties.get("type")
+    if osm_type not in OSM_TYPES:
+        osm_type = (feature.get("geometry") or {}).get("type", "")
+    return f"{osm_type}/{osm_id}"
+
+
+def _cache_path(cache_dir, endpoint, query):
+    key = hashlib.sha256(f"{endpoint}\n{query}".encode()).hexdigest()
+    return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+
+def _read_cache(path, ttl_days):
+    try:
+        if time.time() - os.path.getmtime(path) > ttl_days * 86400:
+            return None
+        with open(path, encoding="utf-8") as src:
+            return json.load(src)
+    except (OSError, ValueError):
+        # missing or cut file
+        return None
+
+
+def _write_cache(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as dst:
+        json.dump(data, dst)
+    os.replace(tmp_path, path)
+
+
+def _query_tile(tile, query, endpoint, timeout, cache_dir, cache_ttl_days):
+    """
+    The _query_tile function gets the features of a tile, from the cache if it is not expired.
+
+    Args:
+        tile (tuple): A tuple of coords (south, west, north, east).
+        query (str): A query from metadata.
+        endpoint (str): url of the overpass interpreter.
+        timeout (int): seconds to wait for the query.
+        cache_dir (str): folder of the cache, None to disable it.
+        cache_ttl_days (int): days after which a cached tile is queried again.
+    Returns:
+        list: list of dict features.
+    """
+    tile_query = query.format(bbox=str(tile))
+    path = _cache_path(cache_dir, endpoint, tile_query) if cache_dir else None
+    if path:
+        response = _read_cache(path, cache_ttl_days)
+        if response is not None:
+            count("overpass_cache_hits")
+            return response.get("features", [])
+
+    api = overpass.API(endpoint=endpoint, timeout=timeout)
+    for attempt in range(QUERY_ATTEMPTS):
+        try:
+            response = api.get(tile_query, verbosity="geom")
+            break
+        except (overpass.MultipleRequestsError, overpass.ServerLoadError) as ex:
+            if attempt == QUERY_ATTEMPTS - 1:
+                raise
+            logger.warning(f"overpass tile {tile} failed: {ex}, retrying")
+            time.sleep(RETRY_WAIT * 2**attempt)
+    count("overpass_queries")
+    if path:
+        _write_cache(path, response)
+    return response.get("features", [])
+
+
+def get_overpass_data(
+    bbox,
+    query,
+    data_folder,
+    endpoint=OVERPASS_ENDPOINT,
+    tile_deg=OVERPASS_TILE_DEG,
+    n_jobs=OVERPASS_WORKERS,
+    cache_dir=None,
+    cache_ttl_days=OVERPASS_CACHE_TTL_DAYS,
+    timeout=OVERPASS_TIMEOUT,
+    name="overpass",
+):
     """
     The get_overpass_data function get a result of the query in overpass.
 
+    The bbox is split in tiles that are queried at the same time, the features of the
+    tiles are merged by OSM id. Each tile is cached in cache_dir, or in
+    data_folder/overpass_cache.
+
     Args:
         bbox (tuple): A tuple os coords for bbox.
         query (str): A query from metadata.
         data_folder (str): path of directory.
+        endpoint (str): url of the overpass interpreter.
+        tile_deg (float): max size of the tiles in degrees.
+        n_jobs (int): Number of tiles queried at the same time.
+        cache_dir (str): folder of the cache of tiles.
+        cache_ttl_days (int): days after which a cached tile is queried again.
+        timeout (int): seconds to wait for each tile query.
+        name (str): name of the vector file in data_folder.
 
     Returns:
          dict : A featureCollection object.
+    Raises:
+        OverpassError: when a tile can not be queried, without the tile the merge would
+            keep the index polygons that intersect its OSM features.
     """
     try:
-        api = overpass.API(timeout=600)
-
-        query = query.format(bbox=str(bbox))
-        response = api.get(query, verbosity="geom")
-        response = fc(line2polygon(response.get("features")))
+        if cache_dir is None and data_folder:
+            cache_dir = f"{data_folder}/overpass_cache"
+        tiles = bbox_tiles(bbox, tile_deg)
+        responses = Parallel(n_jobs=min(n_jobs, len(tiles)), prefer="threads")(
+            delayed(_query_tile)(
+                tile, query, endpoint, timeout, cache_dir, cache_ttl_days
+            )
+            for tile in tiles
+        )
+        features = {}
+        for feature in (i for response in responses for i in response):
+            # the features over the edges of the tiles are in several responses
+            features.setdefault(osm_key(feature), feature)
+        logger.info(f"overpass: {len(features)} features from {len(tiles)} tiles")
+        count("overpass_tiles", len(tiles))
+        count("osm_features", len(features))
+        response = fc(line2polygon(list(features.values())))
         if response and data_folder:
-            json.dump(response, open(f"{data_folder}/overpass_VECTOR.geojson", "w"))
+            write_features(
+                f"{data_folder}/{name}_VECTOR.geojson", response.get("features")
+            )
         return response
     except Exception as ex:
-        logger.error(ex)
+        logger.error(f"overpass query of {name} failed: {ex}")
+        raise OverpassError(f"overpass query of {name} failed: {ex}") from ex
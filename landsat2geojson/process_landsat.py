@@ -1,20 +1,394 @@
-import json
+import itertools
 import logging
+import os
+import time
 
-import geopandas as gpd
 import numpy as np
 import rasterio as rio
-from geojson.feature import FeatureCollection as fc
+import shapely
 from joblib import Parallel, delayed
 from rasterio.features import shapes as rio_shape
+from rasterio.windows import Window
+from shapely import STRtree
+from shapely.geometry import mapping, shape
 from tqdm import tqdm
 
-from .feature_utils import get_crs_dataset
+from .band_store import load_array, store_array
+from .feature_utils import (
+    fc2geoms,
+    geoms2geometries,
+    get_crs_dataset,
+    reproject_geoms,
+)
+from .index_formula import compile_formula
+from .profiling import add_span
+from .vector_io import output_path, write_features
 
 logger = logging.getLogger("__name__")
 
 
-def calculate_index_feature(scenes: list, metadata: dict, data_folder: str):
+def _polygonize(index_result, transform):
+    """
+    The _polygonize function converts the index to polygons by value, rounded to 1 decimal.
+
+    Args:
+        index_result (ndarray): index array, 0 is nodata.
+        transform (Affine): transform of the array.
+    Returns:
+        list: list of (geometry, value) tuples.
+    """
+    return list(
+        rio_shape(
+            np.round(index_result, 1), mask=index_result != 0, transform=transform
+        )
+    )
+
+
+def block_windows(height: int, width: int, block_size: int):
+    """
+    The block_windows function splits a raster in square windows.
+
+    Args:
+        height (int): rows of the raster.
+        width (int): columns of the raster.
+        block_size (int): size of the windows in pixels.
+    Returns:
+        list: list of rasterio Windows.
+    """
+    return [
+        Window(col, row, min(block_size, width - col), min(block_size, height - row))
+        for row in range(0, height, block_size)
+        for col in range(0, width, block_size)
+    ]
+
+
+def _affine_xy(transform, xy):
+    """Apply an affine transform to an array of (x, y) coordinates."""
+    return xy @ np.array([[transform.a, transform.d], [transform.b, transform.e]]) + [
+        transform.c,
+        transform.f,
+    ]
+
+
+def _index_block(
+    bands: dict, metadata: dict, transform, window, height: int, width: int
+):
+    """
+    The _index_block function calculates and polygonizes the index of a window.
+
+    The polygons that touch a seam with the neighbor windows are returned apart in
+    pixel coordinates, so the polygons of both sides of a seam share exact coordinates.
+
+    Args:
+        bands (dict): A dict of the whole band arrays, by name.
+        metadata (dict): metadata of the index.
+        transform (Affine): transform of the bands.
+        window (Window): window to calculate.
+        height (int): rows of the raster.
+        width (int): columns of the raster.
+    Returns:
+        tuple: window, index array of the window, polygons, polygons on a seam and their values.
+    """
+    formula = compile_formula(metadata.get("formula"))
+    rows, cols = window.toslices()
+    index_block = formula.evaluate(
+        {i: bands[i][rows, cols] for i in formula.bands},
+        min_value=metadata.get("min_value"),
+        max_value=metadata.get("max_value"),
+    )
+    inverse = ~transform
+    # the edges of the raster are not seams, the coords of the pixels are integers
+    seams = (
+        window.col_off + 0.5 if window.col_off > 0 else -np.inf,
+        window.row_off + 0.5 if window.row_off > 0 else -np.inf,
+        (
+            window.col_off + window.width - 0.5
+            if window.col_off + window.width < width
+            else np.inf
+        ),
+        (
+            window.row_off + window.height - 0.5
+            if window.row_off + window.height < height
+            else np.inf
+        ),
+    )
+    polygons = _polygonize(index_block, rio.windows.transform(window, transform))
+    # bounds of the exteriors in pixels, with the coords of all polygons in one array
+    exteriors = [geometry["coordinates"][0] for geometry, _ in polygons]
+    sizes = np.array([len(i) for i in exteriors], dtype=int)
+    coords = np.array(list(itertools.chain.from_iterable(exteriors)), dtype="float64")
+    on_seam = np.zeros(len(polygons), dtype=bool)
+    if len(polygons):
+        coords = _affine_xy(inverse, coords.reshape(-1, 2))
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        mins = np.minimum.reduceat(coords, starts)
+        maxs = np.maximum.reduceat(coords, starts)
+        on_seam = (
+            (mins[:, 0] < seams[0])
+            | (mins[:, 1] < seams[1])
+            | (maxs[:, 0] > seams[2])
+            | (maxs[:, 1] > seams[3])
+        )
+    seam_geoms = shapely.transform(
+        np.array(
+            [shape(polygons[i][0]) for i in np.flatnonzero(on_seam)], dtype=object
+        ),
+        lambda xy: np.round(_affine_xy(inverse, xy)),
+    )
+    seam_values = [polygons[i][1] for i in np.flatnonzero(on_seam)]
+    polygons = [i for i, seam in zip(polygons, on_seam) if not seam]
+    return window, index_block, polygons, seam_geoms, seam_values
+
+
+def calculate_index_blocks(
+    bands: dict, metadata: dict, transform, block_size: int, n_jobs=-1
+):
+    """
+    The calculate_index_blocks function calculates and polygonizes the index by blocks in a process pool.
+
+    The polygons cut by the seams of the blocks are merged again by value, the result
+    is the same as polygonizing the whole index.
+
+    Args:
+        bands (dict): A dict of band arrays, by name.
+        metadata (dict): metadata of the index.
+        transform (Affine): transform of the bands.
+        block_size (int): size of the blocks in pixels.
+        n_jobs (int): Number of processes.
+    Returns:
+        tuple: index array and list of (geometry, value) tuples.
+    """
+    formula = compile_formula(metadata.get("formula"))
+    height, width = np.shape(bands[formula.bands[0]])
+    index_result = np.zeros((height, width), dtype="float32")
+    # the band arrays are memory mapped by joblib, they are not copied to each process
+    blocks = Parallel(n_jobs=n_jobs, return_as="generator")(
+        delayed(_index_block)(
+            {i: bands[i] for i in formula.bands},
+            metadata,
+            transform,
+            window,
+            height,
+            width,
+        )
+        for window in block_windows(height, width, block_size)
+    )
+    polygons, seam_geoms, seam_values = [], [], []
+    for (
+        window,
+        index_block,
+        block_polygons,
+        block_seam_geoms,
+        block_seam_values,
+    ) in blocks:
+        index_result[window.toslices()] = index_block
+        polygons.extend(block_polygons)
+        seam_geoms.append(block_seam_geoms)
+        seam_values.extend(block_seam_values)
+
+    seam_geoms = np.concatenate(seam_geoms)
+    seam_values = np.array(seam_values, dtype="float64")
+    for group in _touching_groups(seam_geoms, seam_values):
+        # polygons that only touch in a corner are split again, like rasterio does
+        merged = shapely.get_parts(shapely.union_all(seam_geoms[group]))
+        merged = shapely.transform(merged, lambda xy: _affine_xy(transform, xy))
+        value = float(seam_values[group[0]])
+        polygons.extend((mapping(geom), value) for geom in merged)
+    return index_result, polygons
+
+
+def _touching_groups(geoms, values):
+    """
+    The _touching_groups function groups the polygons of the same value that touch each other.
+
+    Args:
+        geoms (ndarray): array of polygons.
+        values (ndarray): value of each polygon.
+    Returns:
+        list: list of arrays of indexes, one by group.
+    """
+    parent = np.arange(len(geoms))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    left, right = STRtree(geoms).query(geoms, predicate="intersects")
+    same = (left < right) & (values[left] == values[right])
+    for i, j in zip(left[same], right[same]):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_j] = root_i
+    roots = np.array([find(i) for i in range(len(geoms))], dtype=int)
+    order = np.argsort(roots, kind="stable")
+    _, starts = np.unique(roots[order], return_index=True)
+    return np.split(order, starts[1:]) if len(order) else []
+
+
+def reduce_polygons(geoms, values, simplify_tolerance=None, min_area=None):
+    """
+    The reduce_polygons function simplifies the polygons of an index and removes the small ones.
+
+    The polygons are simplified as a coverage, so the edges shared by neighbor polygons
+    stay shared, with GEOS older than 3.12 each polygon is simplified alone.
+
+    Args:
+        geoms (np.ndarray): An array of polygons.
+        values (list): value of each polygon.
+        simplify_tolerance (float): Optional tolerance in units of the crs, 0 to not simplify.
+        min_area (float): Optional min area in units of the crs, the smaller polygons are removed.
+    Returns:
+        tuple: An array of polygons and a list of values.
+    """
+    if min_area:
+        keep = shapely.area(geoms) >= min_area
+        geoms = geoms[keep]
+        values = [v for v, k in zip(values, keep) if k]
+    if simplify_tolerance and len(geoms):
+        try:
+            geoms = shapely.coverage_simplify(geoms, simplify_tolerance)
+        except (AttributeError, shapely.errors.ShapelyError) as ex:
+            logger.info(f"coverage simplification not available: {ex}")
+            geoms = shapely.simplify(geoms, simplify_tolerance, preserve_topology=True)
+    return geoms, values
+
+
+def _check_bands(metadata: dict):
+    """Check the formula of an index before the scenes are processed."""
+    formula_bands = compile_formula(metadata.get("formula")).bands
+    missing = [i for i in formula_bands if i not in metadata.get("bands", [])]
+    if missing:
+        raise ValueError(
+            f"The bands {missing} of the formula of {metadata.get('index_name')} are not downloaded"
+        )
+
+
+def calculate_index(
+    raw_data: dict,
+    display_id: str,
+    metadata: dict,
+    data_folder: str,
+    block_size=None,
+    n_jobs=-1,
+    simplify_tolerance=None,
+    min_area=None,
+    precision=None,
+    output_format=None,
+    band_store=None,
+):
+    """
+    The calculate_index function calculates and vectorizes an index with the bands of a scene.
+
+    Args:
+        raw_data (dict): raw data of the scene, with the bands read.
+        display_id (str): display id of the scene.
+        metadata (dict): metadata of the index.
+        data_folder (str): path of directory.
+        block_size (int): Optional size of blocks in pixels, the blocks are processed in a process pool.
+        n_jobs (int): Number of processes for the blocks.
+        simplify_tolerance (float): Optional tolerance to simplify the polygons, in units of the crs of the scene.
+        min_area (float): Optional min area of the polygons, in units of the crs of the scene.
+        precision (int): Optional number of decimals of the coordinates in EPSG:4326.
+        output_format (str): Optional driver of the vector files, GeoJSON by default.
+        band_store (BandStore): Optional band store, the index array is returned as a handle.
+
+    Returns:
+         dict : index array, vectors and crs.
+    """
+    index_name = metadata.get("index_name")
+    formula = compile_formula(metadata.get("formula"))
+    # the bands of the store are memory mapped, they are not copied
+    bands = {
+        i: load_array(raw_data.get(i).get("data_read").get("out_image"))
+        for i in formula.bands
+    }
+    reference_band = metadata.get("reference_band") or formula.bands[0]
+    extra = {
+        **raw_data.get(reference_band).get("data_read").get("meta"),
+        "dtype": "float32",
+    }
+    result = {}
+
+    # index & vector
+    transform_ = extra.get("transform")
+    if block_size:
+        index_result, polygons = calculate_index_blocks(
+            bands, metadata, transform_, block_size, n_jobs
+        )
+    else:
+        index_result = formula.evaluate(
+            bands,
+            min_value=metadata.get("min_value"),
+            max_value=metadata.get("max_value"),
+        )
+        polygons = _polygonize(index_result, transform_)
+    result["index_result"] = index_result
+
+    crs = get_crs_dataset(extra.get("crs"))
+    crs_geojson = {
+        "type": "name",
+        "properties": {"name": f"urn:ogc:def:crs:EPSG::{crs}"},
+    }
+
+    values = [v for _, v in polygons]
+    geoms = fc2geoms([{"geometry": p} for p, _ in polygons])
+    if simplify_tolerance or min_area:
+        geoms, values = reduce_polygons(geoms, values, simplify_tolerance, min_area)
+        geometries = geoms2geometries(geoms)
+    else:
+        geometries = [p for p, _ in polygons]
+    vector_data = []
+    for p, v in zip(geometries, values):
+        vector_data.append({"type": "Feature", "properties": {"val": v}, "geometry": p})
+    result["index_result_vector"] = vector_data
+    if vector_data:
+        # the coordinate arrays are reprojected, without a GeoDataFrame
+        geometries_4326 = geoms2geometries(
+            reproject_geoms(geoms, crs, 4326, precision=precision)
+        )
+        result["index_result_vector_4326"] = [
+            {"type": "Feature", "properties": {"val": v}, "geometry": p}
+            for p, v in zip(geometries_4326, values)
+        ]
+    result["crs"] = crs
+    result["crs_json"] = crs_geojson
+
+    if data_folder and index_result.any():
+        with rio.open(
+            f"{data_folder}/{display_id}__{index_name}.TIF", "w", **extra
+        ) as src:
+            src.write(index_result, 1)
+
+        if vector_data:
+            write_features(
+                output_path(
+                    f"{data_folder}/{display_id}__{index_name}_VECTOR.geojson",
+                    output_format,
+                ),
+                vector_data,
+                driver=output_format,
+                crs=crs_geojson,
+            )
+
+    return store_array(
+        band_store, result, "index_result", f"{display_id}__{index_name}"
+    )
+
+
+def calculate_index_feature(
+    scenes: list,
+    metadata: dict,
+    data_folder: str,
+    block_size=None,
+    n_jobs=-1,
+    simplify_tolerance=None,
+    min_area=None,
+    precision=None,
+    output_format=None,
+    band_store=None,
+):
     """
     The calculate_index_feature function calculates the index with bands and metadata for each scene.
 
@@ -22,72 +396,135 @@ def calculate_index_feature(scenes: list, metadata: dict, data_folder: str):
         scenes (list): A list of scenes with features.
         metadata (list): A list of bands.
         data_folder (str): path of directory.
+        block_size (int): Optional size of blocks in pixels, each scene is processed by blocks in a process pool.
+        n_jobs (int): Number of processes.
+        simplify_tolerance (float): Optional tolerance to simplify the polygons, in units of the crs of the scene.
+        min_area (float): Optional min area of the polygons, in units of the crs of the scene.
+        precision (int): Optional number of decimals of the coordinates in EPSG:4326.
+        output_format (str): Optional driver of the vector files, GeoJSON by default.
+        band_store (BandStore): Optional band store, the index arrays are returned as handles.
+
+    Returns:
+         list : A list of scenes with index data.
+    """
+    _check_bands(metadata)
+
+    def calculate_index_(scene_, metadata_, data_folder_):
+        scene_.get("raw_data").update(
+            calculate_index(
+                scene_.get("raw_data"),
+                scene_.get("display_id"),
+                metadata_,
+                data_folder_,
+                block_size,
+                n_jobs,
+                simplify_tolerance,
+                min_area,
+                precision,
+                output_format,
+                band_store,
+            )
+        )
+        return scene_
+
+    # with blocks the processes are used by the blocks of each scene
+    scenes_index = Parallel(n_jobs=1 if block_size else n_jobs)(
+        delayed(calculate_index_)(scene, metadata, data_folder)
+        for scene in tqdm(
+            scenes, desc=f"calculate  {metadata.get('index_name')}, vector"
+        )
+    )
+    return scenes_index
+
+
+def calculate_indices_feature(
+    scenes: list,
+    indices: dict,
+    data_folder: str,
+    block_size=None,
+    n_jobs=-1,
+    simplify_tolerance=None,
+    min_area=None,
+    precision=None,
+    output_format=None,
+    on_scene=None,
+    band_store=None,
+):
+    """
+    The calculate_indices_feature function calculates several indices for each scene, from the same bands.
+
+    The results of each index are in raw_data["index"][key], with the same fields
+    that calculate_index_feature sets in raw_data.
+
+    Args:
+        scenes (list): A list of scenes with features, with the bands of all indices read.
+        indices (dict): A dict of metadata of the indices, by key.
+        data_folder (str): path of directory.
+        block_size (int): Optional size of blocks in pixels, each scene is processed by blocks in a process pool.
+        n_jobs (int): Number of processes.
+        simplify_tolerance (float): Optional tolerance to simplify the polygons, in units of the crs of the scene.
+        min_area (float): Optional min area of the polygons, in units of the crs of the scene.
+        precision (int): Optional number of decimals of the coordinates in EPSG:4326.
+        output_format (str): Optional driver of the vector files, GeoJSON by default.
+        on_scene (callable): Optional function called with each scene as soon as it is calculated.
+        band_store (BandStore): Optional band store, the index arrays are returned as handles,
+            so the processes only pickle the handles of the bands and the indices.
 
     Returns:
          list : A list of scenes with index data.
     """
+    for metadata in indices.values():
+        _check_bands(metadata)
 
-    def calculate_index(scene_, metadata_, data_folder_):
+    def calculate_indices(scene_, indices_, data_folder_):
+        # the scenes can run in other processes, their times are returned with them
+        start, cpu = time.time(), time.process_time()
         raw_data = scene_.get("raw_data")
-        bands_ = metadata_.get("bands")
-        index_name = metadata_.get("index_name")
-        #  util for eval
-        bands = {
-            f"{i}": raw_data.get(i).get("data_read").get("out_image").astype("float32")
-            for i in bands_
+        raw_data["index"] = {
+            key: calculate_index(
+                raw_data,
+                scene_.get("display_id"),
+                metadata_,
+                data_folder_,
+                block_size,
+                n_jobs,
+                simplify_tolerance,
+                min_area,
+                precision,
+                output_format,
+                band_store,
+            )
+            for key, metadata_ in indices_.items()
         }
-        extra = eval(metadata_.get("extra"))
-
-        index_result_all = eval(metadata_.get("formula"))
-        index_result = np.where(index_result_all >= 0, index_result_all, 0)
-        raw_data["index_result"] = index_result
-
-        # vector
-        transform_ = extra.get("transform")
-        crs = get_crs_dataset(extra.get("crs"))
-        crs_geojson = {
-            "type": "name",
-            "properties": {"name": f"urn:ogc:def:crs:EPSG::{crs}"},
+        scene_["profile"] = {
+            "start": start,
+            "wall": time.time() - start,
+            "cpu": time.process_time() - cpu,
+            "pid": os.getpid(),
+            "polygons": sum(
+                len(i.get("index_result_vector")) for i in raw_data["index"].values()
+            ),
         }
-
-        mask = index_result != 0
-        vector_data = []
-        for (p, v) in rio_shape(
-            np.round(index_result, 1), mask=mask, transform=transform_
-        ):
-            vector_data.append(
-                {"type": "Feature", "properties": {"val": v}, "geometry": p}
-            )
-        raw_data["index_result_vector"] = vector_data
-        if vector_data:
-            raw_data["index_result_vector_4326"] = json.loads(
-                gpd.GeoDataFrame.from_features(vector_data, crs=crs)
-                .to_crs(crs=4326)
-                .to_json()
-            ).get("features", [])
-        raw_data["crs"] = crs
-        raw_data["crs_json"] = crs_geojson
-
-        if data_folder and index_result.any():
-            display_id = scene_.get("display_id")
-            with rio.open(
-                f"{data_folder_}/{display_id}__{index_name}.TIF", "w", **extra
-            ) as src:
-                src.write(index_result, 1)
-
-            if vector_data:
-                json.dump(
-                    fc(vector_data, crs=crs_geojson),
-                    open(
-                        f"{data_folder_}/{display_id}__{index_name}_VECTOR.geojson", "w"
-                    ),
-                    indent=1,
-                )
-
         return scene_
 
-    scenes_index = Parallel(n_jobs=-1)(
-        delayed(calculate_index)(scene, metadata, data_folder)
-        for scene in tqdm(scenes, desc="calculate  MNDWI, vector")
-    )
+    index_names = ", ".join(i.get("index_name") for i in indices.values())
+    # with blocks the processes are used by the blocks of each scene
+    scenes_index = []
+    for scene in Parallel(n_jobs=1 if block_size else n_jobs, return_as="generator")(
+        delayed(calculate_indices)(scene, indices, data_folder)
+        for scene in tqdm(scenes, desc=f"calculate  {index_names}, vector")
+    ):
+        profile = scene.pop("profile")
+        add_span(
+            "calculate_index_scene",
+            profile["start"],
+            profile["wall"],
+            profile["cpu"],
+            display_id=scene.get("display_id"),
+            pid=profile["pid"],
+            counters={"polygons": profile["polygons"]},
+        )
+        if on_scene:
+            on_scene(scene)
+        scenes_index.append(scene)
     return scenes_index
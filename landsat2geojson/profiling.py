@@ -0,0 +1,265 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+logger = logging.getLogger("__name__")
+
+_profiler = None
+
+
+def peak_rss_mb(who="self"):
+    """
+    The peak_rss_mb function gets the peak resident memory of the process or of its finished children.
+
+    Args:
+        who (str): self or children.
+    Returns:
+        float: MB, None if it is not available.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    # KB in linux, bytes in macos
+    return usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def rss_mb():
+    """
+    The rss_mb function gets the current resident memory of the process.
+
+    Returns:
+        float: MB, None if it is not available, it is read from /proc in linux.
+    """
+    try:
+        with open("/proc/self/statm") as src:
+            pages = int(src.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _delta(end, start):
+    return None if end is None or start is None else round(end - start, 1)
+
+
+class Profiler:
+    """Spans of the stages of a run, with wall time, CPU time, memory and counters.
+
+    The memory of a span is the change of the current RSS of the process and how much the
+    span raised the peak RSS of the process, the peak of the whole process is only in the
+    totals of the report, ru_maxrss never decreases so it is the same for the next spans.
+
+    The counters of count are added to the innermost span of the thread, or to the
+    innermost span of the main thread when the thread has none, like the download
+    threads. The spans are written in the trace-event format, so the report can be opened
+    in chrome://tracing or Perfetto. The stages in cprofile_stages are also profiled with
+    cProfile, only in the thread that opens them.
+    """
+
+    def __init__(self, cprofile_stages=()):
+        self.cprofile_stages = set(cprofile_stages or ())
+        self.cprofiles = {}
+        self.spans = []
+        self.open_spans = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        """Record a span, args are saved with the counters of the span."""
+        record = {
+            "name": name,
+            "args": dict(args),
+            "counters": {},
+            "start": time.time(),
+            "tid": threading.get_ident(),
+        }
+        stack = self._stack()
+        stack.append(record)
+        with self.lock:
+            self.open_spans.append(record)
+        cpu = time.process_time()
+        rss_start = rss_mb()
+        peak_start = peak_rss_mb()
+        profile = None
+        if name in self.cprofile_stages:
+            profile = self.cprofiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+            record["wall"] = time.time() - record["start"]
+            record["cpu"] = time.process_time() - cpu
+            record["rss_delta_mb"] = _delta(rss_mb(), rss_start)
+            record["peak_rss_growth_mb"] = _delta(peak_rss_mb(), peak_start)
+            stack.pop()
+            with self.lock:
+                self.open_spans.remove(record)
+                self.spans.append(record)
+
+    def add_span(self, name: str, start: float, wall: float, cpu=None, **args):
+        """Record a span measured in other process, like the scenes of a process pool."""
+        counters = args.pop("counters", {})
+        with self.lock:
+            self.spans.append(
+                {
+                    "name": name,
+                    "args": args,
+                    "counters": counters,
+                    "start": start,
+                    "wall": wall,
+                    "cpu": cpu,
+                    "tid": args.get("pid", os.getpid()),
+                }
+            )
+
+    def count(self, name: str, value=1):
+        """Add value to a counter of the current span."""
+        stack = self._stack()
+        with self.lock:
+            if stack:
+                record = stack[-1]
+            else:
+                main_id = threading.main_thread().ident
+                records = [i for i in self.open_spans if i["tid"] == main_id]
+                if not records:
+                    return
+                record = records[-1]
+            record["counters"][name] = record["counters"].get(name, 0) + value
+
+    def report(self):
+        """Report with the spans and the totals of the counters by span name."""
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(
+                record["name"], {"count": 0, "wall": 0.0, "cpu": 0.0}
+            )
+            total["count"] += 1
+            total["wall"] += record["wall"]
+            total["cpu"] += record.get("cpu") or 0.0
+            for key, value in record["counters"].items():
+                total[key] = total.get(key, 0) + value
+        events = [
+            {
+                "name": record["name"],
+                "ph": "X",
+                "ts": round((record["start"] - self.start) * 1e6),
+                "dur": round(record["wall"] * 1e6),
+                "pid": os.getpid(),
+                "tid": record["tid"],
+                "args": {
+                    **record["args"],
+                    **record["counters"],
+                    "cpu": record.get("cpu"),
+                    "rss_delta_mb": record.get("rss_delta_mb"),
+                    "peak_rss_growth_mb": record.get("peak_rss_growth_mb"),
+                },
+            }
+            for record in sorted(self.spans, key=lambda i: i["start"])
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "totals": totals,
+            "process_peak_rss_mb": peak_rss_mb(),
+            "process_peak_rss_children_mb": peak_rss_mb("children"),
+        }
+
+    def write(self, path: str):
+        """
+        The write method saves the report as JSON and the cProfile stats of each profiled stage.
+
+        Args:
+            path (str): path of the JSON report, the stats are saved in {path}.{stage}.prof.
+        Returns:
+            list: paths of the files.
+        """
+        with open(path, "w", encoding="utf-8") as dst:
+            json.dump(self.report(), dst)
+        paths = [path]
+        root = path[:-5] if path.endswith(".json") else path
+        for stage, profile in self.cprofiles.items():
+            profile.dump_stats(f"{root}.{stage}.prof")
+            paths.append(f"{root}.{stage}.prof")
+        return paths
+
+
+def start_profiling(cprofile_stages=()):
+    """
+    The start_profiling function activates a profiler for span and count.
+
+    Args:
+        cprofile_stages (list): names of the spans profiled with cProfile.
+    Returns:
+        Profiler: the active profiler.
+    """
+    global _profiler
+    _profiler = Profiler(cprofile_stages)
+    return _profiler
+
+
+def stop_profiling():
+    """Deactivate the profiler, return it."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+@contextlib.contextmanager
+def profiling(path=None, cprofile_stages=()):
+    """
+    The profiling context manager activates a profiler and writes its report at the end, also after an error.
+
+    Args:
+        path (str): path of the JSON report, nothing is profiled without it.
+        cprofile_stages (list): names of the spans profiled with cProfile.
+    """
+    if not path:
+        yield None
+        return
+    profiler = start_profiling(cprofile_stages)
+    try:
+        yield profiler
+    finally:
+        stop_profiling()
+        for file_path in profiler.write(path):
+            logger.info(f"profile saved in {file_path}")
+
+
+def span(name: str, **args):
+    """Span of the active profiler, nothing is recorded without a profiler."""
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.span(name, **args)
+
+
+def count(name: str, value=1):
+    """Counter of the current span of the active profiler."""
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def add_span(name: str, start: float, wall: float, cpu=None, **args):
+    """Span measured in other process, recorded by the active profiler."""
+    if _profiler is not None:
+        _profiler.add_span(name, start, wall, cpu, **args)
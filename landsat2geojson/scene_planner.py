@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+
+import numpy as np
+import shapely
+
+from .constants import (
+    CLOUD_COST_WEIGHT,
+    PLANNER_MIN_AREA_M2,
+    SCENE_BAND_BYTES,
+    WATER_BANDS,
+)
+from .band_cache import band_key
+from .feature_utils import reproject_geoms
+from .search_cache import json_encode
+
+logger = logging.getLogger("__name__")
+
+# equal area projection, to compare the AOI covered by each scene
+AREA_CRS = 6933
+
+
+def download_bytes(scene: dict, bands: list, cache=None):
+    """
+    The download_bytes function estimates the bytes to download for the bands of a scene.
+
+    Args:
+        scene (dict): A scene.
+        bands (list): A list of bands.
+        cache (BandCache): Optional band cache, the cached bands are not downloaded.
+    Returns:
+        int: bytes, SCENE_BAND_BYTES by band that is not cached.
+    """
+    return sum(
+        SCENE_BAND_BYTES
+        for band in bands
+        if cache is None or not cache.contains(band_key(scene.get("display_id"), band))
+    )
+
+
+def scene_cost(scene: dict, bytes_: int, cloud_weight=CLOUD_COST_WEIGHT):
+    """
+    The scene_cost function gets the cost of selecting a scene, from its bytes and cloud cover.
+
+    Args:
+        scene (dict): A scene.
+        bytes_ (int): bytes to download for the scene.
+        cloud_weight (float): weight of the cloud cover, the cost grows by
+            1 + cloud_weight * cloud_cover / 100.
+    Returns:
+        float: cost in MB, a cached scene costs at least one MB.
+    """
+    cloud_cover = float(scene.get("cloud_cover", 100.0))
+    return max(bytes_ / 1024**2, 1.0) * (1 + cloud_weight * cloud_cover / 100)
+
+
+def _entry(scene, **values):
+    return {
+        "display_id": scene.get("display_id"),
+        "wrs_path": scene.get("wrs_path"),
+        "wrs_row": scene.get("wrs_row"),
+        "acquisition_date": scene.get("acquisition_date"),
+        "cloud_cover": float(scene.get("cloud_cover", 100.0)),
+        **values,
+    }
+
+
+def plan_scenes(
+    scenes: list,
+    geoms,
+    bands=WATER_BANDS,
+    cache=None,
+    cloud_weight=CLOUD_COST_WEIGHT,
+    min_area=PLANNER_MIN_AREA_M2,
+):
+    """
+    The plan_scenes function selects a near-minimal set of scenes that covers the features.
+
+    It is a greedy weighted set cover: each step selects the scene with most AOI not covered
+    yet by cost, until the AOI is covered or no scene adds more than min_area. The AOI is the
+    union of the features, the cost of a scene comes from its bytes to download and its
+    cloud cover. Several dates of the same path/row compete by their cost.
+
+    Args:
+        scenes (list): list of scenes, all the dates of each path/row.
+        geoms (np.ndarray): shapely geometries of the features.
+        bands (list): bands to download for each scene.
+        cache (BandCache): Optional band cache, the cached bands are not downloaded.
+        cloud_weight (float): weight of the cloud cover in the cost.
+        min_area (float): min AOI in square meters that a scene has to add.
+    Returns:
+        tuple: selected scenes in the order of selection, and the plan with the reasons.
+    """
+    aoi = reproject_geoms(
+        np.array([shapely.union_all(shapely.make_valid(np.asarray(geoms)))]),
+        4326,
+        AREA_CRS,
+    )[0]
+    footprints = reproject_geoms(
+        np.array([scene["spatial_coverage"] for scene in scenes], dtype=object),
+        4326,
+        AREA_CRS,
+    )
+    footprints = shapely.intersection(footprints, aoi)
+    bytes_ = np.array([download_bytes(scene, bands, cache) for scene in scenes])
+    costs = np.array(
+        [scene_cost(scene, b, cloud_weight) for scene, b in zip(scenes, bytes_)]
+    )
+
+    remaining = aoi
+    candidates = np.flatnonzero(shapely.area(footprints) > min_area)
+    selected = []
+    while len(candidates) and shapely.area(remaining) > min_area:
+        gains = shapely.area(shapely.intersection(footprints[candidates], remaining))
+        if gains.max() <= min_area:
+            break
+        # most new AOI by cost, the less cloudy on ties
+        best = max(
+            range(len(candidates)),
+            key=lambda n: (
+                gains[n] / costs[candidates[n]],
+                -float(scenes[candidates[n]].get("cloud_cover", 100.0)),
+            ),
+        )
+        idx = candidates[best]
+        selected.append((idx, gains[best]))
+        remaining = shapely.difference(remaining, footprints[idx])
+        candidates = np.delete(candidates, best)
+
+    aoi_area = shapely.area(aoi)
+    selected_ids = {idx for idx, _ in selected}
+    plan = {
+        "aoi_km2": aoi_area / 1e6,
+        "uncovered_km2": shapely.area(remaining) / 1e6,
+        "download_mb": float(bytes_[list(selected_ids)].sum()) / 1024**2,
+        "selected": [
+            _entry(
+                scenes[idx],
+                step=step,
+                aoi_km2=shapely.area(footprints[idx]) / 1e6,
+                new_km2=gain / 1e6,
+                aoi_fraction=gain / aoi_area if aoi_area else 0.0,
+                download_mb=float(bytes_[idx]) / 1024**2,
+                cost=float(costs[idx]),
+                reason="covers most new AOI by cost",
+            )
+            for step, (idx, gain) in enumerate(selected, 1)
+        ],
+        "skipped": [
+            _entry(
+                scene,
+                aoi_km2=shapely.area(footprints[idx]) / 1e6,
+                cost=float(costs[idx]),
+                reason=(
+                    "does not intersect the features"
+                    if shapely.area(footprints[idx]) <= min_area
+                    else "its AOI is covered by the selected scenes"
+                ),
+            )
+            for idx, scene in enumerate(scenes)
+            if idx not in selected_ids
+        ],
+    }
+    for line in explain_plan(plan):
+        logger.info(line)
+    return [scenes[idx] for idx, _ in selected], plan
+
+
+def explain_plan(plan: dict):
+    """
+    The explain_plan function describes a plan of plan_scenes.
+
+    Args:
+        plan (dict): plan of plan_scenes.
+    Returns:
+        list: lines of text.
+    """
+    lines = [
+        f"scene plan: {len(plan['selected'])} of {len(plan['selected']) + len(plan['skipped'])} scenes, "
+        f"{plan['download_mb']:.0f} MB to download, "
+        f"{plan['aoi_km2'] - plan['uncovered_km2']:.1f} of {plan['aoi_km2']:.1f} km2 covered"
+    ]
+    for entry in plan["selected"]:
+        lines.append(
+            f"  {entry['step']}. {entry['display_id']} path/row {entry['wrs_path']}/{entry['wrs_row']}, "
+            f"cloud {entry['cloud_cover']:.1f}%, +{entry['new_km2']:.1f} km2 "
+            f"({entry['aoi_fraction']:.1%} of the AOI), {entry['download_mb']:.0f} MB, "
+            f"cost {entry['cost']:.1f}"
+        )
+    for entry in plan["skipped"]:
+        lines.append(
+            f"  - {entry['display_id']} cloud {entry['cloud_cover']:.1f}%: {entry['reason']}"
+        )
+    return lines
+
+
+def scene_report(scenes: list, features: list, bands: list, cache=None):
+    """
+    The scene_report function summarizes the scenes of a run before downloading them.
+
+    Args:
+        scenes (list): list of scenes with the features they contain.
+        features (list): list of features, with their feature_index.
+        bands (list): bands to download for each scene.
+        cache (BandCache): Optional band cache, the cached bands are not downloaded.
+    Returns:
+        dict: report with the scenes, bands, estimated bytes and features of each scene.
+    """
+    report_scenes = []
+    assigned = set()
+    for scene in scenes:
+        features_contains = scene.get("features_contains", [])
+        indexes = [i.get("feature_index") for i in features_contains]
+        assigned.update(indexes)
+        report_scenes.append(
+            _entry(
+                scene,
+                bands=list(bands),
+                download_mb=download_bytes(scene, bands, cache) / 1024**2,
+                features=indexes,
+                contains=sum(i.get("status") == "contains" for i in features_contains),
+                intersects=sum(
+                    i.get("status") == "intersects" for i in features_contains
+                ),
+            )
+        )
+    return {
+        "scenes": report_scenes,
+        "bands": len(scenes) * len(bands),
+        "download_mb": sum(i["download_mb"] for i in report_scenes),
+        "features": len(features),
+        "unassigned_features": [
+            n for n, feature in enumerate(features) if n not in assigned
+        ],
+        # parts of these features are outside the scenes
+        "partial_features": [
+            n
+            for n, feature in enumerate(features)
+            if n in assigned and not feature.get("is_include")
+        ],
+    }
+
+
+def explain_report(report: dict):
+    """
+    The explain_report function describes a report of scene_report.
+
+    Args:
+        report (dict): report of scene_report.
+    Returns:
+        list: lines of text.
+    """
+    lines = [
+        f"{len(report['scenes'])} scenes, {report['bands']} bands, "
+        f"{report['download_mb']:.0f} MB to download (estimated, whole bands)"
+    ]
+    for entry in report["scenes"]:
+        lines.append(
+            f"  {entry['display_id']} path/row {entry['wrs_path']}/{entry['wrs_row']}, "
+            f"cloud {entry['cloud_cover']:.1f}%, {', '.join(entry['bands'])}, "
+            f"{entry['download_mb']:.0f} MB, {len(entry['features'])} features "
+            f"({entry['contains']} contained, {entry['intersects']} intersected)"
+        )
+    lines.append(
+        f"{report['features']} features, {len(report['unassigned_features'])} outside the scenes, "
+        f"{len(report['partial_features'])} partly outside"
+    )
+    return lines
+
+
+def write_plan(path: str, plan: dict):
+    """
+    The write_plan function saves a plan of plan_scenes, or a report of scene_report, as JSON.
+
+    Args:
+        path (str): path of the JSON file.
+        plan (dict): plan or report.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as dst:
+        dst.write(json.dumps(plan, default=json_encode, indent=2))
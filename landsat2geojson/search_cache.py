@@ -0,0 +1,239 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+
+from shapely.geometry import mapping, shape
+from shapely.geometry.base import BaseGeometry
+
+from .constants import SEARCH_CACHE_TTL_DAYS
+
+logger = logging.getLogger("__name__")
+
+SQLITE_TIMEOUT = 60
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def json_encode(value):
+    """JSON encoder for the values of landsatxplore results."""
+    if isinstance(value, BaseGeometry):
+        return {"$geometry": mapping(value)}
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def json_decode(value):
+    """JSON object hook for the values encoded by json_encode."""
+    if "$geometry" in value:
+        return shape(value["$geometry"])
+    if "$datetime" in value:
+        return datetime.fromisoformat(value["$datetime"])
+    if "$date" in value:
+        return date.fromisoformat(value["$date"])
+    return value
+
+
+def bbox_key(bbox: tuple):
+    """
+    The bbox_key function creates the key of a bbox for the cache.
+
+    Args:
+        bbox (tuple): A tuple os coords for bbox.
+    Returns:
+        str: coords rounded to 6 decimals.
+    """
+    return ",".join(f"{i:.6f}" for i in bbox)
+
+
+def _to_day(value: str):
+    return datetime.strptime(value, DATE_FORMAT).date()
+
+
+def _to_str(value: date):
+    return value.strftime(DATE_FORMAT)
+
+
+class SearchCache:
+    """SQLite cache of the scene searches, by dataset and bbox.
+
+    It keeps the scenes found and the acquisition date windows already searched, so a new
+    search only queries the dates that are not covered. Windows older than ttl_days are
+    searched again.
+    """
+
+    def __init__(self, path, ttl_days=SEARCH_CACHE_TTL_DAYS):
+        self.path = path
+        self.ttl = ttl_days * 86400
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS scenes (
+                    dataset TEXT NOT NULL,
+                    bbox TEXT NOT NULL,
+                    entity_id TEXT NOT NULL,
+                    acquisition_date TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (dataset, bbox, entity_id)
+                )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS coverage (
+                    dataset TEXT NOT NULL,
+                    bbox TEXT NOT NULL,
+                    start_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        return contextlib.closing(conn)
+
+    def _count(self, conn, name, value=1):
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, value),
+        )
+
+    def missing_windows(
+        self, dataset: str, bbox: tuple, start_date: str, end_date: str
+    ):
+        """
+        The missing_windows method gets the date windows that are not covered by the cache.
+
+        Args:
+            dataset (str): dataset name.
+            bbox (tuple): A tuple os coords for bbox.
+            start_date (str): YYYY-MM-DD.
+            end_date (str): YYYY-MM-DD, included.
+        Returns:
+            list: list of (start_date, end_date) tuples to search.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT start_date, end_date FROM coverage "
+                "WHERE dataset = ? AND bbox = ? AND fetched_at >= ? "
+                "AND end_date >= ? AND start_date <= ? ORDER BY start_date",
+                (
+                    dataset,
+                    bbox_key(bbox),
+                    time.time() - self.ttl,
+                    start_date,
+                    end_date,
+                ),
+            ).fetchall()
+        windows = []
+        cursor = _to_day(start_date)
+        end = _to_day(end_date)
+        for covered_start, covered_end in rows:
+            covered_start, covered_end = _to_day(covered_start), _to_day(covered_end)
+            if covered_start > cursor:
+                windows.append((cursor, min(covered_start - timedelta(days=1), end)))
+            cursor = max(cursor, covered_end + timedelta(days=1))
+            if cursor > end:
+                break
+        if cursor <= end:
+            windows.append((cursor, end))
+        return [(_to_str(i), _to_str(j)) for i, j in windows]
+
+    def add(
+        self,
+        dataset: str,
+        bbox: tuple,
+        start_date: str,
+        end_date: str,
+        scenes: list,
+        complete=True,
+    ):
+        """
+        The add method stores the scenes of a search, and the window as covered if the search is complete.
+
+        Args:
+            dataset (str): dataset name.
+            bbox (tuple): A tuple os coords for bbox.
+            start_date (str): YYYY-MM-DD.
+            end_date (str): YYYY-MM-DD, included.
+            scenes (list): list of scenes found.
+            complete (bool): False if the search hit the limit of results.
+        """
+        now = time.time()
+        key = bbox_key(bbox)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        dataset,
+                        key,
+                        str(scene.get("entity_id")),
+                        _acquisition_date(scene),
+                        json.dumps(scene, default=json_encode),
+                        now,
+                    )
+                    for scene in scenes
+                ],
+            )
+            if complete:
+                conn.execute(
+                    "INSERT INTO coverage VALUES (?, ?, ?, ?, ?)",
+                    (dataset, key, start_date, end_date, now),
+                )
+            # expired windows are not used anymore
+            conn.execute("DELETE FROM coverage WHERE fetched_at < ?", (now - self.ttl,))
+            self._count(conn, "windows_queried")
+            self._count(conn, "scenes_fetched", len(scenes))
+            conn.execute("COMMIT")
+
+    def scenes(self, dataset: str, bbox: tuple, start_date: str, end_date: str):
+        """
+        The scenes method gets the cached scenes acquired between two dates.
+
+        Args:
+            dataset (str): dataset name.
+            bbox (tuple): A tuple os coords for bbox.
+            start_date (str): YYYY-MM-DD.
+            end_date (str): YYYY-MM-DD, included.
+        Returns:
+            list: list of scenes, the newest first.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT data FROM scenes WHERE dataset = ? AND bbox = ? "
+                "AND acquisition_date >= ? AND acquisition_date <= ? "
+                "ORDER BY acquisition_date DESC",
+                (dataset, bbox_key(bbox), start_date, end_date),
+            ).fetchall()
+            self._count(conn, "searches")
+            self._count(conn, "scenes_served", len(rows))
+        return [json.loads(row[0], object_hook=json_decode) for row in rows]
+
+    def stats(self):
+        """Counters of the cache and number of scenes and windows stored."""
+        with self._connect() as conn:
+            stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+            stats["scenes"] = conn.execute("SELECT COUNT(*) FROM scenes").fetchone()[0]
+            stats["windows"] = conn.execute(
+                "SELECT COUNT(*) FROM coverage WHERE fetched_at >= ?",
+                (time.time() - self.ttl,),
+            ).fetchone()[0]
+        return stats
+
+
+def _acquisition_date(scene: dict):
+    value = scene.get("acquisition_date")
+    if isinstance(value, (date, datetime)):
+        return value.strftime(DATE_FORMAT)
+    return str(value)[:10]
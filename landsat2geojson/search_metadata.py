@@ -1,35 +1,86 @@
+import logging
 from datetime import datetime, timedelta
 
-from landsatxplore.api import API
+from .constants import (
+    CREDENTIAL_CACHE_PATH,
+    DAYS_AGO,
+    LIMIT_QUERY,
+    SEARCH_CACHE_SETTLE_DAYS,
+)
+from .session import get_session
 
-from .constants import DAYS_AGO, LIMIT_QUERY
+logger = logging.getLogger("__name__")
 
+DATASET = "landsat_ot_c2_l2"
 
-def wraper_landsadxplore(username: str, password: str, bbox: tuple):
+
+def wraper_landsadxplore(
+    username: str,
+    password: str,
+    bbox: tuple,
+    cache=None,
+    api=None,
+    credential_cache=CREDENTIAL_CACHE_PATH,
+):
     """
     The wraper_landsadxplore function get the data to know which landsat scenes are available according to a bbox.
 
+    With a cache, only the date windows that are not cached are searched, the last
+    SEARCH_CACHE_SETTLE_DAYS days are always searched again because new scenes are
+    still being published for them.
+
     Args:
         username (str): username for earthexplorer.
         password (str):  password for earthexplorer.
         bbox (tuple): A tuple os coords for bbox.
+        cache (SearchCache): Optional cache of the searches.
+        api (API): Optional logged API shared by several searches.
+        credential_cache (str): path of the credential cache of the session, without api.
 
     Returns:
          dict : The json response.
     """
-    api = API(username, password)
     today = datetime.today()
     end = (today - timedelta(days=DAYS_AGO)).strftime("%Y-%m-%d")
     where = {
-        "dataset": "landsat_ot_c2_l2",
+        "dataset": DATASET,
         "bbox": bbox,
         "start_date": end,
         "end_date": today.strftime("%Y-%m-%d"),
         "max_results": LIMIT_QUERY,
     }
-    results = api.search(**where)
-    api.logout()
-    return results
+    if cache is None:
+        api = api or get_session(username, password, credential_cache).api()
+        return api.search(**where)
+
+    windows = cache.missing_windows(
+        DATASET, bbox, where["start_date"], where["end_date"]
+    )
+    if windows:
+        settled_end = (today - timedelta(days=SEARCH_CACHE_SETTLE_DAYS)).strftime(
+            "%Y-%m-%d"
+        )
+        api = api or get_session(username, password, credential_cache).api()
+        for start_date, end_date in windows:
+            results = api.search(
+                **{**where, "start_date": start_date, "end_date": end_date}
+            )
+            complete = len(results) < LIMIT_QUERY
+            if not complete:
+                logger.warning(
+                    f"search {start_date} {end_date} reached {LIMIT_QUERY} results, it will not be cached as complete"
+                )
+            cache.add(
+                DATASET,
+                bbox,
+                start_date,
+                min(end_date, settled_end),
+                results,
+                complete=complete and start_date <= settled_end,
+            )
+    results = cache.scenes(DATASET, bbox, where["start_date"], where["end_date"])
+    logger.info(f"search cache: {len(windows)} windows searched, {cache.stats()}")
+    return results[:LIMIT_QUERY]
 
 
 # search --dataset landsat_ot_c2_l2 --location 12.53 -1.53 --start 2022-01-01 --end 2022-12-31
@@ -0,0 +1,222 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from landsatxplore.api import API, API_URL
+from landsatxplore.earthexplorer import EarthExplorer
+from landsatxplore.errors import USGSAuthenticationError
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from .constants import CREDENTIAL_CACHE_PATH, SESSION_TTL_HOURS
+from .profiling import count
+
+logger = logging.getLogger("__name__")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _cookies(jar):
+    return [
+        {
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "secure": cookie.secure,
+            "expires": cookie.expires,
+        }
+        for cookie in jar
+    ]
+
+
+class SessionAPI(API):
+    """API of EarthExplorer with the token of a session manager.
+
+    A request rejected by an invalid token gets a new token from the manager and it is
+    sent again, so a token that expired in the server is refreshed transparently.
+    """
+
+    def __init__(self, manager):
+        self.url = API_URL
+        self.session = requests.Session()
+        self.manager = manager
+        self.session.headers["X-Auth-Token"] = manager.api_token()
+
+    def request(self, endpoint, params=None):
+        try:
+            return super().request(endpoint, params)
+        except USGSAuthenticationError:
+            token = self.manager.api_token(
+                rejected=self.session.headers["X-Auth-Token"]
+            )
+            self.session.headers["X-Auth-Token"] = token
+            return super().request(endpoint, params)
+
+    def logout(self):
+        """The token is shared by the processes of the run, it expires by itself."""
+
+
+class SessionManager:
+    """Login of EarthExplorer shared by the searches and the downloads.
+
+    It keeps the API token and the cookies of the web session, and persists them in a
+    credential cache with their expiry, so the threads and the processes of a run, and
+    the next runs, log in once. A file lock serializes the logins between processes.
+    """
+
+    def __init__(
+        self,
+        username,
+        password,
+        cache_path=CREDENTIAL_CACHE_PATH,
+        ttl_hours=SESSION_TTL_HOURS,
+    ):
+        self.username = username
+        self.password = password
+        self.cache_path = cache_path
+        self.ttl = ttl_hours * 3600
+        self.key = hashlib.sha256(username.encode()).hexdigest()
+        self.lock = threading.Lock()
+        self.credentials = {}
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None or not self.cache_path:
+            yield
+            return
+        with open(f"{self.cache_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, encoding="utf-8") as src:
+                return json.load(src)
+        except (OSError, ValueError):
+            # missing or cut file
+            return {}
+
+    def _write(self, name, value):
+        self.credentials[name] = value
+        if not self.cache_path:
+            return
+        data = self._read()
+        data.setdefault(self.key, {})[name] = value
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        # the token and the cookies are secrets
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as dst:
+            json.dump(data, dst)
+        os.replace(tmp_path, self.cache_path)
+
+    def _valid(self, name, rejected=None):
+        """Credential of the memory or the cache that did not expire and was not rejected."""
+        for source in (self.credentials, self._read().get(self.key, {})):
+            value = source.get(name)
+            if value and value["expires"] > time.time() and value["value"] != rejected:
+                self.credentials[name] = value
+                return value["value"]
+        return None
+
+    def _get(self, name, login, rejected=None):
+        value = self._valid(name, rejected)
+        if value is not None:
+            return value
+        with self.lock:
+            if self.cache_path:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            with self._file_lock():
+                # other thread or process may have logged in while waiting
+                value = self._valid(name, rejected)
+                if value is None:
+                    logger.info(f"EarthExplorer login: {name}")
+                    count(f"{name}_logins")
+                    value = login()
+                    self._write(
+                        name, {"value": value, "expires": time.time() + self.ttl}
+                    )
+        return value
+
+    def _api_login(self):
+        api = API.__new__(API)
+        api.url = API_URL
+        api.session = requests.Session()
+        api.login(self.username, self.password)
+        return api.session.headers["X-Auth-Token"]
+
+    def _web_login(self):
+        ee = EarthExplorer.__new__(EarthExplorer)
+        ee.session = requests.Session()
+        ee.login(self.username, self.password)
+        return _cookies(ee.session.cookies)
+
+    def api_token(self, rejected=None):
+        """
+        The api_token method gets a valid token of the API, it logs in only without one.
+
+        Args:
+            rejected (str): Optional token rejected by the API, it is not reused.
+        Returns:
+            str: the token.
+        """
+        return self._get("api", self._api_login, rejected)
+
+    def api(self):
+        """API with the token of the manager."""
+        return SessionAPI(self)
+
+    def web_cookies(self, session: requests.Session, rejected=None):
+        """
+        The web_cookies method sets the cookies of a valid web session in a requests session.
+
+        Args:
+            session (requests.Session): session of the downloads.
+            rejected (list): Optional cookies rejected by the server, they are not reused.
+        Returns:
+            list: the cookies, to pass them as rejected.
+        """
+        cookies = self._get("web", self._web_login, rejected)
+        session.cookies.clear()
+        for cookie in cookies:
+            session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie["domain"],
+                path=cookie["path"],
+                secure=cookie["secure"],
+                expires=cookie["expires"],
+            )
+        return cookies
+
+
+def get_session(username, password, cache_path=CREDENTIAL_CACHE_PATH):
+    """
+    The get_session function gets the session manager of the process for a user.
+
+    Args:
+        username (str): username for earthexplorer.
+        password (str):  password for earthexplorer.
+        cache_path (str): path of the credential cache, None to keep them only in memory.
+    Returns:
+        SessionManager: the same manager for the same user and cache.
+    """
+    with _sessions_lock:
+        key = (username, cache_path)
+        if key not in _sessions:
+            _sessions[key] = SessionManager(username, password, cache_path)
+        return _sessions[key]
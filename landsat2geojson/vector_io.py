@@ -0,0 +1,572 @@
+import json
+import logging
+import os
+
+import numpy as np
+import shapely
+
+from .feature_utils import GEOJSON_TYPES, fc2geoms
+
+logger = logging.getLogger("__name__")
+
+READ_CHUNK_SIZE = 1 << 20
+RECORD_SEPARATOR = "\x1e"
+GEOJSONSEQ_EXTENSIONS = (".geojsonl", ".geojsons", ".geojsonseq", ".jsonl", ".ndjson")
+JSON_SEPARATORS = (",", ":")
+# extension of the files written by each driver
+DRIVER_EXTENSIONS = {
+    "GeoJSON": ".geojson",
+    "GeoJSONSeq": ".geojsonl",
+    "FlatGeobuf": ".fgb",
+    "GeoParquet": ".parquet",
+}
+# features converted at a time, the row groups of GeoParquet
+WRITE_BATCH_SIZE = 10000
+
+
+class _JSONStream:
+    """Incremental reader of JSON values from a text file."""
+
+    def __init__(self, file_, chunk_size=READ_CHUNK_SIZE):
+        self.file = file_
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        """Append the next chunk of the file to the buffer, return False at the end of the file."""
+        if self.eof:
+            return False
+        chunk = self.file.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next character that is not a whitespace, without consuming it."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        """Consume the next character, it must be char."""
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Invalid JSON, expected {char!r} found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode and consume the next JSON value.
+
+        A value that is not complete in the buffer is decoded again after each read, the
+        reads double in size so a value much bigger than a chunk, like a polygon with many
+        vertices, is decoded a few times instead of once for each chunk.
+        """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number can be cut at the end of the buffer
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            size *= 2
+
+
+def _iter_feature_collection(stream):
+    """
+    The _iter_feature_collection function yields the features of a FeatureCollection one by one.
+
+    The top level members other than features are decoded whole, the features array is
+    decoded one element at a time, so only one feature is held in memory.
+
+    Args:
+        stream (_JSONStream): stream positioned at the start of the FeatureCollection.
+    Yields:
+        dict: A feature.
+    """
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if key != "features":
+            value = stream.value()
+            if key == "type" and value == "Feature":
+                raise ValueError("Expected a FeatureCollection, found a Feature")
+        else:
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.peek() == "]":
+                        stream.expect("]")
+                        break
+                    stream.expect(",")
+        if stream.peek() == "}":
+            return
+        stream.expect(",")
+
+
+def _iter_geojsonseq(file_):
+    """
+    The _iter_geojsonseq function yields the features of a newline delimited GeoJSON file.
+
+    Args:
+        file_ (file): text file object.
+    Yields:
+        dict: A feature.
+    """
+    for line in file_:
+        line = line.strip().lstrip(RECORD_SEPARATOR).strip()
+        if line:
+            yield json.loads(line)
+
+
+def _is_geojsonseq(path: str, file_):
+    """
+    The _is_geojsonseq function checks if a file is a GeoJSON text sequence.
+
+    The extension is used when it is known, otherwise the first line is checked,
+    a GeoJSONSeq file starts with a record separator or a complete Feature.
+
+    Args:
+        path (str): path of file.
+        file_ (file): text file object, the position is restored.
+    Returns:
+        bool: True if the file is a GeoJSONSeq.
+    """
+    if path.lower().endswith(GEOJSONSEQ_EXTENSIONS):
+        return True
+    start = file_.tell()
+    line = file_.readline(READ_CHUNK_SIZE)
+    file_.seek(start)
+    if line.lstrip().startswith(RECORD_SEPARATOR):
+        return True
+    try:
+        return json.loads(line).get("type") == "Feature"
+    except (json.JSONDecodeError, AttributeError):
+        return False
+
+
+def read_features(path: str):
+    """
+    The read_features function yields the features of a FeatureCollection or a GeoJSONSeq file incrementally.
+
+    Args:
+        path (str): path of the GeoJSON or GeoJSONSeq file.
+    Yields:
+        dict: A feature.
+    """
+    with open(path, encoding="utf-8") as file_:
+        if _is_geojsonseq(path, file_):
+            yield from _iter_geojsonseq(file_)
+        else:
+            yield from _iter_feature_collection(_JSONStream(file_))
+
+
+class FeatureWriter:
+    """Write features one by one to a FeatureCollection or a GeoJSONSeq file."""
+
+    def __init__(self, path, driver=None, crs=None):
+        self.path = path
+        self.driver = driver or guess_driver(path)
+        self.crs = crs
+        self.count = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "w", encoding="utf-8")
+        if self.driver == "GeoJSON":
+            self.file.write('{"type":"FeatureCollection",')
+            if self.crs:
+                self.file.write(f'"crs":{_dumps(self.crs)},')
+            self.file.write('"features":[')
+        return self
+
+    def write(self, feature: dict):
+        if self.driver == "GeoJSON":
+            if self.count:
+                self.file.write(",")
+            self.file.write("\n")
+            self.file.write(_dumps(feature))
+        else:
+            self.file.write(_dumps(feature))
+            self.file.write("\n")
+        self.count += 1
+
+    def write_many(self, features):
+        for feature in features:
+            self.write(feature)
+        return self.count
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.driver == "GeoJSON":
+            self.file.write("\n]}\n")
+        self.file.close()
+
+
+def _dumps(value):
+    return json.dumps(value, separators=JSON_SEPARATORS)
+
+
+def guess_driver(path: str):
+    """
+    The guess_driver function gets the output format from the extension of a file.
+
+    Args:
+        path (str): path of file.
+    Returns:
+        str: GeoJSONSeq for newline delimited extensions, FlatGeobuf for .fgb, GeoParquet for .parquet, GeoJSON otherwise.
+    """
+    path = path.lower()
+    if path.endswith(GEOJSONSEQ_EXTENSIONS):
+        return "GeoJSONSeq"
+    if path.endswith(".fgb"):
+        return "FlatGeobuf"
+    if path.endswith((".parquet", ".geoparquet")):
+        return "GeoParquet"
+    return "GeoJSON"
+
+
+def output_path(path: str, driver=None):
+    """
+    The output_path function changes the extension of a path to the extension of a driver.
+
+    Args:
+        path (str): path of file.
+        driver (str): output format, the path is not changed if it is None or the extension is of the driver.
+    Returns:
+        str: path of the file.
+    """
+    if not driver or guess_driver(path) == driver:
+        return path
+    return f"{os.path.splitext(path)[0]}{DRIVER_EXTENSIONS[driver]}"
+
+
+def crs_epsg(crs):
+    """
+    The crs_epsg function gets the epsg code of the crs member of a FeatureCollection.
+
+    Args:
+        crs (dict|int): crs member, like urn:ogc:def:crs:EPSG::32618, or an epsg code.
+    Returns:
+        int: epsg code, 4326 if crs is None.
+    """
+    if crs is None:
+        return 4326
+    if isinstance(crs, dict):
+        return int(str(crs.get("properties", {}).get("name")).split(":")[-1])
+    return int(crs)
+
+
+def _field_array(values: list):
+    """
+    The _field_array function converts the values of a property to a numpy array.
+
+    Args:
+        values (list): values of a property, None if the feature does not have it.
+    Returns:
+        np.ndarray: bool, int64 or float64 array when all the values are of that type, strings otherwise.
+    """
+    present = [i for i in values if i is not None]
+    complete = len(present) == len(values)
+    if present and complete and all(isinstance(i, bool) for i in present):
+        return np.array(values, dtype=bool)
+    numbers = present and all(
+        isinstance(i, (int, float)) and not isinstance(i, bool) for i in present
+    )
+    if numbers and complete and all(isinstance(i, int) for i in present):
+        return np.array(values, dtype="int64")
+    if numbers:
+        return np.array([np.nan if i is None else i for i in values], dtype="float64")
+    return np.array(
+        [i if i is None or isinstance(i, str) else _dumps(i) for i in values],
+        dtype=object,
+    )
+
+
+class _FlatGeobufWriter:
+    """Write features to a FlatGeobuf file with its packed R-tree, with pyogrio.
+
+    The packed R-tree is built over all the features, so they are buffered as WKB and
+    written when the writer is closed.
+    """
+
+    def __init__(self, path, crs=None):
+        self.path = path
+        self.crs = crs
+        self.count = 0
+        self.wkb = []
+        self.properties = []
+        self.types = set()
+
+    def __enter__(self):
+        return self
+
+    def write(self, feature: dict):
+        self.write_many([feature])
+
+    def write_many(self, features):
+        batch = []
+        for feature in features:
+            batch.append(feature)
+            if len(batch) == WRITE_BATCH_SIZE:
+                self._add(batch)
+                batch = []
+        if batch:
+            self._add(batch)
+        return self.count
+
+    def _add(self, features):
+        geoms = fc2geoms(features)
+        self.types.update(shapely.get_type_id(geoms).tolist())
+        self.wkb.extend(shapely.to_wkb(geoms))
+        self.properties.extend(i.get("properties") or {} for i in features)
+        self.count += len(features)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return
+        from pyogrio.raw import write
+
+        fields = list(dict.fromkeys(k for i in self.properties for k in i))
+        write(
+            self.path,
+            np.array(self.wkb, dtype=object),
+            [_field_array([i.get(k) for i in self.properties]) for k in fields],
+            fields,
+            driver="FlatGeobuf",
+            geometry_type=(
+                GEOJSON_TYPES.get(next(iter(self.types)), "Unknown")
+                if len(self.types) == 1
+                else "Unknown"
+            ),
+            crs=f"EPSG:{crs_epsg(self.crs)}",
+            layer_options={"SPATIAL_INDEX": "YES"},
+        )
+
+
+def _arrow_column(pa, values: list):
+    """
+    The _arrow_column function converts the values of a property to an arrow array, None are nulls.
+
+    Args:
+        values (list): values of a property, None if the feature does not have it.
+    Returns:
+        pa.Array: bool, int64 or float64 array when all the values are of that type, strings otherwise.
+    """
+    present = [i for i in values if i is not None]
+    if not present:
+        return pa.nulls(len(values))
+    if all(isinstance(i, bool) for i in present):
+        return pa.array(values, type=pa.bool_())
+    if all(isinstance(i, (int, float)) and not isinstance(i, bool) for i in present):
+        numbers = all(isinstance(i, int) for i in present)
+        return pa.array(values, type=pa.int64() if numbers else pa.float64())
+    return pa.array(
+        [i if i is None or isinstance(i, str) else _dumps(i) for i in values],
+        type=pa.string(),
+    )
+
+
+def _unify_types(pa, types: list):
+    """Common type of the row groups of a property, the numbers are widened and other conflicts are strings."""
+    unified = types[0]
+    for type_ in types[1:]:
+        try:
+            unified = pa.unify_schemas(
+                [pa.schema([("value", unified)]), pa.schema([("value", type_)])],
+                promote_options="permissive",
+            ).field("value").type
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            return pa.string()
+    return unified
+
+
+class _GeoParquetWriter:
+    """Write features to a GeoParquet file, one row group for each batch of features.
+
+    The geometries are WKB with a bbox column for the covering of GeoParquet 1.1, so the
+    readers can skip the row groups out of a bbox. Each property is a typed column. The
+    properties of the features are not known before they are written, so each batch is
+    spooled to a parquet file with its own schema, and when the writer is closed the
+    schemas are unified and the row groups are copied to the file, the properties that a
+    batch does not have are null.
+    """
+
+    GEOMETRY_COLUMNS = ("geometry", "bbox")
+
+    def __init__(self, path, crs=None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(
+                "The GeoParquet format needs pyarrow, install it with: pip install landsat2geojson[parquet]"
+            )
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.crs = crs
+        self.count = 0
+        self.spool_dir = None
+        self.parts = []
+        self.bbox_type = pa.struct(
+            [(i, pa.float64()) for i in ("xmin", "ymin", "xmax", "ymax")]
+        )
+
+    def _geo_metadata(self):
+        column = {
+            "encoding": "WKB",
+            "geometry_types": [],
+            "covering": {
+                "bbox": {i: ["bbox", i] for i in ("xmin", "ymin", "xmax", "ymax")}
+            },
+        }
+        epsg = crs_epsg(self.crs)
+        if epsg != 4326:
+            from pyproj import CRS
+
+            column["crs"] = CRS.from_epsg(epsg).to_json_dict()
+        return {
+            "version": "1.1.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": column},
+        }
+
+    def __enter__(self):
+        import tempfile
+
+        self.spool_dir = tempfile.mkdtemp(
+            prefix=".spool_", dir=os.path.dirname(os.path.abspath(self.path))
+        )
+        return self
+
+    def write(self, feature: dict):
+        self.write_many([feature])
+
+    def write_many(self, features):
+        batch = []
+        for feature in features:
+            batch.append(feature)
+            if len(batch) == WRITE_BATCH_SIZE:
+                self._write_row_group(batch)
+                batch = []
+        if batch:
+            self._write_row_group(batch)
+        return self.count
+
+    def _column_name(self, key):
+        # a property can not replace the geometry columns
+        return f"{key}_property" if key in self.GEOMETRY_COLUMNS else key
+
+    def _write_row_group(self, features):
+        pa = self.pa
+        geoms = fc2geoms(features)
+        bounds = shapely.bounds(geoms)
+        properties = [i.get("properties") or {} for i in features]
+        keys = list(dict.fromkeys(k for i in properties for k in i))
+        columns = {
+            "geometry": pa.array(shapely.to_wkb(geoms), type=pa.binary()),
+            "bbox": pa.StructArray.from_arrays(
+                [pa.array(bounds[:, i]) for i in range(4)],
+                fields=list(self.bbox_type),
+            ),
+        }
+        for key in keys:
+            columns[self._column_name(key)] = _arrow_column(
+                pa, [i.get(key) for i in properties]
+            )
+        part = os.path.join(self.spool_dir, f"{len(self.parts):06d}.parquet")
+        self.pq.write_table(pa.table(columns), part)
+        self.parts.append(part)
+        self.count += len(features)
+
+    def _schema(self, schemas):
+        pa = self.pa
+        types = {}
+        for schema in schemas:
+            for field in schema:
+                if field.name not in self.GEOMETRY_COLUMNS:
+                    types.setdefault(field.name, []).append(field.type)
+        return pa.schema(
+            [("geometry", pa.binary()), ("bbox", self.bbox_type)]
+            + [(name, _unify_types(pa, i)) for name, i in types.items()],
+            metadata={"geo": json.dumps(self._geo_metadata())},
+        )
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import shutil
+
+        try:
+            if exc_type is None:
+                self._write()
+        finally:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def _write(self):
+        pa = self.pa
+        schema = self._schema([self.pq.read_schema(i) for i in self.parts])
+        with self.pq.ParquetWriter(self.path, schema) as writer:
+            for part in self.parts:
+                table = self.pq.read_table(part)
+                table = pa.table(
+                    [
+                        (
+                            table.column(field.name).cast(field.type)
+                            if field.name in table.column_names
+                            else pa.nulls(table.num_rows, type=field.type)
+                        )
+                        for field in schema
+                    ],
+                    schema=schema,
+                )
+                writer.write_table(table, row_group_size=table.num_rows)
+
+
+WRITERS = {
+    "FlatGeobuf": _FlatGeobufWriter,
+    "GeoParquet": _GeoParquetWriter,
+}
+
+
+def write_features(path: str, features, driver=None, crs=None):
+    """
+    The write_features function streams an iterable of features to a file.
+
+    Args:
+        path (str): path of the output file.
+        features (iterable): features to write, it can be a generator.
+        driver (str): GeoJSON, GeoJSONSeq, FlatGeobuf or GeoParquet, guessed from the extension by default.
+        crs (dict): Optional crs member of the FeatureCollection.
+    Returns:
+        int: number of features written.
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    driver = driver or guess_driver(path)
+    if driver in WRITERS:
+        writer = WRITERS[driver](path, crs=crs)
+    else:
+        writer = FeatureWriter(path, driver=driver, crs=crs)
+    with writer:
+        return writer.write_many(features)
@@ -0,0 +1,514 @@
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import click
+
+from .checkpoint import write_json
+from .constants import (
+    BAND_CACHE_MAX_BYTES,
+    BAND_STORE_DIR,
+    CREDENTIAL_CACHE_PATH,
+    QUEUE_LEASE_SECONDS,
+    QUEUE_MAX_ATTEMPTS,
+    QUEUE_POLL_SECONDS,
+)
+from .search_cache import json_decode, json_encode
+
+logger = logging.getLogger("__name__")
+
+SQLITE_TIMEOUT = 60
+QUEUE_NAME = "queue.sqlite"
+
+
+def worker_id():
+    """Id of the worker, with its host and process."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Durable queue of tasks in a SQLite database, shared by the workers of several hosts.
+
+    A worker leases a task for lease_seconds and extends the lease with heartbeats while it
+    runs. The task of a worker that dies is leased again when its lease expires, a task is
+    failed after max_attempts leases. The results are saved as JSON files in the results
+    folder, the folder has to be in a filesystem with working locks for several hosts.
+    """
+
+    def __init__(self, root, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.root = root
+        self.max_attempts = max_attempts
+        self.results_dir = os.path.join(root, "results")
+        os.makedirs(self.results_dir, exist_ok=True)
+        with self._connect() as conn:
+            # the rollback journal works over network filesystems, WAL needs a single host
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                    id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    owner TEXT,
+                    lease_expires REAL,
+                    error TEXT,
+                    updated_at REAL NOT NULL
+                )""")
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            os.path.join(self.root, QUEUE_NAME),
+            timeout=SQLITE_TIMEOUT,
+            isolation_level=None,
+        )
+        return contextlib.closing(conn)
+
+    def result_path(self, task_id):
+        """Path of the JSON result of a task."""
+        return os.path.join(self.results_dir, f"{task_id}.json")
+
+    def enqueue(self, task_id: str, payload: dict):
+        """
+        The enqueue method adds a task, a done task is kept and a failed task is retried.
+
+        Args:
+            task_id (str): id of the task, like the fingerprint of its inputs.
+            payload (dict): inputs of the task, JSON serializable or geometries and dates.
+        """
+        data = json.dumps(payload, default=json_encode)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO tasks (id, payload, status, attempts, updated_at) VALUES (?, ?, 'pending', 0, ?)",
+                (task_id, data, time.time()),
+            )
+            conn.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, error = NULL WHERE id = ? AND status = 'failed'",
+                (task_id,),
+            )
+
+    def lease(self, owner: str, lease_seconds=QUEUE_LEASE_SECONDS):
+        """
+        The lease method takes a pending task, or a task whose lease expired.
+
+        Args:
+            owner (str): id of the worker.
+            lease_seconds (float): seconds of the lease without heartbeats.
+        Returns:
+            tuple: task id and payload, None when no task is available.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # the tasks of dead workers failed too many times
+            conn.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired', updated_at = ? "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT id, payload FROM tasks WHERE status = 'pending' "
+                "OR (status = 'running' AND lease_expires < ?) ORDER BY updated_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'running', attempts = attempts + 1, owner = ?, "
+                "lease_expires = ?, updated_at = ? WHERE id = ?",
+                (owner, now + lease_seconds, now, row[0]),
+            )
+            conn.execute("COMMIT")
+        return row[0], json.loads(row[1], object_hook=json_decode)
+
+    def heartbeat(self, task_id, owner, lease_seconds=QUEUE_LEASE_SECONDS):
+        """Extend the lease of a running task, False if the worker lost it."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time() + lease_seconds, task_id, owner),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, task_id, owner, result):
+        """
+        The complete method saves the result of a task and marks it as done.
+
+        Args:
+            task_id (str): id of the task.
+            owner (str): id of the worker, the result of a lost lease is discarded.
+            result (object): result of the task, JSON serializable or geometries and dates.
+        Returns:
+            bool: True if the task was completed by the worker.
+        """
+        path = self.result_path(task_id)
+        # the result is moved to its path only if the worker still has the lease
+        owner_path = f"{path}.{owner.replace(':', '_')}"
+        write_json(owner_path, result)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'done', owner = NULL, error = NULL, updated_at = ? "
+                "WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time(), task_id, owner),
+            )
+            done = cursor.rowcount == 1
+            if done:
+                os.replace(owner_path, path)
+            conn.execute("COMMIT")
+        if not done:
+            os.remove(owner_path)
+            logger.warning(f"task {task_id} was leased by other worker")
+        return done
+
+    def fail(self, task_id, owner, error):
+        """Release a task that failed, it is retried until max_attempts."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "owner = NULL, error = ?, updated_at = ? WHERE id = ? AND owner = ?",
+                (self.max_attempts, str(error), time.time(), task_id, owner),
+            )
+
+    def status(self, task_ids=None):
+        """Status and error of the tasks, by id."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, status, error FROM tasks").fetchall()
+        return {
+            task_id: {"status": status, "error": error}
+            for task_id, status, error in rows
+            if task_ids is None or task_id in task_ids
+        }
+
+    def stats(self, task_ids=None):
+        """Number of tasks by status."""
+        stats = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        for task in self.status(task_ids).values():
+            stats[task["status"]] += 1
+        return stats
+
+    def result(self, task_id):
+        """Result of a done task."""
+        with open(self.result_path(task_id), encoding="utf-8") as src:
+            return json.load(src, object_hook=json_decode)
+
+
+def run_task(
+    payload: dict,
+    username=None,
+    password=None,
+    cache_dir=None,
+    band_store_dir=BAND_STORE_DIR,
+    **kwargs,
+):
+    """
+    The run_task function downloads the bands of a scene and calculates its indices.
+
+    Args:
+        payload (dict): task of scene_task.
+        username (str): username for earthexplorer.
+        password (str):  password for earthexplorer.
+        cache_dir (str): Optional band cache of the worker, instead of the one of the task.
+        band_store_dir (str): folder of the band store of the task, empty to disable it.
+        kwargs: other options of download_scenes, like credential_cache.
+    Returns:
+        dict: the indices of the scene without the arrays, like the scene checkpoints.
+    """
+    from .band_store import BandStore
+    from .download_band import download_scenes
+    from .indices import get_indices, required_bands
+    from .process_landsat import calculate_indices_feature
+
+    options = payload["options"]
+    indices = get_indices(payload["landsat_index"])
+    band_store = BandStore(band_store_dir) if band_store_dir else None
+    try:
+        scenes = download_scenes(
+            username,
+            password,
+            [payload["scene"]],
+            required_bands(indices),
+            payload["data_folder"],
+            partial=options["partial_read"],
+            download_url=options["download_url"],
+            cache_dir=cache_dir or options["cache_dir"],
+            cache_max_bytes=options["cache_max_bytes"],
+            n_jobs=options["download_workers"],
+            max_per_host=options["max_per_host"],
+            engine=options["download_engine"],
+            band_store=band_store,
+            **kwargs,
+        )
+        scenes = calculate_indices_feature(
+            scenes,
+            indices,
+            payload["data_folder"],
+            block_size=options["block_size"],
+            simplify_tolerance=options["simplify_tolerance"],
+            min_area=options["min_area"],
+            precision=options["coord_precision"],
+            output_format=options["output_format"],
+            band_store=band_store,
+        )
+    finally:
+        if band_store:
+            band_store.close()
+    return {
+        key: {k: v for k, v in result.items() if k != "index_result"}
+        for key, result in scenes[0].get("raw_data").get("index").items()
+    }
+
+
+def work(
+    queue_dir: str,
+    username=None,
+    password=None,
+    cache_dir=None,
+    credential_cache=CREDENTIAL_CACHE_PATH,
+    lease_seconds=QUEUE_LEASE_SECONDS,
+    poll_seconds=QUEUE_POLL_SECONDS,
+    wait=False,
+    band_store_dir=BAND_STORE_DIR,
+):
+    """
+    The work function runs the tasks of a queue until it is empty.
+
+    A thread extends the lease of the running task every third of lease_seconds, so only
+    the tasks of dead workers are leased again.
+
+    Args:
+        queue_dir (str): folder of the queue.
+        username (str): username for earthexplorer.
+        password (str):  password for earthexplorer.
+        cache_dir (str): Optional band cache of the worker.
+        credential_cache (str): path of the credential cache of the session.
+        lease_seconds (float): seconds of the lease without heartbeats.
+        poll_seconds (float): seconds between the checks of a queue without pending tasks.
+        wait (bool): wait for new tasks when the queue is empty.
+        band_store_dir (str): folder of the band store of the worker, empty to disable it.
+    Returns:
+        dict: number of tasks done and failed by the worker.
+    """
+    queue = WorkQueue(queue_dir)
+    owner = worker_id()
+    stats = {"done": 0, "failed": 0}
+    while True:
+        task = queue.lease(owner, lease_seconds)
+        if task is None:
+            if not wait and not queue.stats()["running"]:
+                return stats
+            # the running tasks of other workers can be released
+            time.sleep(poll_seconds)
+            continue
+        task_id, payload = task
+        logger.info(f"{owner}: task {payload['scene'].get('display_id')}")
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(lease_seconds / 3):
+                if not queue.heartbeat(task_id, owner, lease_seconds):
+                    logger.warning(f"{owner}: lease of task {task_id} lost")
+                    return
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            result = run_task(
+                payload,
+                username,
+                password,
+                cache_dir,
+                band_store_dir,
+                credential_cache=credential_cache,
+            )
+        except Exception as ex:
+            logger.error(f"{owner}: task {task_id} failed: {ex}")
+            queue.fail(task_id, owner, ex)
+            stats["failed"] += 1
+            continue
+        finally:
+            stop.set()
+            beat.join()
+        if queue.complete(task_id, owner, result):
+            stats["done"] += 1
+
+
+def scene_task(scene, landsat_index, data_folder, options):
+    """
+    The scene_task function creates the payload of the task of a scene.
+
+    Args:
+        scene (dict): scene with the features it contains.
+        landsat_index (list): keys of the indices.
+        data_folder (str): path of directory, shared by the workers.
+        options (dict): options of the download and the index, see run_task.
+    Returns:
+        dict: the payload.
+    """
+    from .feature_utils import clean_path
+
+    # an empty folder keeps the outputs out of the disk, like the run without queue
+    data_folder = clean_path(data_folder or "")
+    return {
+        "scene": scene,
+        "landsat_index": list(landsat_index),
+        "data_folder": os.path.abspath(data_folder) if data_folder else data_folder,
+        "options": {"cache_max_bytes": BAND_CACHE_MAX_BYTES, **options},
+    }
+
+
+def run_queue(
+    queue_dir: str,
+    tasks: dict,
+    username=None,
+    password=None,
+    workers=1,
+    credential_cache=CREDENTIAL_CACHE_PATH,
+    poll_seconds=QUEUE_POLL_SECONDS,
+    band_store_dir=BAND_STORE_DIR,
+):
+    """
+    The run_queue function enqueues tasks, runs local workers and waits for all of them.
+
+    The workers of other hosts can run the tasks of the same queue_dir with
+    landsat2geojson-worker.
+
+    Args:
+        queue_dir (str): folder of the queue.
+        tasks (dict): payloads by task id, the done tasks are not run again.
+        username (str): username for earthexplorer.
+        password (str):  password for earthexplorer.
+        workers (int): number of local worker processes, 0 to wait for other workers.
+        credential_cache (str): path of the credential cache of the session.
+        poll_seconds (float): seconds between the checks of the queue.
+        band_store_dir (str): folder of the band store of the local workers, empty to disable it.
+    Returns:
+        dict: results by task id.
+    """
+    queue = WorkQueue(queue_dir)
+    for task_id, payload in tasks.items():
+        queue.enqueue(task_id, payload)
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=work,
+            args=(queue_dir, username, password),
+            kwargs={
+                "credential_cache": credential_cache,
+                "band_store_dir": band_store_dir,
+            },
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        while True:
+            stats = queue.stats(tasks)
+            if not stats["pending"] and not stats["running"]:
+                break
+            logger.info(f"queue {queue_dir}: {stats}")
+            time.sleep(poll_seconds)
+    finally:
+        for process in processes:
+            process.join()
+    failed = {
+        task_id: task["error"]
+        for task_id, task in queue.status(tasks).items()
+        if task["status"] == "failed"
+    }
+    if failed:
+        raise Exception(
+            f"{len(failed)} tasks failed: "
+            + ", ".join(
+                f"{tasks[i]['scene'].get('display_id')} ({error})"
+                for i, error in failed.items()
+            )
+        )
+    return {task_id: queue.result(task_id) for task_id in tasks}
+
+
+@click.command(short_help="Run the tasks of a landsat2geojson queue")
+@click.option(
+    "-u",
+    "--username",
+    type=str,
+    help="EarthExplorer username.",
+    envvar="LANDSATXPLORE_USERNAME",
+)
+@click.option(
+    "-p",
+    "--password",
+    type=str,
+    help="EarthExplorer password.",
+    envvar="LANDSATXPLORE_PASSWORD",
+)
+@click.option(
+    "--queue_dir",
+    help="Folder of the queue, the --queue_dir of landsat2geojson",
+    required=True,
+    type=str,
+)
+@click.option(
+    "--cache_dir",
+    help="Path of the band cache of this worker, by default the one of the run",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--credential_cache",
+    help="Path of the cache of the EarthExplorer login, empty to disable it",
+    type=str,
+    default=CREDENTIAL_CACHE_PATH,
+    show_default=True,
+)
+@click.option(
+    "--lease_seconds",
+    help="Seconds after which the task of a worker without heartbeats is run by other",
+    type=float,
+    default=QUEUE_LEASE_SECONDS,
+    show_default=True,
+)
+@click.option(
+    "--band_store_dir",
+    help="Folder of the band arrays memory mapped by the processes, empty to keep them in memory",
+    type=str,
+    default=BAND_STORE_DIR,
+    show_default=True,
+)
+@click.option(
+    "--wait",
+    help="Wait for new tasks when the queue is empty",
+    is_flag=True,
+    default=False,
+)
+def main(
+    username,
+    password,
+    queue_dir,
+    cache_dir,
+    credential_cache,
+    lease_seconds,
+    band_store_dir,
+    wait,
+):
+    stats = work(
+        queue_dir,
+        username,
+        password,
+        cache_dir=cache_dir,
+        credential_cache=credential_cache or None,
+        lease_seconds=lease_seconds,
+        wait=wait,
+        band_store_dir=band_store_dir,
+    )
+    click.echo(f"{stats['done']} tasks done, {stats['failed']} failed")
+
+
+if __name__ == "__main__":
+    main()
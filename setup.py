@@ -59,10 +59,14 @@ setup(
     entry_points={
         "console_scripts": [
             "landsat2geojson = landsat2geojson.main:main",
+            "landsat2geojson-batch = landsat2geojson.batch:main",
+            "landsat2geojson-benchmark = landsat2geojson.benchmark:main",
+            "landsat2geojson-worker = landsat2geojson.work_queue:main",
         ]
     },
     packages=find_packages(exclude=["docs", "tests*"]),
     include_package_data=True,
     install_requires=install_requires,
+    extras_require={"async": ["aiohttp"], "parquet": ["pyarrow"]},
     python_requires='>=3.9'
 )
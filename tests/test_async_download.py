@@ -0,0 +1,61 @@
+import email.utils
+import time
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import shape
+
+from landsat2geojson.async_download import (
+    DEFAULT_RETRY_AFTER,
+    download_bands_async,
+    retry_after_seconds,
+)
+from landsat2geojson.benchmark import make_features, make_scene, scene_bounds
+from landsat2geojson.download_band import WrapperEarthExplorer
+from landsat2geojson.local_server import LocalServer
+
+# the files are bigger than the socket buffers, so the requests overlap
+SIZE = 2048
+BANDS = ["B3", "B6"]
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds("7") == 7.0
+    assert retry_after_seconds("-3") == 0.0
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= retry_after_seconds(date) <= 30
+    assert retry_after_seconds("soon") == DEFAULT_RETRY_AFTER
+    assert retry_after_seconds(None) == DEFAULT_RETRY_AFTER
+    assert retry_after_seconds("", default=1.5) == 1.5
+
+
+@pytest.fixture
+def scenes(tmp_path):
+    display_ids = [f"LC09_L2SP_{i:03d}001_20220101_20220102_02_T1" for i in (1, 2)]
+    tasks = []
+    for number, display_id in enumerate(display_ids):
+        bounds = scene_bounds(number, SIZE)
+        make_scene(str(tmp_path), display_id, BANDS, SIZE, bounds, seed=number)
+        features_contains = gpd.GeoSeries(
+            [shape(i["geometry"]) for i in make_features(bounds, 3, seed=number)]
+        ).set_crs(4326)
+        tasks += [(display_id, band, features_contains) for band in BANDS]
+    return str(tmp_path), tasks
+
+
+def test_async_download_adapts_to_throttling(scenes):
+    folder, tasks = scenes
+    initial = len(tasks)
+    with LocalServer(folder, max_concurrent=1, retry_after=0) as server:
+        ee = WrapperEarthExplorer(download_url=server.download_url)
+        results, stats = download_bands_async(
+            ee, tasks, initial_concurrency=initial, max_concurrency=initial
+        )
+    assert stats["throttled"] > 0
+    assert stats["min_limit"] < initial
+    assert server.stats["throttled"] > 0
+    # every band is downloaded and masked, in the order of the tasks
+    assert [i["name"] for i in results] == [
+        f"L2SR_{display_id}_SR_{band}_TIF" for display_id, band, _ in tasks
+    ]
+    assert all(i["data_read"]["out_image"].any() for i in results)
@@ -0,0 +1,76 @@
+import os
+import time
+
+from landsat2geojson.band_cache import BandCache
+
+
+def add(cache, key, data):
+    tmp_path = cache.tmp_path(key)
+    with open(tmp_path, "wb") as dst:
+        dst.write(data)
+    path = cache.put(key, tmp_path)
+    # distinct last access times
+    time.sleep(0.01)
+    return path
+
+
+def test_lru_eviction_skips_locked_keys(tmp_path):
+    cache = BandCache(str(tmp_path), max_bytes=25)
+    add(cache, "a", b"a" * 10)
+    add(cache, "b", b"b" * 10)
+    # b is the most recently used
+    assert cache.get("b")
+    with cache.lock("a"):
+        # a is the least recently used but it is read by other worker
+        add(cache, "c", b"c" * 10)
+        add(cache, "d", b"d" * 10)
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is None
+    assert cache.get("d") is not None
+    assert cache.stats()["bytes"] == 20
+
+
+def test_lru_eviction(tmp_path):
+    cache = BandCache(str(tmp_path), max_bytes=25)
+    for key in "abc":
+        add(cache, key, key.encode() * 10)
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.get("c") is not None
+
+
+def test_truncated_file_is_removed(tmp_path):
+    cache = BandCache(str(tmp_path))
+    path = add(cache, "a", b"a" * 10)
+    with open(path, "r+b") as dst:
+        dst.truncate(5)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+    assert not os.path.exists(path)
+
+
+def test_modified_file_is_removed(tmp_path):
+    cache = BandCache(str(tmp_path))
+    path = add(cache, "a", b"a" * 10)
+    # same size, other content
+    with open(path, "r+b") as dst:
+        dst.write(b"b" * 10)
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_verify(tmp_path):
+    cache = BandCache(str(tmp_path))
+    path = add(cache, "a", b"a" * 10)
+    add(cache, "b", b"b" * 10)
+    mtime = os.path.getmtime(path)
+    with open(path, "r+b") as dst:
+        dst.write(b"c" * 10)
+    os.utime(path, (mtime, mtime))
+    # the size and the modification time are the same, only the checksum finds it
+    assert cache.get("a") == path
+    assert cache.verify() == ["a"]
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
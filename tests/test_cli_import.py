@@ -0,0 +1,24 @@
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ["rasterio", "geopandas", "shapely", "pyproj", "joblib"]
+# seconds, the CLI without the heavy modules starts in a fraction of it
+MAX_IMPORT_SECONDS = 2.0
+
+
+def test_cli_import_is_lazy():
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import landsat2geojson.main\n"
+        "seconds = time.perf_counter() - start\n"
+        f"heavy = [i for i in {HEAVY_MODULES!r} if i in sys.modules]\n"
+        "print(json.dumps({'seconds': seconds, 'heavy': heavy}))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    assert result["heavy"] == []
+    assert result["seconds"] < MAX_IMPORT_SECONDS
@@ -0,0 +1,40 @@
+import numpy as np
+import shapely
+
+from landsat2geojson.benchmark import make_boxes
+from landsat2geojson.feature_utils import mark_intersects
+
+
+def brute_force_intersects(geoms_a, geoms_b):
+    intersects_a = np.zeros(len(geoms_a), dtype=bool)
+    intersects_b = np.zeros(len(geoms_b), dtype=bool)
+    for i, geom_a in enumerate(geoms_a):
+        for j, geom_b in enumerate(geoms_b):
+            if geom_a.intersects(geom_b):
+                intersects_a[i] = True
+                intersects_b[j] = True
+    return intersects_a, intersects_b
+
+
+def test_mark_intersects_matches_pairwise_loop():
+    geoms_a = make_boxes(300, seed=1, max_size=0.05)
+    geoms_b = make_boxes(200, seed=2, max_size=0.05)
+    # a box that only touches other box, touching geometries intersect
+    x = shapely.bounds(geoms_b[0])[2]
+    geoms_a[0] = shapely.box(x, 0.5, x + 0.01, 0.51)
+    features_a = [{"geom": i} for i in geoms_a]
+    features_b = [{"geom": i} for i in geoms_b]
+
+    expected_a, expected_b = brute_force_intersects(geoms_a, geoms_b)
+    intersects_a, intersects_b = mark_intersects(features_a, features_b)
+    np.testing.assert_array_equal(intersects_a, expected_a)
+    np.testing.assert_array_equal(intersects_b, expected_b)
+    # the boxes are dense enough to have both flags
+    assert 0 < intersects_a.sum() < len(geoms_a)
+    assert 0 < intersects_b.sum() < len(geoms_b)
+
+
+def test_mark_intersects_empty():
+    intersects_a, intersects_b = mark_intersects([], [{"geom": shapely.box(0, 0, 1, 1)}])
+    assert intersects_a.shape == (0,)
+    assert intersects_b.tolist() == [False]
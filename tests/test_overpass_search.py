@@ -0,0 +1,31 @@
+from landsat2geojson.overpass_search import osm_key
+
+
+def feature(geometry_type, coordinates, properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": geometry_type, "coordinates": coordinates},
+        "properties": properties,
+    }
+
+
+def test_osm_key_node_and_way_with_the_same_id():
+    # older overpass conversion, the type property is the type of the feature
+    node = feature("Point", [0.0, 0.0], {"type": "Feature", "id": 42})
+    way = feature(
+        "LineString", [[0.0, 0.0], [1.0, 1.0]], {"type": "Feature", "id": 42}
+    )
+    assert osm_key(node) != osm_key(way)
+
+
+def test_osm_key_element_type():
+    way = feature("LineString", [[0.0, 0.0], [1.0, 1.0]], {"type": "way", "id": 42})
+    assert osm_key(way) == "way/42"
+    way_osmtogeojson = dict(way, id="way/42", properties={"highway": "primary"})
+    assert osm_key(way_osmtogeojson) == "way/42"
+
+
+def test_osm_key_same_feature_in_two_tiles():
+    first = feature("Point", [0.0, 0.0], {"id": 7})
+    second = feature("Point", [0.0, 0.0], {"id": 7})
+    assert osm_key(first) == osm_key(second)
@@ -0,0 +1,56 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import shape
+
+from landsat2geojson.benchmark import make_features, make_scene, scene_bounds
+from landsat2geojson.download_band import WrapperEarthExplorer
+from landsat2geojson.local_server import LocalServer
+from landsat2geojson.profiling import span, start_profiling, stop_profiling
+
+DISPLAY_ID = "LC09_L2SP_001001_20220101_20220102_02_T1"
+SIZE = 512
+
+
+@pytest.fixture
+def scene(tmp_path):
+    folder = tmp_path / "server"
+    folder.mkdir()
+    bounds = scene_bounds(0, SIZE)
+    (path,) = make_scene(str(folder), DISPLAY_ID, ["B3"], SIZE, bounds)
+    features = make_features(bounds, 3)
+    features_contains = gpd.GeoSeries(
+        [shape(i["geometry"]) for i in features]
+    ).set_crs(4326)
+    return str(folder), os.path.getsize(path), features_contains
+
+
+def read_band(folder, features_contains, output_dir, ranges):
+    """Masked band and the counters of the read."""
+    start_profiling()
+    try:
+        with LocalServer(folder, ranges=ranges) as server, span("read") as record:
+            ee = WrapperEarthExplorer(download_url=server.download_url)
+            band = ee.download_band(
+                DISPLAY_ID, "B3", features_contains, str(output_dir), partial=True
+            )
+    finally:
+        stop_profiling()
+    return band["data_read"]["out_image"], record["counters"]
+
+
+def test_partial_read_falls_back_to_the_whole_file(scene, tmp_path):
+    folder, file_size, features_contains = scene
+    partial, partial_counters = read_band(
+        folder, features_contains, tmp_path / "partial", ranges=True
+    )
+    whole, whole_counters = read_band(
+        folder, features_contains, tmp_path / "whole", ranges=False
+    )
+    np.testing.assert_array_equal(partial, whole)
+    assert partial.any()
+    # only the tiles of the features with ranges, the whole file without them
+    assert partial_counters == {"partial_reads": 1}
+    assert whole_counters == {"bytes_downloaded": file_size}
@@ -0,0 +1,70 @@
+import io
+import json
+
+import pytest
+
+from landsat2geojson import vector_io
+
+def point(number, properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [number, number]},
+        "properties": properties,
+    }
+
+
+def test_geoparquet_typed_properties(tmp_path, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    # one row group for each two features
+    monkeypatch.setattr(vector_io, "WRITE_BATCH_SIZE", 2)
+    features = [
+        point(0, {"val": 1, "source_generated": "landsat"}),
+        point(1, {"val": 2, "source_generated": "landsat", "intersects": True}),
+        point(2, {"val": 0.5, "bbox": "x"}),
+        point(3, {"tags": {"natural": "water"}, "val": None}),
+        point(4, {"val": 3, "name": 7}),
+        point(5, {"name": "lake"}),
+    ]
+    path = str(tmp_path / "output.parquet")
+    assert vector_io.write_features(path, iter(features), driver="GeoParquet") == 6
+
+    parquet = pq.ParquetFile(path)
+    assert parquet.num_row_groups == 3
+    table = parquet.read().drop(["geometry", "bbox"])
+    assert {i.name: str(i.type) for i in table.schema} == {
+        # the ints of the first row group are widened with the floats of the next ones
+        "val": "double",
+        "source_generated": "string",
+        "intersects": "bool",
+        "bbox_property": "string",
+        "tags": "string",
+        # a number and a string are strings
+        "name": "string",
+    }
+    assert table.column("val").to_pylist() == [1.0, 2.0, 0.5, None, 3.0, None]
+    assert table.column("intersects").to_pylist() == [None, True] + [None] * 4
+    assert table.column("tags").to_pylist()[3] == '{"natural":"water"}'
+    assert table.column("name").to_pylist()[4:] == ["7", "lake"]
+    assert not [i for i in tmp_path.iterdir() if i.name.startswith(".spool_")]
+
+
+def test_json_stream_value_bigger_than_chunks():
+    polygon = [[[i * 0.001, i * 0.002] for i in range(20000)]]
+    feature = {
+        "type": "Feature",
+        "properties": {},
+        "geometry": {"type": "Polygon", "coordinates": polygon},
+    }
+    text = json.dumps({"type": "FeatureCollection", "features": [feature, feature]})
+
+    class CountingFile(io.StringIO):
+        reads = 0
+
+        def read(self, size=-1):
+            CountingFile.reads += 1
+            return super().read(size)
+
+    stream = vector_io._JSONStream(CountingFile(text), chunk_size=1024)
+    assert list(vector_io._iter_feature_collection(stream)) == [feature, feature]
+    # the reads grow while a feature is not complete, instead of one read per chunk
+    assert CountingFile.reads < len(text) / 1024 / 10
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+from landsat2geojson.work_queue import WorkQueue, run_queue
+
+PAYLOAD = {"scene": {"display_id": "LC08_L2SP_001002_20220101_20220102_02_T1"}}
+
+
+def test_expired_lease_is_leased_by_other_owner(tmp_path):
+    queue = WorkQueue(str(tmp_path))
+    queue.enqueue("a", PAYLOAD)
+    assert queue.lease("worker-1", lease_seconds=0)[0] == "a"
+    time.sleep(0.01)
+    task_id, payload = queue.lease("worker-2", lease_seconds=60)
+    assert task_id == "a"
+    assert payload == PAYLOAD
+    assert not queue.heartbeat("a", "worker-1")
+    assert queue.heartbeat("a", "worker-2")
+
+
+def test_valid_lease_is_not_leased_again(tmp_path):
+    queue = WorkQueue(str(tmp_path))
+    queue.enqueue("a", PAYLOAD)
+    assert queue.lease("worker-1", lease_seconds=60)[0] == "a"
+    assert queue.lease("worker-2", lease_seconds=60) is None
+
+
+def test_task_failed_after_max_attempts(tmp_path):
+    queue = WorkQueue(str(tmp_path), max_attempts=2)
+    queue.enqueue("a", PAYLOAD)
+    for attempt in range(2):
+        assert queue.lease("worker-1")[0] == "a"
+        queue.fail("a", "worker-1", ValueError(f"error {attempt}"))
+    assert queue.status() == {"a": {"status": "failed", "error": "error 1"}}
+    assert queue.lease("worker-1") is None
+
+
+def test_expired_lease_failed_after_max_attempts(tmp_path):
+    queue = WorkQueue(str(tmp_path), max_attempts=1)
+    queue.enqueue("a", PAYLOAD)
+    assert queue.lease("worker-1", lease_seconds=0)[0] == "a"
+    time.sleep(0.01)
+    assert queue.lease("worker-2") is None
+    assert queue.status()["a"]["status"] == "failed"
+
+
+def test_complete_of_a_lost_lease_is_ignored(tmp_path):
+    queue = WorkQueue(str(tmp_path))
+    queue.enqueue("a", PAYLOAD)
+    queue.lease("worker-1", lease_seconds=0)
+    time.sleep(0.01)
+    queue.lease("worker-2", lease_seconds=60)
+    assert not queue.complete("a", "worker-1", {"owner": 1})
+    assert queue.status()["a"]["status"] == "running"
+    assert queue.complete("a", "worker-2", {"owner": 2})
+    assert queue.status()["a"]["status"] == "done"
+    assert queue.result("a") == {"owner": 2}
+    assert list((tmp_path / "results").iterdir()) == [tmp_path / "results" / "a.json"]
+
+
+def test_run_queue_raises_when_a_task_failed(tmp_path):
+    queue = WorkQueue(str(tmp_path), max_attempts=1)
+    stop = threading.Event()
+
+    def worker():
+        # a worker of other host whose tasks fail
+        while not stop.is_set():
+            task = queue.lease("worker-1")
+            if task:
+                queue.fail(task[0], "worker-1", RuntimeError("no bands"))
+            time.sleep(0.01)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    try:
+        with pytest.raises(Exception, match="1 tasks failed.*no bands"):
+            run_queue(
+                str(tmp_path),
+                {"a": PAYLOAD},
+                workers=0,
+                credential_cache=None,
+                poll_seconds=0.01,
+            )
+    finally:
+        stop.set()
+        thread.join()